@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import inbox, membership, sharding
+
+        sharding.connect_signals()
+        membership.connect_signals()
+        inbox.connect_signals()
@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import sharding
+from .models import Expense, ExpenseSplitBetween, ArchivedExpense, ArchivedExpenseSplit
+
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'ARCHIVE_SETTLED_AFTER_DAYS', 90)
+ARCHIVE_BATCH_SIZE = getattr(settings, 'ARCHIVE_BATCH_SIZE', 500)
+
+
+def archivable_expenses(days=ARCHIVE_AFTER_DAYS):
+    """Expenses older than ``days`` with no split still owing anything.
+
+    Tombstones of deleted expenses stay where they are.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    return Expense.objects.filter(created_at__lt=cutoff, deleted_at__isnull=True).exclude(
+        id__in=ExpenseSplitBetween.objects.filter(amount_owed__gt=0).values('expense_id')
+    )
+
+
+def archive_batch(expense_ids):
+    """Archive the given expenses that are still settled, in one transaction on the current database."""
+    with transaction.atomic(using=sharding.current_alias()):
+        return _archive_batch(expense_ids)
+
+
+def _archive_batch(expense_ids):
+    expenses = list(Expense.objects.select_for_update().filter(id__in=expense_ids, deleted_at__isnull=True).exclude(
+        id__in=ExpenseSplitBetween.objects.filter(amount_owed__gt=0).values('expense_id')
+    ))
+    if not expenses:
+        return 0
+    ids = [e.id for e in expenses]
+    splits = ExpenseSplitBetween.objects.filter(expense_id__in=ids)
+    shared_with = Expense.split_between.through.objects.filter(expense_id__in=ids)
+
+    ArchivedExpense.objects.bulk_create([
+        ArchivedExpense(
+            id=e.id, group_id=e.group_id, description=e.description, amount=e.amount,
+            paid_by_id=e.paid_by_id, created_at=e.created_at,
+            recurring_id=e.recurring_id, occurrence=e.occurrence,
+        )
+        for e in expenses
+    ])
+    ArchivedExpense.split_between.through.objects.bulk_create([
+        ArchivedExpense.split_between.through(archivedexpense_id=row.expense_id, member_id=row.member_id)
+        for row in shared_with
+    ], batch_size=1000)
+    ArchivedExpenseSplit.objects.bulk_create([
+        ArchivedExpenseSplit(
+            id=s.id, expense_id=s.expense_id, owe_id_id=s.owe_id_id,
+            amount_owed=s.amount_owed, original_amount=s.original_amount,
+        )
+        for s in splits
+    ], batch_size=1000)
+
+    splits.delete()
+    Expense.objects.filter(id__in=ids).delete()
+    return len(ids)
+
+
+def archive_settled(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, limit=None):
+    """Move fully settled expenses and their splits into the archive tables.
+
+    Each batch commits on its own so the hot tables are never locked for the
+    whole run. Returns the number of archived expenses.
+    """
+    archived = 0
+    last_id = 0
+    while limit is None or archived < limit:
+        size = batch_size if limit is None else min(batch_size, limit - archived)
+        ids = list(archivable_expenses(days).filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:size])
+        if not ids:
+            break
+        archived += archive_batch(ids)
+        last_id = ids[-1]
+    return archived
+
+
+def wants_archive(request):
+    return request.query_params.get('include_archived', '').lower() in ('1', 'true', 'yes')
@@ -0,0 +1,186 @@
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+from django.db.models import BigIntegerField, F, Q
+from django.db.models.functions import Cast, Round
+
+from .models import ExpenseSplitBetween, Settlement, Member
+
+
+# The engine works in int64 minor units (paise) so that sums stay exact.
+MINOR_UNITS = 100
+
+# users: sorted user ids; net: int64 vector aligned with users (positive means
+# the user is owed money); pair_*: sparse owe matrix in COO form, already netted
+# so that each unordered pair appears once with pair_from owing pair_to.
+GroupBalances = namedtuple('GroupBalances', ['users', 'net', 'pair_from', 'pair_to', 'pair_amount'])
+
+
+def flat_array(queryset, width):
+    values = chain.from_iterable(queryset.iterator(chunk_size=20000))
+    return np.fromiter(values, dtype=np.int64).reshape(-1, width)
+
+
+def _window(queryset, after_id=0, upto_id=None):
+    queryset = queryset.filter(id__gt=after_id)
+    if upto_id is not None:
+        queryset = queryset.filter(id__lte=upto_id)
+    return queryset
+
+
+def split_arrays(queryset, with_id=False):
+    """(debtor, creditor, amount) arrays for splits; the payer is the creditor."""
+    fields = ['owe_id', 'expense__paid_by', 'amount_owed']
+    if with_id:
+        fields.insert(0, 'id')
+    data = flat_array(queryset.values_list(*fields), len(fields))
+    columns = [data[:, i] for i in range(len(fields))]
+    columns[-1] = columns[-1] * MINOR_UNITS
+    return tuple(columns)
+
+
+def settlement_arrays(queryset, with_id=False):
+    """Settlements as (debtor, creditor, amount) arrays with negative amounts."""
+    fields = ['from_user', 'to_user', 'minor']
+    if with_id:
+        fields.insert(0, 'id')
+    queryset = queryset.annotate(minor=Cast(Round(F('amount') * MINOR_UNITS), BigIntegerField()))
+    data = flat_array(queryset.values_list(*fields), len(fields))
+    columns = [data[:, i] for i in range(len(fields))]
+    # A payment from x to y reduces what x owes y.
+    columns[-1] = -columns[-1]
+    return tuple(columns)
+
+
+def concat_rows(*parts):
+    return tuple(np.concatenate(columns) for columns in zip(*parts))
+
+
+def group_rows(group_id, split_after=0, settlement_after=0, split_upto=None, settlement_upto=None):
+    splits = _window(ExpenseSplitBetween.objects.filter(expense__group_id=group_id), split_after, split_upto)
+    settlements = _window(Settlement.objects.filter(group_id=group_id), settlement_after, settlement_upto)
+    return concat_rows(split_arrays(splits), settlement_arrays(settlements))
+
+
+def pair_rows(user_a, user_b, split_after=0, settlement_after=0, split_upto=None, settlement_upto=None):
+    splits = ExpenseSplitBetween.objects.filter(
+        Q(owe_id=user_a, expense__paid_by=user_b) | Q(owe_id=user_b, expense__paid_by=user_a)
+    )
+    settlements = Settlement.objects.filter(
+        Q(from_user=user_a, to_user=user_b) | Q(from_user=user_b, to_user=user_a)
+    )
+    return concat_rows(
+        split_arrays(_window(splits, split_after, split_upto)),
+        settlement_arrays(_window(settlements, settlement_after, settlement_upto)),
+    )
+
+
+def sum_by_key(keys, values):
+    """Sum int64 ``values`` per distinct key without leaving int64."""
+    if not len(keys):
+        return keys, values
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(values[order], starts)
+
+
+def directional_totals(debtors, creditors, amounts):
+    """Gross (debtor, creditor, amount) totals per ordered pair, self-debts dropped."""
+    keep = debtors != creditors
+    debtors, creditors, amounts = debtors[keep], creditors[keep], amounts[keep]
+    base = int(max(debtors.max(), creditors.max())) + 1 if len(debtors) else 1
+    keys, totals = sum_by_key(debtors * base + creditors, amounts)
+    return keys // base, keys % base, totals
+
+
+def reduce_balances(debtors, creditors, amounts, members=()):
+    """Reduce flat (debtor, creditor, amount) arrays to a GroupBalances."""
+    members = np.asarray(members, dtype=np.int64)
+    users, index = np.unique(np.concatenate([debtors, creditors, members]), return_inverse=True)
+    size = len(users)
+    debtor = index[:len(debtors)]
+    creditor = index[len(debtors):len(debtors) + len(creditors)]
+
+    keep = debtor != creditor
+    debtor, creditor, amounts = debtor[keep], creditor[keep], amounts[keep]
+
+    # Fold both directions of a pair onto one key, signed from low to high.
+    low = np.minimum(debtor, creditor)
+    high = np.maximum(debtor, creditor)
+    signed = np.where(debtor == low, amounts, -amounts)
+    keys, sums = sum_by_key(low * size + high, signed)
+
+    nonzero = sums != 0
+    keys, sums = keys[nonzero], sums[nonzero]
+    low, high = keys // size, keys % size
+
+    net = np.zeros(size, dtype=np.int64)
+    idx, totals = sum_by_key(np.concatenate([high, low]), np.concatenate([sums, -sums]))
+    net[idx] = totals
+
+    forward = sums > 0
+    return GroupBalances(
+        users=users,
+        net=net,
+        pair_from=users[np.where(forward, low, high)],
+        pair_to=users[np.where(forward, high, low)],
+        pair_amount=np.abs(sums),
+    )
+
+
+def python_reduce_balances(debtors, creditors, amounts):
+    """Pure-Python reference used by the benchmark and consistency checks."""
+    net = {}
+    pairs = {}
+    for debtor, creditor, amount in zip(debtors, creditors, amounts):
+        if debtor == creditor:
+            continue
+        net[creditor] = net.get(creditor, 0) + amount
+        net[debtor] = net.get(debtor, 0) - amount
+        if debtor < creditor:
+            key, signed = (debtor, creditor), amount
+        else:
+            key, signed = (creditor, debtor), -amount
+        pairs[key] = pairs.get(key, 0) + signed
+    return net, pairs
+
+
+def group_members(group_id):
+    return list(Member.objects.filter(group_id=group_id, user__isnull=False).values_list('user_id', flat=True))
+
+
+def compute_group_balances(group_id):
+    """Full recompute over the group's entire history."""
+    return reduce_balances(*group_rows(group_id), members=group_members(group_id))
+
+
+def compute_user_totals(user_id):
+    """Full recompute of (owed to the user, owed by the user) in minor units."""
+    splits = ExpenseSplitBetween.objects.filter(Q(owe_id=user_id) | Q(expense__paid_by=user_id))
+    settlements = Settlement.objects.filter(Q(from_user=user_id) | Q(to_user=user_id))
+    return user_totals(*concat_rows(split_arrays(splits), settlement_arrays(settlements)), user_id=user_id)
+
+
+def user_totals(debtors, creditors, amounts, user_id):
+    others = debtors != creditors
+    owed_to_user = int(amounts[others & (creditors == user_id)].sum())
+    owed_by_user = int(amounts[others & (debtors == user_id)].sum())
+    return owed_to_user, owed_by_user
+
+
+def to_major(minor):
+    return round(int(minor) / MINOR_UNITS, 2)
+
+
+def balances_payload(group_id, balances):
+    return {
+        'group': group_id,
+        'users': balances.users.tolist(),
+        'net': [to_major(v) for v in balances.net],
+        'pairs': [
+            {'from_user': int(f), 'to_user': int(t), 'amount': to_major(a)}
+            for f, t, a in zip(balances.pair_from, balances.pair_to, balances.pair_amount)
+        ],
+    }
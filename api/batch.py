@@ -0,0 +1,166 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+
+from . import load_shedding
+from .db_routers import SAFE_METHODS, pin_to_primary, serving
+
+
+MAX_REQUESTS = getattr(settings, 'BATCH_MAX_REQUESTS', 20)
+MAX_WORKERS = getattr(settings, 'BATCH_MAX_WORKERS', 4)
+logger = logging.getLogger(__name__)
+
+METHODS = ('GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+# Copied from the batch request onto each sub-request.
+INHERITED_META = (
+    'REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'HTTP_HOST',
+    'HTTP_USER_AGENT', 'HTTP_ACCEPT_LANGUAGE', 'wsgi.url_scheme',
+)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='batch')
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse(data):
+    """Validate a batch body and return its sub-requests as dicts."""
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise BatchError('requests must be a non-empty list')
+    if len(items) > MAX_REQUESTS:
+        raise BatchError(f'at most {MAX_REQUESTS} requests per batch')
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise BatchError(f'requests[{index}] needs a path')
+        method = str(item.get('method', 'GET')).upper()
+        if method not in METHODS:
+            raise BatchError(f'requests[{index}] has an unsupported method')
+        headers = item.get('headers') or {}
+        if not isinstance(headers, dict):
+            raise BatchError(f'requests[{index}] headers must be an object')
+        parsed.append({
+            'method': method,
+            'path': item['path'],
+            'body': item.get('body'),
+            'headers': {str(k): str(v) for k, v in headers.items()},
+        })
+    return parsed
+
+
+def sub_request(outer, item):
+    """An HttpRequest for one item that carries the batch caller's identity.
+
+    The user is forced through DRF's forced-authentication hook so the JWT
+    is verified once, for the batch request itself.
+    """
+    url = urlsplit(item['path'])
+    body = b'' if item['body'] is None else json.dumps(item['body']).encode()
+
+    request = HttpRequest()
+    request.method = item['method']
+    request.path = request.path_info = url.path
+    request.META = {key: outer.META[key] for key in INHERITED_META if key in outer.META}
+    request.META.update({
+        'REQUEST_METHOD': item['method'],
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+    })
+    for name, value in item['headers'].items():
+        if name.lower() != 'authorization':
+            request.META['HTTP_' + name.upper().replace('-', '_')] = value
+    request.GET = QueryDict(url.query)
+    request._stream = BytesIO(body)
+    request._read_started = False
+
+    request.user = outer.user
+    request._force_auth_user = outer.user
+    request._force_auth_token = outer.auth
+    return request
+
+
+def payload(response):
+    if hasattr(response, 'data'):
+        return response.data
+    if not response.content:
+        return None
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(response.content)
+    return response.content.decode(response.charset or 'utf-8', 'replace')
+
+
+def dispatch(outer, item):
+    """Run one sub-request through its view and return a result entry."""
+    request = sub_request(outer, item)
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return {'status': 404, 'body': {'detail': 'Not found.'}}
+    if getattr(getattr(match.func, 'view_class', None), 'batch_endpoint', False):
+        return {'status': 400, 'body': {'detail': 'Batch requests cannot be nested.'}}
+
+    # Sub-requests skip the middleware, so they meet the load limits here.
+    with load_shedding.limited(outer.user.id, match.view_name, item['method']) as rejection:
+        try:
+            with serving(request):
+                response = rejection or match.func(request, *match.args, **match.kwargs)
+        except Exception:
+            logger.exception('Batch item %s %s failed', item['method'], request.path)
+            return {'status': 500, 'body': {'detail': 'Internal server error.'}}
+    result = {'status': response.status_code, 'body': payload(response)}
+    headers = {name: response[name] for name in ('Location', 'Retry-After', 'Idempotent-Replayed') if response.has_header(name)}
+    if headers:
+        result['headers'] = headers
+    return result
+
+
+def dispatch_in_worker(outer, item):
+    # Worker threads own their database connections; treat each item like a
+    # request so CONN_MAX_AGE and health checks apply.
+    close_old_connections()
+    try:
+        return dispatch(outer, item)
+    finally:
+        close_old_connections()
+
+
+def run(outer, items):
+    """Run sub-requests and return their results in order.
+
+    Consecutive safe requests run concurrently on the shared pool. An unsafe
+    request waits for the reads before it, runs alone on the calling thread
+    and pins the caller to the primary so later items read their writes.
+    """
+    results = [None] * len(items)
+    pending = []
+    wrote = False
+
+    def drain():
+        for index, future in pending:
+            results[index] = future.result()
+        pending.clear()
+
+    for index, item in enumerate(items):
+        if item['method'] in SAFE_METHODS:
+            pending.append((index, _executor.submit(dispatch_in_worker, outer, item)))
+            continue
+        drain()
+        results[index] = dispatch(outer, item)
+        if results[index]['status'] < 400:
+            wrote = True
+            pin_to_primary(outer.user.id)
+    drain()
+    return results, wrote
@@ -0,0 +1,319 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Max, Q
+
+from .balances import (
+    flat_array, split_arrays, settlement_arrays, group_rows, pair_rows, group_members,
+    directional_totals, reduce_balances, user_totals, compute_user_totals, compute_group_balances, concat_rows,
+)
+from . import sharding
+from .locks import group_scope, ledger_lock, pair_scope
+from .models import BalanceCheckpoint, BalanceCheckpointEntry, ExpenseSplitBetween, Settlement
+
+
+logger = logging.getLogger(__name__)
+
+# Retake a checkpoint once this many writes have landed in its scope.
+CHECKPOINT_EVERY = getattr(settings, 'BALANCE_CHECKPOINT_EVERY', 200)
+# Ids are handed out at insert, not at commit, so a row just below the
+# highest visible id may still be in an open transaction. Watermarks stay
+# this many ids below the top; the rows in between are read live.
+WATERMARK_LAG = getattr(settings, 'BALANCE_CHECKPOINT_WATERMARK_LAG', 1000)
+
+# Retakes run here, after the write that made them due has committed.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+
+
+def _ordered(user_a, user_b):
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+def _pair_filter(pairs):
+    query = Q(pk__in=[])
+    for user_a, user_b in {_ordered(a, b) for a, b in pairs if a != b}:
+        query |= Q(user1_id=user_a, user2_id=user_b)
+    return query
+
+
+def _watermarks():
+    return (
+        max((ExpenseSplitBetween.objects.aggregate(top=Max('id'))['top'] or 0) - WATERMARK_LAG, 0),
+        max((Settlement.objects.aggregate(top=Max('id'))['top'] or 0) - WATERMARK_LAG, 0),
+    )
+
+
+def _save(checkpoint, split_watermark, settlement_watermark, rows):
+    checkpoint.split_watermark = split_watermark
+    checkpoint.settlement_watermark = settlement_watermark
+    checkpoint.writes_since = 0
+    checkpoint.save()
+    checkpoint.entries.all().delete()
+    debtors, creditors, amounts = directional_totals(*rows)
+    BalanceCheckpointEntry.objects.bulk_create(
+        [
+            BalanceCheckpointEntry(checkpoint=checkpoint, from_user_id=d, to_user_id=c, amount=a)
+            for d, c, a in zip(debtors.tolist(), creditors.tolist(), amounts.tolist())
+        ],
+        batch_size=1000,
+    )
+    return checkpoint
+
+
+def take_group_checkpoint(group_id):
+    # On the database the checkpoint and its rows are routed to.
+    with transaction.atomic(using=sharding.current_alias()):
+        split_watermark, settlement_watermark = _watermarks()
+        checkpoint, _ = BalanceCheckpoint.objects.select_for_update().get_or_create(group_id=group_id)
+        rows = group_rows(group_id, split_upto=split_watermark, settlement_upto=settlement_watermark)
+        return _save(checkpoint, split_watermark, settlement_watermark, rows)
+
+
+def take_pair_checkpoint(user_a, user_b):
+    user1, user2 = _ordered(user_a, user_b)
+    with transaction.atomic(using=sharding.current_alias()):
+        split_watermark, settlement_watermark = _watermarks()
+        checkpoint, _ = BalanceCheckpoint.objects.select_for_update().get_or_create(user1_id=user1, user2_id=user2)
+        rows = pair_rows(user1, user2, split_upto=split_watermark, settlement_upto=settlement_watermark)
+        return _save(checkpoint, split_watermark, settlement_watermark, rows)
+
+
+def retake(checkpoint):
+    if checkpoint.group_id is not None:
+        return take_group_checkpoint(checkpoint.group_id)
+    return take_pair_checkpoint(checkpoint.user1_id, checkpoint.user2_id)
+
+
+def entry_arrays(checkpoint_ids):
+    rows = BalanceCheckpointEntry.objects.filter(
+        checkpoint_id__in=checkpoint_ids
+    ).values_list('from_user', 'to_user', 'amount')
+    data = flat_array(rows, 3)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def group_balances(group_id):
+    """Group balances as the group checkpoint plus every row after its watermarks."""
+    checkpoint = BalanceCheckpoint.objects.filter(group_id=group_id).first()
+    if checkpoint is None:
+        rows = group_rows(group_id)
+    else:
+        rows = concat_rows(
+            entry_arrays([checkpoint.id]),
+            group_rows(group_id, split_after=checkpoint.split_watermark,
+                       settlement_after=checkpoint.settlement_watermark),
+        )
+    return reduce_balances(*rows, members=group_members(group_id))
+
+
+def pair_totals(user_a, user_b):
+    """(what user_a owes user_b, what user_b owes user_a) in minor units."""
+    user1, user2 = _ordered(user_a, user_b)
+    checkpoint = BalanceCheckpoint.objects.filter(user1_id=user1, user2_id=user2).first()
+    if checkpoint is None:
+        rows = pair_rows(user1, user2)
+    else:
+        rows = concat_rows(
+            entry_arrays([checkpoint.id]),
+            pair_rows(user1, user2, split_after=checkpoint.split_watermark,
+                      settlement_after=checkpoint.settlement_watermark),
+        )
+    owed_to_a, owed_by_a = user_totals(*rows, user_id=user_a)
+    return owed_by_a, owed_to_a
+
+
+def _past_watermark(ids, debtors, creditors, user_id, counterparts, watermarks):
+    others = np.where(debtors == user_id, creditors, debtors)
+    order = np.argsort(counterparts)
+    counterparts, watermarks = counterparts[order], watermarks[order]
+    position = np.clip(np.searchsorted(counterparts, others), 0, len(counterparts) - 1)
+    covered = counterparts[position] == others
+    return ids > np.where(covered, watermarks[position], -1)
+
+
+def user_balance_totals(user_id):
+    """(owed to the user, owed by the user) built from the user's pair checkpoints.
+
+    Counterparts with a checkpoint only contribute rows past its watermarks;
+    everyone else is read in full.
+    """
+    checkpoints = list(BalanceCheckpoint.objects.filter(
+        Q(user1_id=user_id) | Q(user2_id=user_id)
+    ).values_list('id', 'user1_id', 'user2_id', 'split_watermark', 'settlement_watermark'))
+    if not checkpoints:
+        return compute_user_totals(user_id)
+
+    ids, user1s, user2s, split_marks, settlement_marks = (np.array(c, dtype=np.int64) for c in zip(*checkpoints))
+    counterparts = np.where(user1s == user_id, user2s, user1s)
+    covered = counterparts.tolist()
+
+    split_min = int(split_marks.min())
+    splits = ExpenseSplitBetween.objects.filter(
+        Q(owe_id=user_id) & (Q(id__gt=split_min) | ~Q(expense__paid_by__in=covered))
+        | Q(expense__paid_by=user_id) & (Q(id__gt=split_min) | ~Q(owe_id__in=covered))
+    )
+    row_ids, debtors, creditors, amounts = split_arrays(splits, with_id=True)
+    keep = _past_watermark(row_ids, debtors, creditors, user_id, counterparts, split_marks)
+    split_part = debtors[keep], creditors[keep], amounts[keep]
+
+    settlement_min = int(settlement_marks.min())
+    settlements = Settlement.objects.filter(
+        Q(from_user=user_id) & (Q(id__gt=settlement_min) | ~Q(to_user__in=covered))
+        | Q(to_user=user_id) & (Q(id__gt=settlement_min) | ~Q(from_user__in=covered))
+    )
+    row_ids, debtors, creditors, amounts = settlement_arrays(settlements, with_id=True)
+    keep = _past_watermark(row_ids, debtors, creditors, user_id, counterparts, settlement_marks)
+    settlement_part = debtors[keep], creditors[keep], amounts[keep]
+
+    rows = concat_rows(entry_arrays(ids.tolist()), split_part, settlement_part)
+    return user_totals(*rows, user_id=user_id)
+
+
+def note_writes(group_id=None, pairs=()):
+    """Count a ledger write against its group and user-pair checkpoints.
+
+    Missing checkpoints are created empty (watermark 0, which reads as a full
+    recompute) so that every scope starts counting; any scope that reaches
+    CHECKPOINT_EVERY writes is retaken in the background once the current
+    transaction commits (see retake_due).
+    """
+    pairs = {_ordered(a, b) for a, b in pairs if a != b}
+    headers = [BalanceCheckpoint(user1_id=a, user2_id=b) for a, b in pairs]
+    scope = _pair_filter(pairs)
+    if group_id is not None:
+        headers.append(BalanceCheckpoint(group_id=group_id))
+        scope |= Q(group_id=group_id)
+    if not headers:
+        return
+    BalanceCheckpoint.objects.bulk_create(headers, ignore_conflicts=True)
+    BalanceCheckpoint.objects.filter(scope).update(writes_since=F('writes_since') + 1)
+    _retake_later(BalanceCheckpoint.objects.filter(scope, writes_since__gte=CHECKPOINT_EVERY))
+
+
+def note_write_counts(group_counts, pair_counts):
+    """note_writes for many writes at once.
+
+    ``group_counts`` maps group ids and ``pair_counts`` (user, user) pairs to
+    the number of writes in them. Checkpoints are looked up together and
+    bumped with one UPDATE per distinct count.
+    """
+    counts = {}
+    for group_id, count in group_counts.items():
+        if group_id is not None:
+            counts[(group_id, None, None)] = count
+    for (user_a, user_b), count in pair_counts.items():
+        if user_a != user_b:
+            key = (None,) + _ordered(user_a, user_b)
+            counts[key] = counts.get(key, 0) + count
+    if not counts:
+        return
+    BalanceCheckpoint.objects.bulk_create(
+        [BalanceCheckpoint(group_id=g, user1_id=a, user2_id=b) for g, a, b in counts],
+        ignore_conflicts=True, batch_size=1000,
+    )
+
+    # Separate lookups so each can use its unique index; the pair one reads
+    # a superset of the wanted rows, narrowed down here.
+    fields = ('id', 'group_id', 'user1_id', 'user2_id')
+    pairs = [(a, b) for g, a, b in counts if g is None]
+    candidates = list(BalanceCheckpoint.objects.filter(
+        group_id__in=[g for g, _, _ in counts if g is not None],
+    ).values_list(*fields))
+    if pairs:
+        user1s, user2s = zip(*pairs)
+        candidates += BalanceCheckpoint.objects.filter(
+            user1_id__in=set(user1s), user2_id__in=set(user2s),
+        ).values_list(*fields)
+    ids_by_count = defaultdict(list)
+    for checkpoint_id, *key in candidates:
+        count = counts.get(tuple(key))
+        if count:
+            ids_by_count[count].append(checkpoint_id)
+    for count, ids in ids_by_count.items():
+        BalanceCheckpoint.objects.filter(id__in=ids).update(writes_since=F('writes_since') + count)
+    _retake_later(BalanceCheckpoint.objects.filter(
+        id__in=[i for ids in ids_by_count.values() for i in ids], writes_since__gte=CHECKPOINT_EVERY,
+    ))
+
+
+def _retake_later(due):
+    checkpoint_ids = list(due.values_list('id', flat=True))
+    if not checkpoint_ids:
+        return
+    alias = sharding.current_alias()
+    transaction.on_commit(
+        lambda: _executor.submit(copy_context().run, _retake_in_background, alias, checkpoint_ids), using=alias,
+    )
+
+
+def _retake_in_background(alias, checkpoint_ids):
+    close_old_connections()
+    try:
+        retake_due(alias, checkpoint_ids)
+    except Exception:
+        # The next write to the scope, or ``balance_checkpoints take --due``,
+        # tries again.
+        logger.exception('Could not retake balance checkpoints %s on %s', checkpoint_ids, alias)
+    finally:
+        close_old_connections()
+
+
+def retake_due(alias, checkpoint_ids=None):
+    """Retake the checkpoints on ``alias`` with CHECKPOINT_EVERY writes or more since they were taken.
+
+    Each one is taken under its scope's ledger lock. ``checkpoint_ids``
+    limits this to those checkpoints. Returns the number retaken.
+    """
+    retaken = 0
+    with sharding.using(alias):
+        due = BalanceCheckpoint.objects.filter(writes_since__gte=CHECKPOINT_EVERY)
+        if checkpoint_ids is not None:
+            due = due.filter(id__in=checkpoint_ids)
+        for checkpoint in due:
+            if checkpoint.group_id is not None:
+                scope = group_scope(checkpoint.group_id)
+            else:
+                scope = pair_scope(checkpoint.user1_id, checkpoint.user2_id)
+            with ledger_lock(scope):
+                # Someone may have retaken it while we waited for the lock.
+                if BalanceCheckpoint.objects.filter(id=checkpoint.id, writes_since__gte=CHECKPOINT_EVERY).exists():
+                    retake(checkpoint)
+                    retaken += 1
+    return retaken
+
+
+def adjust_split(split_id, group_id, debtor_id, creditor_id, delta):
+    """Apply an in-place change of ``delta`` minor units to an already checkpointed split.
+
+    Rows past a checkpoint's watermark are read live, so only checkpoints
+    that already folded this split in need their entry moved.
+    """
+    if not delta or debtor_id == creditor_id:
+        return
+    user1, user2 = _ordered(debtor_id, creditor_id)
+    scope = Q(user1_id=user1, user2_id=user2)
+    if group_id is not None:
+        scope |= Q(group_id=group_id)
+    checkpoint_ids = BalanceCheckpoint.objects.filter(
+        scope, split_watermark__gte=split_id
+    ).values_list('id', flat=True)
+    for checkpoint_id in checkpoint_ids:
+        key = {'checkpoint_id': checkpoint_id, 'from_user_id': debtor_id, 'to_user_id': creditor_id}
+        if not BalanceCheckpointEntry.objects.filter(**key).update(amount=F('amount') + delta):
+            BalanceCheckpointEntry.objects.create(amount=delta, **key)
+
+
+def verify(checkpoint):
+    """Return True when the checkpoint plus its deltas equals a full recompute."""
+    if checkpoint.group_id is not None:
+        fast = group_balances(checkpoint.group_id)
+        full = compute_group_balances(checkpoint.group_id)
+        return all(np.array_equal(a, b) for a, b in zip(fast, full))
+    fast = pair_totals(checkpoint.user1_id, checkpoint.user2_id)
+    owed_to, owed_by = user_totals(*pair_rows(checkpoint.user1_id, checkpoint.user2_id), user_id=checkpoint.user1_id)
+    return fast == (owed_by, owed_to)
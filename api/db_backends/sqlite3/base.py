@@ -0,0 +1,7 @@
+from django.db.backends.sqlite3 import base
+
+from api.db_pool import InstrumentedConnectionMixin
+
+
+class DatabaseWrapper(InstrumentedConnectionMixin, base.DatabaseWrapper):
+    pass
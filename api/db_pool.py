@@ -0,0 +1,109 @@
+import threading
+import time
+
+from django.db import connections
+
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _alias_stats(alias):
+    return _stats.setdefault(alias, {
+        'connects': 0,
+        'connect_seconds': 0.0,
+        'connect_seconds_max': 0.0,
+        'checkouts': 0,
+        'checkout_seconds': 0.0,
+        'checkout_seconds_max': 0.0,
+        'health_check_failures': 0,
+    })
+
+
+def record_connect(alias, seconds):
+    with _lock:
+        stats = _alias_stats(alias)
+        stats['connects'] += 1
+        stats['connect_seconds'] += seconds
+        stats['connect_seconds_max'] = max(stats['connect_seconds_max'], seconds)
+
+
+def record_checkout(alias, seconds):
+    with _lock:
+        stats = _alias_stats(alias)
+        stats['checkouts'] += 1
+        stats['checkout_seconds'] += seconds
+        stats['checkout_seconds_max'] = max(stats['checkout_seconds_max'], seconds)
+
+
+def record_health_check_failure(alias):
+    with _lock:
+        _alias_stats(alias)['health_check_failures'] += 1
+
+
+class InstrumentedConnectionMixin:
+    """Times new connections and tracks their age for the pool metrics.
+
+    Mixed into the backends under api.db_backends; with CONN_MAX_AGE set a
+    worker thread keeps its connection, so ``connects`` only grows on first
+    use, after CONN_MAX_AGE expires or after a failed health check.
+
+    There is no shared pool to queue on (Django's needs psycopg 3), so the
+    wait a request sees is its checkout: the first query of the request
+    waiting for a usable connection, which is the health check plus a
+    reconnect when that fails or the connection has expired.
+    """
+
+    connected_at = None
+
+    def get_new_connection(self, conn_params):
+        start = time.perf_counter()
+        connection = super().get_new_connection(conn_params)
+        record_connect(self.alias, time.perf_counter() - start)
+        self.connected_at = time.monotonic()
+        return connection
+
+    def _cursor(self, name=None):
+        if self.connection is None or (self.health_check_enabled and not self.health_check_done):
+            start = time.perf_counter()
+            self.close_if_health_check_failed()
+            self.ensure_connection()
+            record_checkout(self.alias, time.perf_counter() - start)
+        return super()._cursor(name)
+
+    def is_usable(self):
+        usable = super().is_usable()
+        if not usable:
+            record_health_check_failure(self.alias)
+        return usable
+
+
+def connection_age(alias):
+    """Seconds since this thread's connection for ``alias`` was opened, or None."""
+    connection = connections[alias]
+    if connection.connection is None or connection.connected_at is None:
+        return None
+    return time.monotonic() - connection.connected_at
+
+
+def stats():
+    """Snapshot of per-alias connection counters for this process."""
+    with _lock:
+        snapshot = {alias: dict(values) for alias, values in _stats.items()}
+    for alias in connections:
+        entry = snapshot.setdefault(alias, dict(_alias_stats(alias)))
+        entry['connection_age_seconds'] = connection_age(alias)
+    return snapshot
+
+
+def prewarm():
+    """Open (and health check) a connection to every configured database.
+
+    Called from gunicorn's post_worker_init so that the TCP/TLS/auth
+    handshake happens before the worker accepts its first request.
+    """
+    for alias in connections:
+        connection = connections[alias]
+        connection.ensure_connection()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import LazyObject, empty
+
+from . import metrics
+
+
+REPLICA_ALIAS = 'replica'
+PIN_KEY = 'db-pin:{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_current_request = ContextVar('splitzy_current_request', default=None)
+
+
+def current_request():
+    return _current_request.get()
+
+
+@contextmanager
+def serving(request):
+    """Route queries made inside the block as part of serving ``request``."""
+    token = _current_request.set(request)
+    try:
+        yield
+    finally:
+        _current_request.reset(token)
+
+
+def wrote(request):
+    """Whether ``request`` may have written, so its user should be pinned.
+
+    Views that serve unsafe methods without writing (the batch endpoint) set
+    ``request.db_wrote`` to say so.
+    """
+    return getattr(request, 'db_wrote', request.method not in SAFE_METHODS)
+
+
+def pin_to_primary(user_id):
+    """Keep ``user_id``'s reads on the primary for REPLICA_PIN_SECONDS."""
+    cache.set(PIN_KEY.format(user_id), True, timeout=settings.REPLICA_PIN_SECONDS)
+
+
+def _resolved_user(request):
+    # Never force the lazy session user from inside the router: loading it
+    # runs a query, which would route back here.
+    user = getattr(request, 'user', None)
+    if isinstance(user, LazyObject) and user._wrapped is empty:
+        return None
+    return user
+
+
+def _reads_from_primary(request):
+    if request.method not in SAFE_METHODS:
+        return True
+    user = _resolved_user(request)
+    if user is None or not user.is_authenticated:
+        # Authentication has not run yet (or failed); nothing to stick to.
+        return False
+    pinned = getattr(request, '_db_pinned', None)
+    if pinned is None:
+        pinned = request._db_pinned = bool(cache.get(PIN_KEY.format(user.id)))
+        metrics.cache_lookup('replica-pin', pinned)
+    return pinned
+
+
+class PrimaryReplicaRouter:
+    """Send reads made while serving a safe request to the replica.
+
+    Writes, unsafe requests, work outside a request (commands, shell) and
+    users who wrote within the last REPLICA_PIN_SECONDS all use the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if REPLICA_ALIAS not in settings.DATABASES:
+            return None
+        request = current_request()
+        if request is None or _reads_from_primary(request):
+            return 'default'
+        return REPLICA_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with serving(request):
+            response = self.get_response(request)
+
+        user = getattr(request, 'user', None)
+        if wrote(request) and response.status_code < 400 and user and user.is_authenticated:
+            pin_to_primary(user.id)
+        return response
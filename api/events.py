@@ -0,0 +1,409 @@
+"""Pub/sub for pushing ledger activity to connected clients.
+
+Writes publish small events to topics (one per group, one per user) after
+their transaction commits; api.push streams them over SSE and WebSockets.
+Each event is encoded once and shared by every subscriber of its topic.
+The last PUSH_BUFFER_SIZE events per topic are kept so a reconnecting
+client can resume from the last event id it saw.
+
+The in-process backend only reaches clients connected to the same worker.
+With several workers or hosts PUSH_BACKEND names RedisBackend (settings
+do this when REDIS_URL is set), which fans events out through Redis.
+"""
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import membership, sharding
+from .fast_serializers import decimal_str, iso_datetime
+from .renderers import FastJSONRenderer
+
+
+BUFFER_SIZE = getattr(settings, 'PUSH_BUFFER_SIZE', 256)
+QUEUE_SIZE = getattr(settings, 'PUSH_QUEUE_SIZE', 512)
+# Seconds RedisBackend keeps a quiet topic's buffer.
+BUFFER_TTL = getattr(settings, 'PUSH_BUFFER_TTL', 3600)
+
+logger = logging.getLogger(__name__)
+
+Event = namedtuple('Event', 'id topic type body')
+
+# Sent instead of events when a gap cannot be replayed; clients refetch.
+RESYNC = Event(None, None, 'resync', b'{"type":"resync"}')
+
+_renderer = FastJSONRenderer()
+
+
+def group_topic(group_id):
+    return f'group:{group_id}'
+
+
+def user_topic(user_id):
+    return f'user:{user_id}'
+
+
+def topics_for(user_id):
+    return [user_topic(user_id)] + [group_topic(group_id) for group_id in sorted(membership.group_ids(user_id))]
+
+
+class Subscription:
+    """One connection's view of a set of topics.
+
+    Replayed events come first, then live ones. When a gap cannot be filled
+    (the resume point fell out of the buffer, or the client read too slowly
+    and its queue overflowed) it yields RESYNC and ends. Live events are
+    queued on ``loop``, the event loop that reads them (by default the
+    running one).
+    """
+
+    def __init__(self, backend, topics, backlog=(), gap=False, queue_size=QUEUE_SIZE, loop=None):
+        self.backend = backend
+        self.topics = topics
+        self.backlog = deque(backlog)
+        self.gap = gap
+        self.overflowed = False
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue = asyncio.Queue(queue_size)
+        # Ids already in the backlog, skipped if they are delivered live too.
+        self.replayed = {event.id for event in self.backlog}
+
+    def deliver(self, event):
+        # Called from whichever thread published.
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def next(self, timeout):
+        """The next event, RESYNC, or None if nothing arrived within ``timeout``."""
+        if self.gap:
+            return RESYNC
+        if self.backlog:
+            return self.backlog.popleft()
+        deadline = self.loop.time() + timeout
+        while True:
+            if self.overflowed and self.queue.empty():
+                return RESYNC
+            try:
+                event = await asyncio.wait_for(self.queue.get(), max(deadline - self.loop.time(), 0))
+            except asyncio.TimeoutError:
+                return None
+            if event.id not in self.replayed:
+                return event
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+
+class InProcessBackend:
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self._lock = threading.Lock()
+        # Microsecond start keeps ids increasing across restarts.
+        self._first_id = time.time_ns() // 1000
+        self._ids = itertools.count(self._first_id)
+        self._subscribers = defaultdict(set)
+        self._buffers = defaultdict(lambda: deque(maxlen=buffer_size))
+        self._evicted = {}
+
+    def publish(self, topic, type, data):
+        with self._lock:
+            event_id = next(self._ids)
+            body = _renderer.render({'id': event_id, 'type': type, 'data': data})
+            event = Event(event_id, topic, type, body)
+            buffer = self._buffers[topic]
+            if len(buffer) == buffer.maxlen:
+                self._evicted[topic] = buffer[0].id
+            buffer.append(event)
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+        return event
+
+    def subscribe(self, topics, after=None, loop=None):
+        """Register for ``topics``, replaying buffered events with id > ``after``.
+
+        Registration and the backlog snapshot happen under the publish lock,
+        so every event is either replayed or delivered live, exactly once.
+        """
+        with self._lock:
+            backlog, gap = [], False
+            if after is not None:
+                gap = after < self._first_id - 1 or any(self._evicted.get(t, -1) > after for t in topics)
+                backlog = sorted(
+                    (event for t in topics for event in self._buffers.get(t, ()) if event.id > after),
+                    key=lambda event: event.id,
+                )
+            subscription = Subscription(self, topics, backlog, gap, loop=loop)
+            for topic in topics:
+                self._subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+
+class RedisBackend:
+    """Fans events out to every worker through Redis.
+
+    Ids come from one counter, kept at or above the Redis clock in
+    microseconds, and each topic's last PUSH_BUFFER_SIZE events are kept in
+    a sorted set for PUSH_BUFFER_TTL seconds, so a client can resume on any
+    worker. Each worker listens to every topic on one pattern subscription
+    and hands events to its own subscribers; if that connection drops they
+    are sent RESYNC, since events may have been missed meanwhile.
+    """
+    PREFIX = 'push:'
+
+    # KEYS[1]: the id counter.
+    NEXT_ID_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000000 + tonumber(clock[2])
+local id = redis.call('INCR', KEYS[1])
+if id < now then
+    redis.call('SET', KEYS[1], string.format('%d', now))
+    return now
+end
+return id
+"""
+    # KEYS: the topic's buffer and its last evicted id. ARGV: event id,
+    # encoded event, buffer size, TTL, channel.
+    PUBLISH_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+if excess > 0 then
+    local last = redis.call('ZRANGE', KEYS[1], excess - 1, excess - 1, 'WITHSCORES')
+    redis.call('SET', KEYS[2], last[2], 'EX', ARGV[4])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('PUBLISH', ARGV[5], ARGV[2])
+"""
+
+    def __init__(self, url=None, buffer_size=BUFFER_SIZE, buffer_ttl=BUFFER_TTL):
+        import redis
+
+        self._redis = redis.Redis.from_url(url or settings.PUSH_REDIS_URL)
+        self._next_id = self._redis.register_script(self.NEXT_ID_SCRIPT)
+        self._publish = self._redis.register_script(self.PUBLISH_SCRIPT)
+        self._buffer_size = buffer_size
+        self._buffer_ttl = buffer_ttl
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._listener = None
+        self._listening = threading.Event()
+
+    def _key(self, kind, topic=''):
+        return f'{self.PREFIX}{kind}:{topic}'
+
+    def publish(self, topic, type, data):
+        event_id = self._next_id(keys=[self._key('ids')])
+        body = _renderer.render({'id': event_id, 'type': type, 'data': data})
+        event = Event(event_id, topic, type, body)
+        self._publish(
+            keys=[self._key('buffer', topic), self._key('evicted', topic)],
+            args=[event_id, b'%d %s %s' % (event_id, type.encode(), body), self._buffer_size, self._buffer_ttl,
+                  self._key('topic', topic)],
+        )
+        return event
+
+    def _decode(self, topic, encoded):
+        event_id, type, body = encoded.split(b' ', 2)
+        return Event(int(event_id), topic, type.decode(), body)
+
+    def subscribe(self, topics, after=None, loop=None):
+        """Register for ``topics``, replaying buffered events with id > ``after``.
+
+        The subscription is registered before the buffers are read, so an
+        event published meanwhile is replayed, delivered live, or both;
+        Subscription drops the live copy of a replayed event. This talks to
+        Redis, so call it off the event loop, passing the ``loop``.
+        """
+        self._listen()
+        with self._lock:
+            subscription = Subscription(self, topics, loop=loop)
+            for topic in topics:
+                self._subscribers[topic].add(subscription)
+        if after is None:
+            return subscription
+
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.time()
+        for topic in topics:
+            pipe.zrangebyscore(self._key('buffer', topic), f'({after}', '+inf')
+            pipe.get(self._key('evicted', topic))
+        now, *found = pipe.execute()
+        # Ids follow the clock, so an older one may predate a buffer that
+        # has since expired.
+        gap = after < (now[0] - self._buffer_ttl) * 1000000
+        backlog = []
+        for topic, encoded, evicted in zip(topics, found[::2], found[1::2]):
+            gap = gap or (evicted is not None and int(float(evicted)) > after)
+            backlog += [self._decode(topic, event) for event in encoded]
+        subscription.backlog.extend(sorted(backlog, key=lambda event: event.id))
+        subscription.replayed.update(event.id for event in backlog)
+        subscription.gap = gap
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def _listen(self):
+        """Start this worker's listener once and wait until it is subscribed."""
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._run_listener, name='push-redis', daemon=True)
+                self._listener.start()
+        self._listening.wait(timeout=5)
+
+    def _run_listener(self):
+        pattern = self._key('topic', '*')
+        reconnecting = False
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                pubsub.psubscribe(pattern)
+                while pubsub.get_message(timeout=5) is None:
+                    pass
+                if reconnecting:
+                    self._deliver_all(RESYNC)
+                self._listening.set()
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        topic = message['channel'][len(self._key('topic')):].decode()
+                        self._deliver(topic, self._decode(topic, message['data']))
+            except Exception:
+                logger.exception('Push listener lost its Redis connection; reconnecting')
+                time.sleep(1)
+            finally:
+                pubsub.close()
+            reconnecting = True
+
+    def _deliver(self, topic, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def _deliver_all(self, event):
+        with self._lock:
+            subscribers = {subscription for group in self._subscribers.values() for subscription in group}
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = getattr(settings, 'PUSH_BACKEND', 'api.events.InProcessBackend')
+                _backend = import_string(path)()
+    return _backend
+
+
+def publish(topics, type, data):
+    """Publish to each topic once the current transaction commits.
+
+    That is the transaction on the database selected with sharding.using()
+    or for_group(), where the group-scoped writes being announced go.
+    """
+    def send():
+        for topic in dict.fromkeys(topics):
+            backend().publish(topic, type, data)
+    transaction.on_commit(send, using=sharding.current_alias())
+
+
+def expense_created(expense, owe_ids):
+    if expense.group_id:
+        topics = [group_topic(expense.group_id)]
+    else:
+        topics = [user_topic(user_id) for user_id in [expense.paid_by_id] + owe_ids]
+    publish(topics, 'expense.created', {
+        'id': expense.id,
+        'description': expense.description,
+        'amount': decimal_str(expense.amount),
+        'group': expense.group_id,
+        'paid_by': expense.paid_by_id,
+        'owe_ids': owe_ids,
+    })
+
+
+def _expense_topics(expense, user_ids):
+    if expense.group_id:
+        return [group_topic(expense.group_id)]
+    return [user_topic(user_id) for user_id in [expense.paid_by_id] + user_ids]
+
+
+def expense_updated(expense, owe_ids, affected_ids):
+    """``affected_ids``: everyone whose share changed, including users dropped from the split."""
+    publish(_expense_topics(expense, affected_ids), 'expense.updated', {
+        'id': expense.id,
+        'description': expense.description,
+        'amount': decimal_str(expense.amount),
+        'group': expense.group_id,
+        'paid_by': expense.paid_by_id,
+        'owe_ids': owe_ids,
+        'affected_ids': affected_ids,
+    })
+
+
+def expense_deleted(expense, owe_ids):
+    publish(_expense_topics(expense, owe_ids), 'expense.deleted', {
+        'id': expense.id,
+        'group': expense.group_id,
+        'paid_by': expense.paid_by_id,
+        'owe_ids': owe_ids,
+        'deleted_at': iso_datetime(expense.deleted_at),
+    })
+
+
+def settlement_created(settlement):
+    if settlement.group_id:
+        topics = [group_topic(settlement.group_id)]
+    else:
+        topics = [user_topic(settlement.from_user_id), user_topic(settlement.to_user_id)]
+    publish(topics, 'settlement.created', {
+        'id': settlement.id,
+        'from_user': settlement.from_user_id,
+        'to_user': settlement.to_user_id,
+        'amount': decimal_str(settlement.amount),
+        'group': settlement.group_id,
+    })
+
+
+def request_created(request):
+    type = 'group.invite' if request.group_id else 'friend_request.created'
+    publish([user_topic(request.to_user_id)], type, {
+        'id': request.id,
+        'from_user': request.from_user_id,
+        'group': request.group_id,
+    })
@@ -0,0 +1,123 @@
+"""Editing and deleting expenses without recomputing balances.
+
+An edit compares the expense's current splits with the new ones and
+applies only the difference:
+
+- a changed share updates its split in place. The delta is taken
+  against the share the split was created with (``original_amount``) and
+  applied to what is still owed, which never goes below zero: money a
+  settle-up already paid stays paid. Checkpoints that had already folded
+  the split in move by the change in what is owed (checkpoints.adjust_split);
+- a dropped user's split is deleted and backed out of checkpoints the
+  same way;
+- a new user's split is a new row, read live past every watermark;
+- spend rollups get the net change in shares per user
+  (rollups.record_expense_change).
+
+Deleting is an edit to no splits that also sets ``deleted_at``. The row
+stays behind as a tombstone so a client can tell a deleted expense from
+one it may not see, and the expense.updated/expense.deleted events name
+every affected user so caches can be dropped precisely.
+
+The payer and group of an expense are fixed; delete and re-add to change
+them.
+"""
+from django.utils import timezone
+
+from . import checkpoints, events, rollups, sharding
+from .balances import MINOR_UNITS
+from .locks import ledger_lock, ledger_scopes
+from .models import Expense, ExpenseSplitBetween
+
+
+def find(expense_id):
+    """The expense with this id on whichever database holds it (tombstones included), or None."""
+    return sharding.find(lambda: Expense.objects.filter(pk=expense_id).first())
+
+
+def _original(split):
+    # A split written without its original share counts what is still owed.
+    return split.amount_owed if split.original_amount is None else split.original_amount
+
+
+def _apply(expense, splits, fields, owed, delete):
+    payer_id = expense.paid_by_id
+    before = {user_id: _original(split) for user_id, split in splits.items()}
+    after = {} if delete else before if owed is None else owed
+
+    changed, removed = [], []
+    for user_id, split in splits.items():
+        if user_id not in after:
+            removed.append((split, -split.amount_owed))
+        elif after[user_id] != before[user_id]:
+            # Only the change in share moves what is still owed; whatever
+            # settle-ups already paid stays paid, down to nothing owed.
+            outstanding = max(split.amount_owed + after[user_id] - before[user_id], 0)
+            changed.append((split, outstanding - split.amount_owed))
+            split.amount_owed = outstanding
+            split.original_amount = after[user_id]
+    created = [
+        ExpenseSplitBetween(expense=expense, owe_id_id=user_id, amount_owed=amount_owed, original_amount=amount_owed)
+        for user_id, amount_owed in after.items() if user_id not in splits
+    ]
+    ExpenseSplitBetween.objects.bulk_update([split for split, _ in changed], ['amount_owed', 'original_amount'])
+    ExpenseSplitBetween.objects.filter(id__in=[split.id for split, _ in removed]).delete()
+    ExpenseSplitBetween.objects.bulk_create(created)
+
+    for split, delta in changed + removed:
+        if delta:
+            checkpoints.adjust_split(split.id, expense.group_id, split.owe_id_id, payer_id, delta * MINOR_UNITS)
+    if created:
+        checkpoints.note_writes(expense.group_id, [(payer_id, split.owe_id_id) for split in created])
+
+    old_amount = expense.amount
+    for field, value in fields.items():
+        setattr(expense, field, value)
+    if delete:
+        expense.deleted_at = timezone.now()
+    expense.save(update_fields=list(fields) + (['deleted_at'] if delete else []))
+
+    rollups.record_expense_change(
+        expense.group_id, rollups.month_of(expense.created_at),
+        before=(payer_id, old_amount, before),
+        after=None if delete else (payer_id, expense.amount, after),
+    )
+    if delete:
+        events.expense_deleted(expense, sorted(before))
+    else:
+        affected = {split.owe_id_id for split, _ in changed + removed} | {split.owe_id_id for split in created}
+        events.expense_updated(expense, sorted(after), sorted(affected))
+    return expense
+
+
+def _edit(expense, fields=None, owed=None, delete=False):
+    with sharding.for_group(expense.group_id):
+        while True:
+            users = set(ExpenseSplitBetween.objects.filter(expense=expense).values_list('owe_id', flat=True))
+            users |= set(owed or ())
+            with ledger_lock(*ledger_scopes(expense.group_id, [(expense.paid_by_id, u) for u in users])):
+                current = Expense.objects.select_for_update().filter(pk=expense.pk, deleted_at__isnull=True).first()
+                if current is None:
+                    return None
+                splits = {
+                    split.owe_id_id: split
+                    for split in ExpenseSplitBetween.objects.select_for_update().filter(expense=current)
+                }
+                if splits.keys() <= users:
+                    return _apply(current, splits, fields or {}, owed, delete)
+            # A concurrent edit added someone to the split after the first
+            # read; go round again so their pair is locked too.
+
+
+def update_expense(expense, fields, owed=None):
+    """Change ``fields`` (description, amount) and, when ``owed`` is given, the shares.
+
+    ``owed`` maps user ids to units owed and replaces the current split.
+    Returns None if the expense was deleted meanwhile.
+    """
+    return _edit(expense, fields=fields, owed=owed)
+
+
+def delete_expense(expense):
+    """Soft-delete: remove the splits and leave a tombstone. None if already deleted."""
+    return _edit(expense, delete=True)
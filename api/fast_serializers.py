@@ -0,0 +1,200 @@
+"""Read-only fast paths for the large list endpoints.
+
+Each function takes the same queryset the matching DRF serializer would get,
+reads a ``values_list`` projection and builds plain dicts. With no sparse
+fieldset the output is identical to the serializer named in the docstring.
+
+``fields`` (from ``?fields=``) limits the keys returned, and only the columns
+and joins those keys need are selected. Nested objects listed in ``fields``
+are collapsed to their id unless also named in ``expand``.
+"""
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from operator import itemgetter
+
+from django.utils import timezone
+
+from .models import ExpenseSplitBetween, ArchivedExpenseSplit, ArchivedExpense
+
+
+CENTS = Decimal('0.01')
+GROUP_EXPENSE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def decimal_str(value):
+    # DecimalField(decimal_places=2) with COERCE_DECIMAL_TO_STRING.
+    if value is None:
+        return None
+    return '{:f}'.format(Decimal(value).quantize(CENTS, rounding=ROUND_HALF_UP))
+
+
+def iso_datetime(value):
+    # DateTimeField with the default ISO 8601 format.
+    if value is None:
+        return None
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def formatted_datetime(value, fmt=GROUP_EXPENSE_DATE_FORMAT):
+    if value is None:
+        return None
+    return timezone.localtime(value).strftime(fmt)
+
+
+def user_ref(user_id, username):
+    return {'id': user_id, 'username': username}
+
+
+def column(path, build=None):
+    return (path,), build
+
+
+def nested(collapsed, *paths, build):
+    """A nested object: ``paths`` when expanded, just ``collapsed`` (its id) otherwise."""
+    return paths, build, collapsed
+
+
+def selected(spec, fields):
+    if fields is None:
+        return list(spec)
+    return [name for name in spec if name in fields]
+
+
+def project(queryset, spec, fields=None, expand=()):
+    """Build one dict per row with the selected fields of ``spec``."""
+    paths = []
+    getters = []
+    for name in selected(spec, fields):
+        entry = spec[name]
+        field_paths, build = entry[:2]
+        if len(entry) == 3 and fields is not None and name not in expand:
+            field_paths, build = (entry[2],), None
+        start = len(paths)
+        paths.extend(field_paths)
+        if build is None:
+            getters.append((name, itemgetter(start), None))
+        elif len(field_paths) == 1:
+            getters.append((name, itemgetter(start), build))
+        else:
+            getters.append((name, itemgetter(*range(start, start + len(field_paths))), build))
+
+    rows = queryset.values_list(*paths)
+    result = []
+    for row in rows:
+        item = {}
+        for name, get, build in getters:
+            value = get(row)
+            if build is not None:
+                value = build(*value) if isinstance(value, tuple) else build(value)
+            item[name] = value
+        result.append(item)
+    return result
+
+
+OWED_EXPENSE_FIELDS = {
+    'id': column('id'),
+    'description': column('expense__description'),
+    'amount_owe': column('amount_owed'),
+    'total_amount': column('expense__amount', decimal_str),
+    'paid_by': column('expense__paid_by__username'),
+    'group': column('expense__group__name'),
+}
+
+SETTLEMENT_FIELDS = {
+    'id': column('id'),
+    'from_user': column('from_user'),
+    'to_user': column('to_user'),
+    'from_user_username': column('from_user__username'),
+    'to_user_username': column('to_user__username'),
+    'amount': column('amount', decimal_str),
+    'remark': column('remark'),
+    'settled_at': column('settled_at', iso_datetime),
+    'group': column('group'),
+}
+
+GROUP_EXPENSE_FIELDS = {
+    'id': column('id'),
+    'description': column('description'),
+    'amount': column('amount', decimal_str),
+    'group': column('group__name'),
+    'paid_by': nested('paid_by', 'paid_by', 'paid_by__username', build=user_ref),
+    'splits': None,
+    'created_at': column('created_at', formatted_datetime),
+}
+
+
+def owed_expenses(queryset, fields=None, expand=()):
+    """Same output as OwedExpenseSerializer(queryset, many=True).data."""
+    return project(queryset, OWED_EXPENSE_FIELDS, fields, expand)
+
+
+def owed_by_creditor(totals, rows):
+    """Outstanding debts grouped by who is owed, largest balance first.
+
+    ``totals`` are (creditor id, username, total, count) rows aggregated in
+    SQL (one per creditor and database; they are added up here), ``rows``
+    are (split id, expense id, description, amount owed, expense amount,
+    group name, created_at, creditor id) tuples, newest first.
+    """
+    creditors = {}
+    for user_id, username, total, count in totals:
+        entry = creditors.get(user_id)
+        if entry is None:
+            entry = creditors[user_id] = {
+                'user': user_ref(user_id, username), 'total': 0, 'count': 0, 'expenses': [],
+            }
+        entry['total'] += total
+        entry['count'] += count
+    for split_id, expense_id, description, amount_owed, amount, group, created_at, user_id in rows:
+        creditors[user_id]['expenses'].append({
+            'id': split_id,
+            'expense': expense_id,
+            'description': description,
+            'amount_owe': amount_owed,
+            'total_amount': decimal_str(amount),
+            'group': group,
+            'created_at': iso_datetime(created_at),
+        })
+    return sorted(creditors.values(), key=lambda entry: (-entry['total'], entry['user']['id']))
+
+
+def settlements(queryset, fields=None, expand=()):
+    """Same output as SettlementSerializer(queryset, many=True).data."""
+    return project(queryset, SETTLEMENT_FIELDS, fields, expand)
+
+
+def group_expenses(queryset, fields=None, expand=()):
+    """Same output as GroupExpenseSerializer(queryset, many=True).data.
+
+    Splits are fetched in one extra query, and only when requested; they
+    carry the ower's id alone unless ``splits`` is expanded.
+    """
+    names = selected(GROUP_EXPENSE_FIELDS, fields)
+    spec = {name: GROUP_EXPENSE_FIELDS[name] for name in names if name != 'splits'}
+    spec['_pk'] = column('id')
+    result = project(queryset, spec, fields=None if fields is None else set(spec), expand=expand)
+
+    if 'splits' in names:
+        split_model = ArchivedExpenseSplit if queryset.model is ArchivedExpense else ExpenseSplitBetween
+        split_rows = split_model.objects.filter(
+            expense_id__in=queryset.order_by().values('id')
+        ).order_by('id')
+        splits = defaultdict(list)
+        if fields is None or 'splits' in expand:
+            for expense_id, user_id, username, amount_owed in split_rows.values_list(
+                    'expense_id', 'owe_id', 'owe_id__username', 'amount_owed'):
+                splits[expense_id].append({'owe_id': user_ref(user_id, username), 'amount_owed': amount_owed})
+        else:
+            for expense_id, user_id, amount_owed in split_rows.values_list('expense_id', 'owe_id', 'amount_owed'):
+                splits[expense_id].append({'owe_id': user_id, 'amount_owed': amount_owed})
+
+    ordered = []
+    for item in result:
+        pk = item.pop('_pk')
+        if 'splits' in names:
+            item['splits'] = splits[pk]
+        ordered.append({name: item[name] for name in names})
+    return ordered
@@ -0,0 +1,80 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+
+HEADER = 'Idempotency-Key'
+KEY_TTL = timedelta(hours=getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24))
+
+
+def _fingerprint(request):
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {payload}'.encode()).hexdigest()
+
+
+def idempotent(method):
+    """Replay the stored response for retried writes that carry an Idempotency-Key.
+
+    The first request for a (user, key, route) claims a row and runs the view
+    while holding a row lock, in the same transaction as the view's writes;
+    a concurrent duplicate blocks on that lock and then replays the stored
+    response. Every returned response is stored, 5xx included: its writes
+    are committed (group writes on their shard's own transaction), so a
+    retry must not run them again. A view that raises stores nothing and
+    may be retried. Requests without the header are unaffected.
+    """
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({"error": f"{HEADER} must be at most 255 characters"}, status=400)
+
+        lookup = {'user': request.user, 'key': key, 'route': request.path}
+        fingerprint = _fingerprint(request)
+        now = timezone.now()
+        IdempotencyKey.objects.filter(expires_at__lte=now, **lookup).delete()
+        IdempotencyKey.objects.get_or_create(
+            defaults={'fingerprint': fingerprint, 'expires_at': now + KEY_TTL}, **lookup
+        )
+
+        with transaction.atomic():
+            record = IdempotencyKey.objects.select_for_update().get(**lookup)
+            if record.fingerprint != fingerprint:
+                return Response({"error": f"{HEADER} was already used with a different request"}, status=422)
+            if record.status_code is not None:
+                response = Response(record.response_body, status=record.status_code)
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            response = method(self, request, *args, **kwargs)
+            record.status_code = response.status_code
+            record.response_body = response.data
+            record.save(update_fields=['status_code', 'response_body'])
+            return response
+
+    return wrapper
+
+
+def purge_expired(batch_size=5000):
+    """Delete expired keys in batches; returns how many were removed."""
+    removed = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(
+            expires_at__lte=timezone.now()
+        ).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return removed
+        removed += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
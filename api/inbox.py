@@ -0,0 +1,53 @@
+"""Pending friend/group request counts for notification badges.
+
+Clients poll the badge every few seconds, so each user's count is cached
+(INBOX_COUNT_CACHE_SECONDS) and dropped whenever a request addressed to
+them is saved or deleted. As with membership, the count is only cached
+when the cache is shared by every worker.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from . import membership, metrics, sharding
+from .models import Request
+
+
+CACHE_KEY = 'inbox-count:{}'
+CACHE_SECONDS = getattr(settings, 'INBOX_COUNT_CACHE_SECONDS', 300)
+
+
+def pending_count(user_id):
+    def load():
+        return sum(sharding.fan_out(
+            lambda: Request.objects.filter(to_user_id=user_id, status='pending').count()
+        ))
+
+    if not membership.cache_is_shared():
+        return load()
+    key = CACHE_KEY.format(user_id)
+    count = cache.get(key)
+    metrics.cache_lookup('inbox-count', count is not None)
+    if count is None:
+        count = load()
+        cache.set(key, count, timeout=CACHE_SECONDS)
+    return count
+
+
+def invalidate(user_id, using=None):
+    """Drop the cached value; ``using`` is the database of the write that changed it."""
+    key = CACHE_KEY.format(user_id)
+    cache.delete(key)
+    # Again after commit, in case a concurrent read cached the old count
+    # while the write was still uncommitted.
+    transaction.on_commit(lambda: cache.delete(key), using=using)
+
+
+def _request_changed(sender, instance, using, **kwargs):
+    invalidate(instance.to_user_id, using)
+
+
+def connect_signals():
+    post_save.connect(_request_changed, sender=Request, dispatch_uid='inbox-save')
+    post_delete.connect(_request_changed, sender=Request, dispatch_uid='inbox-delete')
@@ -0,0 +1,255 @@
+"""Per-user rate limits and a concurrency cap on expensive routes.
+
+Every request is put in a route class: ``expensive`` for the views in
+LOAD_SHEDDING_EXPENSIVE_VIEWS (whole-ledger reads such as the overall
+balance), otherwise ``read`` or ``write`` by method. Each class has
+
+- a token bucket per user: ``burst`` requests at once, refilled at
+  ``rate`` per second; an empty bucket answers 429;
+- optionally a ``concurrency`` cap shared by all workers; a request that
+  finds every slot taken answers 503 at once instead of queueing behind
+  the others and tying up a worker.
+
+Both answers carry Retry-After. State lives in the cache named by
+LOAD_SHEDDING_CACHE, so with several workers that cache must be shared
+(see REDIS_URL in settings); the local-memory default limits each
+process on its own. Taking a token or a slot is atomic: on Redis a Lua
+script does it in one step (timed by the Redis clock for tokens), and the
+local cache is guarded by a lock. Other cache backends are read and
+written without a lock, like DRF's throttles, so racing requests can
+overshoot by a few. A slot counter never goes below zero, and every change
+restarts its INFLIGHT_TTL, so it lives as long as requests keep coming but
+slots leaked by a killed worker come back once the class goes quiet.
+
+Anonymous requests only meet the concurrency cap: behind the platform's
+proxy they all share one address.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from django.http import JsonResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import metrics
+from .db_routers import SAFE_METHODS
+
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'LOAD_SHEDDING_ENABLED', True)
+CACHE = getattr(settings, 'LOAD_SHEDDING_CACHE', 'default')
+EXPENSIVE_VIEWS = set(getattr(settings, 'LOAD_SHEDDING_EXPENSIVE_VIEWS', {'get_overall_balance', 'all_related_expenses'}))
+EXEMPT_VIEWS = set(getattr(settings, 'LOAD_SHEDDING_EXEMPT_VIEWS', {'metrics'}))
+# rate: tokens per second; burst: bucket size; concurrency: requests of the
+# class running at once across all workers (None for no cap).
+# LOAD_SHEDDING_LIMITS overrides these per class.
+DEFAULT_LIMITS = {
+    'expensive': {'rate': 1.0, 'burst': 10, 'concurrency': 8},
+    'write': {'rate': 5.0, 'burst': 30, 'concurrency': None},
+    'read': {'rate': 20.0, 'burst': 100, 'concurrency': None},
+}
+LIMITS = {
+    route: {**limits, **getattr(settings, 'LOAD_SHEDDING_LIMITS', {}).get(route, {})}
+    for route, limits in DEFAULT_LIMITS.items()
+}
+RETRY_AFTER = getattr(settings, 'LOAD_SHEDDING_RETRY_AFTER', 1)
+INFLIGHT_TTL = getattr(settings, 'LOAD_SHEDDING_INFLIGHT_TTL', 60)
+
+BUCKET_KEY = 'shed-bucket:{}:{}'
+INFLIGHT_KEY = 'shed-inflight:{}'
+
+_jwt = JWTAuthentication()
+
+# KEYS[1]: the bucket, a hash of tokens and stamp. ARGV: rate, burst, TTL.
+# Returns the wait as a string; Redis would truncate a Lua number.
+TOKEN_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(bucket[1]) or burst
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - stamp, 0) * rate)
+if tokens < 1 then
+    return tostring((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return '0'
+"""
+# KEYS[1]: a slot counter. ARGV: the change, TTL. Returns the new count.
+SLOT_SCRIPT = """
+local count = redis.call('INCRBY', KEYS[1], ARGV[1])
+if count < 0 then
+    count = 0
+    redis.call('SET', KEYS[1], 0)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return count
+"""
+_local_lock = threading.Lock()
+
+
+def route_class(view_name, method):
+    if view_name in EXPENSIVE_VIEWS:
+        return 'expensive'
+    return 'read' if method in SAFE_METHODS else 'write'
+
+
+def token_user_id(request):
+    """The user id in a valid bearer token, without loading the user; None otherwise."""
+    header = _jwt.get_header(request)
+    if header is None:
+        return None
+    try:
+        raw = _jwt.get_raw_token(header)
+        return raw and _jwt.get_validated_token(raw)[jwt_settings.USER_ID_CLAIM]
+    except (AuthenticationFailed, KeyError):
+        return None
+
+
+def _take_token(cache, user_id, route, rate, burst):
+    """0 if a token was taken, else the seconds until one is available."""
+    key = BUCKET_KEY.format(route, user_id)
+    # An untouched bucket is full again after burst / rate seconds.
+    timeout = math.ceil(burst / rate) + 1
+    if isinstance(cache, RedisCache):
+        client = cache._cache.get_client(write=True)
+        wait = client.register_script(TOKEN_SCRIPT)(
+            keys=[cache.make_and_validate_key(key)], args=[rate, burst, timeout],
+        )
+        return float(wait)
+    if isinstance(cache, LocMemCache):
+        with _local_lock:
+            return _take_local_token(cache, key, rate, burst, timeout)
+    return _take_local_token(cache, key, rate, burst, timeout)
+
+
+def _take_local_token(cache, key, rate, burst, timeout):
+    now = time.time()
+    tokens, stamp = cache.get(key) or (burst, now)
+    tokens = min(burst, tokens + (now - stamp) * rate)
+    if tokens < 1:
+        return (1 - tokens) / rate
+    cache.set(key, (tokens - 1, now), timeout=timeout)
+    return 0
+
+
+def _count_slots(cache, route, delta):
+    """Add ``delta`` to the in-flight count of ``route``; returns the new count."""
+    key = INFLIGHT_KEY.format(route)
+    if isinstance(cache, RedisCache):
+        client = cache._cache.get_client(write=True)
+        return int(client.register_script(SLOT_SCRIPT)(
+            keys=[cache.make_and_validate_key(key)], args=[delta, INFLIGHT_TTL],
+        ))
+    if isinstance(cache, LocMemCache):
+        with _local_lock:
+            return _count_local_slots(cache, key, delta)
+    return _count_local_slots(cache, key, delta)
+
+
+def _count_local_slots(cache, key, delta):
+    in_flight = max(cache.get(key, 0) + delta, 0)
+    cache.set(key, in_flight, timeout=INFLIGHT_TTL)
+    return in_flight
+
+
+def _take_slot(cache, route, limit):
+    if _count_slots(cache, route, 1) > limit:
+        _give_slot(cache, route)
+        return False
+    metrics.gauge_add('splitzy_load_shedding_in_flight', (('route_class', route),))
+    return True
+
+
+def _give_slot(cache, route):
+    _count_slots(cache, route, -1)
+
+
+def _rejected(route, reason, status, retry_after):
+    metrics.inc('splitzy_load_shed_total', (('route_class', route), ('reason', reason)))
+    response = JsonResponse({'detail': 'Too many requests, try again shortly.'}, status=status)
+    response['Retry-After'] = str(max(math.ceil(retry_after), 1))
+    return response
+
+
+def admit(user_id, route):
+    """None if a request of class ``route`` may run now, else the 429/503 response to send.
+
+    Every admitted request must be followed by release(route). Errors from
+    the cache let the request through.
+    """
+    limits = LIMITS[route]
+    cache = caches[CACHE]
+    try:
+        # The slot first, so a request turned away for want of one keeps its token.
+        if limits.get('concurrency') is not None and not _take_slot(cache, route, limits['concurrency']):
+            return _rejected(route, 'concurrency', 503, RETRY_AFTER)
+        if user_id is not None and limits.get('rate'):
+            wait = _take_token(cache, user_id, route, limits['rate'], limits['burst'])
+            if wait:
+                release(route)
+                return _rejected(route, 'rate', 429, wait)
+    except Exception:
+        logger.exception('Load shedding state unavailable; letting the request through')
+    return None
+
+
+def release(route):
+    if LIMITS[route].get('concurrency') is None:
+        return
+    metrics.gauge_add('splitzy_load_shedding_in_flight', (('route_class', route),), -1)
+    try:
+        _give_slot(caches[CACHE], route)
+    except Exception:
+        logger.exception('Could not release a %s slot', route)
+
+
+@contextmanager
+def limited(user_id, view_name, method):
+    """admit()/release() around a block; yields the rejection response or None."""
+    if not ENABLED or view_name in EXEMPT_VIEWS:
+        yield None
+        return
+    route = route_class(view_name, method)
+    rejection = admit(user_id, route)
+    try:
+        yield rejection
+    finally:
+        if rejection is None:
+            release(route)
+
+
+class LoadSheddingMiddleware:
+    """Applies the limits once the URL is resolved, before the view runs."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            route = getattr(request, '_load_shedding_route', None)
+            if route is not None:
+                release(route)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_name = request.resolver_match.view_name
+        if not ENABLED or view_name in EXEMPT_VIEWS:
+            return None
+        route = route_class(view_name, request.method)
+        rejection = admit(token_user_id(request), route)
+        if rejection is None:
+            request._load_shedding_route = route
+        return rejection
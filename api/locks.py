@@ -0,0 +1,86 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+
+from . import sharding
+
+
+# Stand-in for advisory locks on backends without them (SQLite locally):
+# a fixed set of striped in-process locks.
+LOCAL_STRIPES = 1024
+# Seconds to wait for a stripe before giving up. Kept below the SQLite busy
+# timeout so a caller that already holds the database's write lock gives up
+# before the stripe holder waiting on it does.
+LOCAL_LOCK_TIMEOUT = getattr(settings, 'LEDGER_LOCK_TIMEOUT', 10)
+_stripes = [threading.Lock() for _ in range(LOCAL_STRIPES)]
+
+
+class LedgerLockTimeout(OperationalError):
+    pass
+
+
+def group_scope(group_id):
+    return ('group', group_id)
+
+
+def pair_scope(user_a, user_b):
+    return ('pair',) + tuple(sorted((user_a, user_b)))
+
+
+def ledger_scopes(group_id=None, pairs=()):
+    scopes = [pair_scope(a, b) for a, b in pairs if a != b]
+    if group_id is not None:
+        scopes.append(group_scope(group_id))
+    return scopes
+
+
+def scope_key(scope):
+    """Stable signed 64-bit key for pg_advisory_xact_lock."""
+    digest = hashlib.blake2b(repr(scope).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+@contextmanager
+def ledger_lock(*scopes, using=None):
+    """Run the block in a transaction holding a lock for each scope.
+
+    The transaction and locks are on ``using``, by default the database
+    the current shard context points at.
+
+    On PostgreSQL these are transaction-level advisory locks, released at
+    commit. Elsewhere striped in-process locks are held until the block
+    exits, so take this lock outside any enclosing transaction there. Keys
+    are always acquired in sorted order so overlapping scopes cannot deadlock.
+
+    A caller inside a transaction (a view under @idempotent, say) can still
+    wait on a stripe whose holder waits on that transaction's write lock, so
+    a stripe wait gives up after LOCAL_LOCK_TIMEOUT seconds and raises
+    LedgerLockTimeout, rolling the caller back instead of hanging both.
+    """
+    using = using or sharding.current_alias()
+    keys = sorted({scope_key(scope) for scope in scopes})
+    connection = connections[using]
+
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                for key in keys:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [key])
+            yield
+        return
+
+    stripes = sorted({key % LOCAL_STRIPES for key in keys})
+    held = []
+    try:
+        for stripe in stripes:
+            if not _stripes[stripe].acquire(timeout=LOCAL_LOCK_TIMEOUT):
+                raise LedgerLockTimeout(f'timed out waiting for ledger lock stripe {stripe}')
+            held.append(stripe)
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        for stripe in reversed(held):
+            _stripes[stripe].release()
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from api import archive, sharding
+
+
+class Command(BaseCommand):
+    help = 'Move fully settled expenses older than the configured age into the archive tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=archive.ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--batch-size', type=int, default=archive.ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--limit', type=int, help='Stop after archiving this many expenses.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = sum(sharding.fan_out(lambda: archive.archivable_expenses(options['days']).count()))
+            self.stdout.write(f'{count} expenses would be archived')
+            return
+        count = 0
+        for alias in sharding.aliases():
+            limit = options['limit'] and options['limit'] - count
+            if limit is not None and limit <= 0:
+                break
+            with sharding.using(alias):
+                count += archive.archive_settled(
+                    days=options['days'], batch_size=options['batch_size'], limit=limit
+                )
+        self.stdout.write(self.style.SUCCESS(f'Archived {count} expenses'))
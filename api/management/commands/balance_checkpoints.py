@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import checkpoints, sharding
+from api.models import BalanceCheckpoint, Group
+
+
+class Command(BaseCommand):
+    help = 'Take balance checkpoints for groups and user pairs, or verify existing ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['take', 'verify'])
+        parser.add_argument('--group', type=int, action='append', help='Limit to these group ids.')
+        parser.add_argument('--pairs', action='store_true', help='Also (re)take every existing pair checkpoint.')
+        parser.add_argument(
+            '--due', action='store_true',
+            help='Only retake checkpoints with BALANCE_CHECKPOINT_EVERY writes or more since they were taken '
+                 '(normally done in the background after those writes).',
+        )
+
+    def handle(self, *args, **options):
+        if options['action'] == 'take':
+            self._take(options)
+        else:
+            self._verify(options)
+
+    def _take(self, options):
+        if options['due']:
+            taken = sum(checkpoints.retake_due(alias) for alias in sharding.aliases())
+            self.stdout.write(self.style.SUCCESS(f'Retook {taken} checkpoints'))
+            return
+        group_ids = options['group'] or Group.objects.values_list('id', flat=True)
+        taken = 0
+        for group_id in group_ids:
+            with sharding.for_group(group_id):
+                checkpoints.take_group_checkpoint(group_id)
+            taken += 1
+        if options['pairs']:
+            # Every database keeps its own pair checkpoints.
+            for alias in sharding.aliases():
+                with sharding.using(alias):
+                    for checkpoint in BalanceCheckpoint.objects.filter(group__isnull=True):
+                        checkpoints.retake(checkpoint)
+                        taken += 1
+        self.stdout.write(self.style.SUCCESS(f'Took {taken} checkpoints'))
+
+    def _verify(self, options):
+        failed = []
+        for alias in sharding.aliases():
+            with sharding.using(alias):
+                queryset = BalanceCheckpoint.objects.all()
+                if options['group']:
+                    queryset = queryset.filter(group_id__in=options['group'])
+                for checkpoint in queryset.iterator():
+                    if not checkpoints.verify(checkpoint):
+                        failed.append(checkpoint)
+                        scope = f'group {checkpoint.group_id}' if checkpoint.group_id else f'pair {checkpoint.user1_id}-{checkpoint.user2_id}'
+                        self.stderr.write(f'Checkpoint {checkpoint.id} ({scope}) does not match a full recompute')
+        if failed:
+            raise CommandError(f'{len(failed)} checkpoints are inconsistent')
+        self.stdout.write(self.style.SUCCESS('All checkpoints match a full recompute'))
@@ -0,0 +1,49 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api import db_pool
+
+
+class Command(BaseCommand):
+    help = 'Measure per-request database overhead with a fresh connection per request versus a persistent one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        count = options['requests']
+        connections[alias].close()
+
+        fresh = self._run(alias, count, reconnect=True)
+        persistent = self._run(alias, count, reconnect=False)
+
+        for label, timings in (('fresh connection', fresh), ('persistent', persistent)):
+            timings = sorted(timings)
+            self.stdout.write(
+                f"{label:>17}: mean {statistics.mean(timings) * 1000:.2f} ms, "
+                f"p50 {timings[len(timings) // 2] * 1000:.2f} ms, "
+                f"p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.2f} ms"
+            )
+        saved = statistics.mean(fresh) - statistics.mean(persistent)
+        self.stdout.write(self.style.SUCCESS(f"Connection overhead per request: {saved * 1000:.2f} ms"))
+        self.stdout.write(f"Pool stats: {db_pool.stats()[alias]}")
+
+    def _run(self, alias, count, reconnect):
+        connection = connections[alias]
+        timings = []
+        for _ in range(count):
+            start = time.perf_counter()
+            connection.ensure_connection()
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            if reconnect:
+                # What request_finished does when CONN_MAX_AGE is 0.
+                connection.close()
+            timings.append(time.perf_counter() - start)
+        return timings
@@ -0,0 +1,46 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.balances import reduce_balances, python_reduce_balances
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the NumPy group balance reduction against a pure-Python loop.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500)
+        parser.add_argument('--splits', type=int, default=1_000_000)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        members = np.arange(1, options['members'] + 1, dtype=np.int64)
+        debtors = rng.choice(members, options['splits'])
+        creditors = rng.choice(members, options['splits'])
+        amounts = rng.integers(1, 500_000, options['splits'], dtype=np.int64)
+
+        vector_time = self._best(options['repeat'], lambda: reduce_balances(debtors, creditors, amounts, members))
+        self.stdout.write(f"numpy:  {vector_time * 1000:.1f} ms")
+
+        lists = debtors.tolist(), creditors.tolist(), amounts.tolist()
+        python_time = self._best(1, lambda: python_reduce_balances(*lists))
+        self.stdout.write(f"python: {python_time * 1000:.1f} ms ({python_time / vector_time:.1f}x slower)")
+
+        balances = reduce_balances(debtors, creditors, amounts, members)
+        net, _ = python_reduce_balances(*lists)
+        expected = np.array([net.get(u, 0) for u in balances.users.tolist()], dtype=np.int64)
+        if not np.array_equal(expected, balances.net):
+            self.stderr.write('Net vectors differ between implementations')
+        else:
+            self.stdout.write(self.style.SUCCESS('Results match'))
+
+    def _best(self, repeat, func):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return best
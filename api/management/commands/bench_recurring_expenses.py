@@ -0,0 +1,68 @@
+import datetime
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from api import recurring, sharding
+from api.models import Expense, ExpenseSplitBetween, Group, Member, RecurringExpense, SpendRollup
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed daily recurring expenses that are each --days behind, time the scheduler catching up on '
+        'all of them, then time a re-run. Runs on the home database inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--groups', type=int, default=2000)
+        parser.add_argument('--members', type=int, default=5)
+        parser.add_argument('--templates', type=int, default=5, help='Recurring expenses per group.')
+        parser.add_argument('--days', type=int, default=10, help='Occurrences due per recurring expense.')
+        parser.add_argument('--batch-size', type=int, default=recurring.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        with sharding.using(sharding.HOME), transaction.atomic():
+            try:
+                self._bench(options)
+            finally:
+                transaction.set_rollback(True)
+
+    def _bench(self, options):
+        group_count, member_count = options['groups'], options['members']
+        today = timezone.localdate()
+        starts_on = today - datetime.timedelta(days=options['days'] - 1)
+
+        # bulk_create skips the signals that copy users and groups to shards.
+        groups = Group.objects.bulk_create([Group(name=f'bench-recurring-{i}') for i in range(group_count)])
+        users = User.objects.bulk_create([
+            User(username=f'bench-recurring-{groups[0].id}-{i}') for i in range(group_count * member_count)
+        ])
+        members = Member.objects.bulk_create([
+            Member(group=group, user=users[g * member_count + m], name=users[g * member_count + m].username)
+            for g, group in enumerate(groups) for m in range(member_count)
+        ])
+        RecurringExpense.objects.bulk_create([
+            RecurringExpense(
+                group=group, paid_by_id=members[g * member_count + t % member_count].user_id,
+                description=f'rent {t}', amount='1000.00', interval='daily',
+                split={'type': 'equal', 'members': [m.id for m in members[g * member_count:(g + 1) * member_count]]},
+                starts_on=starts_on, next_run=starts_on,
+            )
+            for g, group in enumerate(groups) for t in range(options['templates'])
+        ], batch_size=1000)
+
+        for label in ('first run', 're-run'):
+            start = time.perf_counter()
+            templates, created, _ = recurring.run(today, options['batch_size'])
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{label:>9}: {created:,} expenses from {templates:,} templates in {elapsed:.2f} s')
+
+        expected = group_count * options['templates'] * options['days']
+        expenses = Expense.objects.filter(recurring__isnull=False)
+        owed = ExpenseSplitBetween.objects.filter(expense__in=expenses).aggregate(total=Sum('amount_owed'))['total']
+        share = SpendRollup.objects.filter(group__in=groups).aggregate(total=Sum('share'))['total']
+        self.stdout.write(f'{expenses.count():,} expenses (expected {expected:,}); split total {owed}, rollup share {share}')
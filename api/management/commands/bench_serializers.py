@@ -0,0 +1,94 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api import fast_serializers
+from api.models import Group, Expense, ExpenseSplitBetween, Settlement
+from api.renderers import FastJSONRenderer
+from api.serializers import OwedExpenseSerializer, SettlementSerializer, GroupExpenseSerializer
+from rest_framework.renderers import JSONRenderer
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare serialization throughput of the DRF read serializers with the .values() fast paths. '
+        'Seeds rows inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000)
+        parser.add_argument('--members', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self._seed(options['rows'], options['members'])
+            try:
+                self._compare('owed expenses',
+                              lambda: OwedExpenseSerializer(self._owed(), many=True).data,
+                              lambda: fast_serializers.owed_expenses(self._owed()))
+                self._compare('settlements',
+                              lambda: SettlementSerializer(self._settlements(), many=True).data,
+                              lambda: fast_serializers.settlements(self._settlements()))
+                self._compare('group expenses',
+                              lambda: GroupExpenseSerializer(self._expenses(), many=True).data,
+                              lambda: fast_serializers.group_expenses(self._expenses()))
+                self._render(fast_serializers.group_expenses(self._expenses()))
+            finally:
+                transaction.set_rollback(True)
+
+    def _seed(self, rows, members):
+        self.group = Group.objects.create(name='bench-serializers')
+        users = [User.objects.create(username=f'bench-serializers-{self.group.id}-{i}') for i in range(members)]
+        expenses = Expense.objects.bulk_create([
+            Expense(group=self.group, description=f'expense {i}', amount=100 + i, paid_by=users[i % members])
+            for i in range(rows)
+        ])
+        ExpenseSplitBetween.objects.bulk_create([
+            ExpenseSplitBetween(expense=e, owe_id=u, amount_owed=20, original_amount=20)
+            for e in expenses for u in users if u != e.paid_by
+        ])
+        Settlement.objects.bulk_create([
+            Settlement(from_user=users[i % members], to_user=users[(i + 1) % members],
+                       amount=i + 0.5, group=self.group, remark='bench')
+            for i in range(rows)
+        ])
+        self.owed_user = users[0]
+
+    def _owed(self):
+        return ExpenseSplitBetween.objects.filter(expense__group=self.group).select_related(
+            'expense', 'expense__paid_by', 'expense__group')
+
+    def _settlements(self):
+        return Settlement.objects.filter(group=self.group).select_related(
+            'from_user', 'to_user').order_by('-settled_at', 'id')
+
+    def _expenses(self):
+        return Expense.objects.filter(group=self.group).select_related('paid_by', 'group').order_by('-created_at', 'id')
+
+    def _timed(self, func):
+        start = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - start
+
+    def _compare(self, label, slow, fast):
+        slow_data, slow_time = self._timed(slow)
+        fast_data, fast_time = self._timed(fast)
+        if [dict(row) for row in slow_data] != fast_data:
+            raise CommandError(f'{label}: fast path output differs from the serializer')
+        rows = len(fast_data)
+        self.stdout.write(
+            f'{label:>15}: serializer {rows / slow_time:,.0f} rows/s, '
+            f'fast path {rows / fast_time:,.0f} rows/s ({slow_time / fast_time:.1f}x)'
+        )
+
+    def _render(self, data):
+        stock, stock_time = self._timed(lambda: JSONRenderer().render(data))
+        fast, fast_time = self._timed(lambda: FastJSONRenderer().render(data))
+        if stock != fast:
+            raise CommandError('FastJSONRenderer output differs from JSONRenderer')
+        self.stdout.write(
+            f'{"rendering":>15}: JSONRenderer {stock_time * 1000:.1f} ms, '
+            f'FastJSONRenderer {fast_time * 1000:.1f} ms ({stock_time / fast_time:.1f}x)'
+        )
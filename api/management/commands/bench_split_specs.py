@@ -0,0 +1,90 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from api import splits
+from api.models import Group, Member
+from api.serializers import ExpenseSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Time expanding compact split specs for a large group, and compare validating a split spec '
+        'with validating and resolving the equivalent owe_list. Seeds rows inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        count, repeat = options['members'], options['repeat']
+        member_ids = list(range(1, count + 1))
+        amount = '123456.78'
+        specs = {
+            'equal': {'type': 'equal', 'members': member_ids},
+            'shares': {'type': 'shares', 'members': {str(m): m % 7 + 1 for m in member_ids}},
+            'percentage': {'type': 'percentage', 'members': self._percentages(member_ids)},
+            'exact': {'type': 'exact', 'members': self._exact(member_ids, splits.total_units(amount))},
+        }
+        for kind, spec in specs.items():
+            parts = splits.expand(spec, amount)
+            if sum(units for _, units in parts) != splits.total_units(amount):
+                raise CommandError(f'{kind}: parts do not add up to the total')
+            elapsed = self._best(lambda: splits.expand(spec, amount), repeat)
+            self.stdout.write(f'{kind:>11}: expand {count} members in {elapsed * 1000:.2f} ms')
+
+        with transaction.atomic():
+            try:
+                self._compare_validation(count, repeat)
+            finally:
+                transaction.set_rollback(True)
+
+    def _percentages(self, member_ids):
+        # Two decimal places, adding up to exactly 100.
+        cents = splits.largest_remainder(10000, [1] * len(member_ids))
+        return {str(m): f'{c / 100:.2f}' for m, c in zip(member_ids, cents)}
+
+    def _exact(self, member_ids, total):
+        parts = splits.largest_remainder(total, [m % 5 + 1 for m in member_ids])
+        return {str(m): units for m, units in zip(member_ids, parts)}
+
+    def _best(self, func, repeat):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    def _compare_validation(self, count, repeat):
+        group = Group.objects.create(name='bench-split-specs')
+        users = User.objects.bulk_create([
+            User(username=f'bench-split-{group.id}-{i}') for i in range(count)
+        ])
+        members = Member.objects.bulk_create([
+            Member(group=group, user=user, name=user.username) for user in users
+        ])
+        request = APIRequestFactory().post('/')
+        request.user = users[0]
+        owe_list = [{'username': user.username, 'amount_owed': '12'} for user in users[1:]]
+        payloads = {
+            'owe_list': {'description': 'bench', 'amount': '12000', 'group': group.name, 'owe_list': owe_list},
+            'split': {'description': 'bench', 'amount': '12000', 'group': group.name,
+                      'split': {'type': 'equal', 'members': [m.id for m in members]}},
+        }
+        for label, payload in payloads.items():
+            def validate():
+                serializer = ExpenseSerializer(data=payload, context={'request': request})
+                if not serializer.is_valid():
+                    raise CommandError(f'{label}: {serializer.errors}')
+                if 'owe_list' in serializer.validated_data:
+                    # Usernames are resolved at save time; count that too.
+                    serializer._resolve_owe_list(serializer.validated_data['owe_list'])
+            elapsed = self._best(validate, max(repeat // 10, 3))
+            size = len(json.dumps(payload, separators=(',', ':')))
+            self.stdout.write(f'{label:>11}: payload {size:,} bytes, validate {elapsed * 1000:.1f} ms')
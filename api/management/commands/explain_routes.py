@@ -0,0 +1,333 @@
+import json
+import re
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+from rest_framework.test import APIClient
+
+from api import sharding
+from api.models import Expense, ExpenseSplitBetween, Friend, Group, Member, Request, Settlement
+
+
+# Statements that are bookkeeping rather than the view's own queries.
+SKIPPED_SQL = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT|BEGIN|COMMIT)\b', re.I)
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+ROUTE_PARAMS = re.compile(r'<(?:\w+:)?(\w+)>')
+
+
+def normalize(sql):
+    """SQL with literals replaced by ?, so reports diff cleanly between runs."""
+    return LITERALS.sub('?', ' '.join(sql.split()))
+
+
+@contextmanager
+def rolled_back():
+    """A transaction on home and every shard, rolled back at the end."""
+    with ExitStack() as stack:
+        for alias in sharding.aliases():
+            stack.enter_context(transaction.atomic(using=alias))
+        try:
+            yield
+        finally:
+            for alias in sharding.aliases():
+                transaction.set_rollback(True, using=alias)
+
+
+def walk_routes(patterns, prefix=''):
+    for entry in patterns:
+        if isinstance(entry, URLResolver):
+            yield from walk_routes(entry.url_patterns, prefix + str(entry.pattern))
+        elif isinstance(entry, URLPattern):
+            yield prefix + str(entry.pattern), entry
+
+
+def allowed_methods(callback):
+    actions = getattr(callback, 'actions', None)
+    if actions:
+        return {method.upper() for method in actions}
+    view_class = getattr(callback, 'view_class', None) or getattr(callback, 'cls', None)
+    if view_class is None:
+        return {'GET'}
+    return {method.upper() for method in view_class.http_method_names if hasattr(view_class, method)}
+
+
+def postgres_findings(plan, threshold, lines, depth=0):
+    node = plan['Node Type']
+    label = node
+    if 'Relation Name' in plan:
+        label += f" on {plan['Relation Name']}"
+    if 'Index Name' in plan:
+        label += f" using {plan['Index Name']}"
+    lines.append('  ' * depth + label)
+
+    findings = []
+    loops = plan.get('Actual Loops', 1)
+    scanned = (plan.get('Actual Rows', plan.get('Plan Rows', 0)) + plan.get('Rows Removed by Filter', 0)) * loops
+    if node == 'Seq Scan' and scanned > threshold:
+        findings.append(f"sequential scan on {plan.get('Relation Name')} reads ~{scanned:.0f} rows")
+    children = plan.get('Plans', [])
+    if node == 'Nested Loop' and len(children) > 1:
+        inner = children[1]
+        inner_loops = inner.get('Actual Loops', children[0].get('Plan Rows', 1))
+        inner_rows = inner.get('Actual Rows', inner.get('Plan Rows', 0)) * inner_loops
+        if inner_loops > threshold or inner_rows > threshold:
+            findings.append(f"nested loop runs its inner side {inner_loops:.0f} times (~{inner_rows:.0f} rows)")
+    for child in children:
+        findings += postgres_findings(child, threshold, lines, depth + 1)
+    return findings
+
+
+class Command(BaseCommand):
+    help = (
+        'Request every route in api/urls.py as a representative user, capture each SQL statement, '
+        'EXPLAIN it (ANALYZE on PostgreSQL) and flag sequential scans and nested-loop blowups. '
+        'Seeds its own data inside a transaction that is rolled back unless --user is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Run as this existing user instead of seeding data.')
+        parser.add_argument('--users', type=int, default=40)
+        parser.add_argument('--expenses', type=int, default=3000)
+        parser.add_argument('--rows-threshold', type=int, default=1000,
+                            help='Flag scans and nested loops touching more rows than this.')
+        parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        self.threshold = options['rows_threshold']
+        with rolled_back():
+            if options['user']:
+                self.context = self._existing(options['user'])
+            else:
+                self.context = self._seed(options['users'], options['expenses'])
+            report = self._report()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        else:
+            self.stdout.write(report, ending='')
+
+    # Data
+
+    def _seed(self, users, expenses):
+        people = User.objects.bulk_create([User(username=f'explain-{i}') for i in range(users)])
+        user = people[0]
+        groups = Group.objects.bulk_create([Group(name=f'explain-group-{i}') for i in range(5)])
+        Member.objects.bulk_create([
+            Member(group=group, user=person, name=person.username)
+            for g, group in enumerate(groups) for p, person in enumerate(people) if p == 0 or p % 5 == g
+        ])
+        Friend.objects.bulk_create([Friend(user1=user, user2=person) for person in people[1:]])
+        created = Expense.objects.bulk_create([
+            Expense(group=groups[i % 5] if i % 3 else None, description=f'explain {i}',
+                    amount=100 + i % 50, paid_by=people[i % users])
+            for i in range(expenses)
+        ])
+        ExpenseSplitBetween.objects.bulk_create([
+            ExpenseSplitBetween(expense=expense, owe_id=people[(i + k) % users], amount_owed=10, original_amount=10)
+            for i, expense in enumerate(created) for k in (1, 2)
+        ])
+        Settlement.objects.bulk_create([
+            Settlement(from_user=people[i % users], to_user=people[(i + 1) % users], amount=5,
+                       group=groups[i % 5] if i % 2 else None)
+            for i in range(expenses // 2)
+        ])
+        Request.objects.bulk_create([
+            Request(from_user=person, to_user=user, group=groups[p % 5] if p % 2 else None)
+            for p, person in enumerate(people[1:], 1)
+        ])
+        connection = connections['default']
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        return self._context(user)
+
+    def _existing(self, username):
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            raise CommandError(f'No user named {username!r}')
+        return self._context(user)
+
+    def _context(self, user):
+        group = Group.objects.filter(member__user=user).first()
+        friend = Friend.objects.filter(user1=user).first() or Friend.objects.filter(user2=user).first()
+        friend_id = None
+        if friend:
+            friend_id = friend.user2_id if friend.user1_id == user.id else friend.user1_id
+        invite = Request.objects.filter(to_user=user).first()
+        return {
+            'user': user,
+            'group': group,
+            'params': {
+                'user_id': user.id,
+                'group_id': group.id if group else None,
+                'friend_id': friend_id,
+                'pk': invite.id if invite else None,
+            },
+        }
+
+    def _write_payloads(self):
+        params = self.context['params']
+        group = self.context['group']
+        friend = User.objects.filter(id=params['friend_id']).first()
+        if friend is None:
+            return {}
+        return {
+            'add-expense': {
+                'description': 'explain', 'amount': '30.00', 'group': group.name if group else None,
+                'owe_list': [{'username': friend.username, 'amount_owed': '10'}],
+            },
+            'settle-up': {'to_user_id': friend.id, 'amount': '1'},
+            'friend-request-accept': {},
+            'friend-request-reject': {},
+            'group-settle-up': {
+                'from_user': params['user_id'], 'group': params['group_id'],
+                'settlements': [{'to_user': friend.id, 'amount': '1'}],
+            },
+        }
+
+    # Routes
+
+    def _requests(self):
+        """(label, method, path, body) for every route we know how to call."""
+        payloads = self._write_payloads()
+        params = self.context['params']
+        seen = set()
+        for route, pattern in walk_routes(get_resolver('api.urls').url_patterns):
+            names = ROUTE_PARAMS.findall(route) or list(pattern.pattern.regex.groupindex)
+            if 'format' in names:
+                continue
+            kwargs = {name: params.get(name) for name in names}
+            if None in kwargs.values():
+                yield route, None, None, 'no sample value for a URL parameter'
+                continue
+            if pattern.name:
+                path = reverse(pattern.name, kwargs=kwargs)
+            else:
+                path = '/api/' + ROUTE_PARAMS.sub(lambda m: str(kwargs[m.group(1)]), route)
+            if path in seen:
+                continue
+            seen.add(path)
+
+            methods = allowed_methods(pattern.callback)
+            name = pattern.name or ('group-settle-up' if route.endswith('/settleup/') else route)
+            if 'GET' in methods:
+                yield path, 'GET', path, None
+            for method in sorted(methods & {'POST', 'PUT', 'PATCH'}):
+                if method == 'POST' and name in payloads:
+                    yield f'POST {path}', 'POST', path, payloads[name]
+                else:
+                    yield f'{method} {path}', None, None, 'no sample request body'
+
+    def _report(self):
+        client = APIClient(SERVER_NAME='localhost')
+        client.force_authenticate(self.context['user'])
+        lines = [
+            f'# explain_routes ({connections["default"].vendor}, rows threshold {self.threshold})',
+            '',
+        ]
+        totals = Counter()
+        for label, method, path, body in sorted(self._requests(), key=lambda item: item[0]):
+            if method is None:
+                lines += [f'## {label}', f'skipped: {body}', '']
+                totals['skipped'] += 1
+                continue
+
+            captures = {alias: CaptureQueriesContext(connections[alias]) for alias in connections}
+            for capture in captures.values():
+                capture.__enter__()
+            try:
+                with rolled_back():
+                    response = client.generic(method, path, json.dumps(body) if body else '',
+                                              content_type='application/json')
+            finally:
+                for capture in captures.values():
+                    capture.__exit__(None, None, None)
+
+            statements = [
+                (alias, query['sql']) for alias, capture in captures.items()
+                for query in capture.captured_queries if not SKIPPED_SQL.match(query['sql'])
+            ]
+            lines.append(f'## {label}')
+            lines.append(f'status {response.status_code}, {len(statements)} queries')
+            repeats = Counter(normalize(sql) for _, sql in statements)
+            explained = set()
+            for alias, sql in statements:
+                key = normalize(sql)
+                if key in explained:
+                    continue
+                explained.add(key)
+                count = f' (x{repeats[key]})' if repeats[key] > 1 else ''
+                lines.append(f'- {key}{count}')
+                plan, findings = self._explain(alias, sql)
+                lines += [f'    {line}' for line in plan]
+                for finding in findings:
+                    lines.append(f'    !! {finding}')
+                    totals['flagged'] += 1
+                if repeats[key] > 1:
+                    totals['repeated'] += 1
+            totals['routes'] += 1
+            totals['queries'] += len(statements)
+            lines.append('')
+
+        lines.append(
+            f"# {totals['routes']} routes, {totals['queries']} queries, {totals['flagged']} flagged plans, "
+            f"{totals['repeated']} repeated statements, {totals['skipped']} skipped"
+        )
+        return '\n'.join(lines) + '\n'
+
+    # Plans
+
+    def _explain(self, alias, sql):
+        connection = connections[alias]
+        is_select = sql.lstrip().upper().startswith(('SELECT', 'WITH'))
+        try:
+            with transaction.atomic(using=alias), connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    # ANALYZE executes the statement, so only for reads.
+                    options = 'ANALYZE, FORMAT JSON' if is_select else 'FORMAT JSON'
+                    cursor.execute(f'EXPLAIN ({options}) {sql}')
+                    plan = cursor.fetchone()[0][0]['Plan']
+                    lines = []
+                    return lines, postgres_findings(plan, self.threshold, lines)
+                if connection.vendor == 'sqlite':
+                    cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                    return self._sqlite_findings(cursor, cursor.fetchall())
+                cursor.execute(f'EXPLAIN {sql}')
+                return [' '.join(str(col) for col in row) for row in cursor.fetchall()], []
+        except Exception as exc:
+            return [f'EXPLAIN failed: {exc}'], []
+
+    def _sqlite_findings(self, cursor, rows):
+        lines, findings = [], []
+        depth = {0: -1}
+        loops_at = Counter()
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, -1) + 1
+            lines.append('  ' * depth[node_id] + detail)
+            position = loops_at[parent]
+            if detail.startswith(('SCAN', 'SEARCH')):
+                loops_at[parent] += 1
+            if not detail.startswith('SCAN '):
+                continue
+            table = detail.split()[1]
+            if table.upper() in ('SUBQUERY', 'CONSTANT'):
+                continue
+            try:
+                cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+            except Exception:
+                continue
+            size = cursor.fetchone()[0]
+            if size <= self.threshold:
+                continue
+            if position:
+                findings.append(f'nested loop runs a full scan of {table} ({size} rows) per outer row')
+            else:
+                findings.append(f'full scan of {table} ({size} rows)')
+        return lines, findings
@@ -0,0 +1,129 @@
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from api import checkpoints, sharding
+from api.locks import group_scope, ledger_lock
+from api.models import BalanceCheckpoint, Group
+
+
+# Group-scoped models with the lookup from each to its group, parents
+# before children: copied in this order, deleted from home in reverse.
+MOVED = [
+    ('api.member', 'group_id'),
+    ('api.recurringexpense', 'group_id'),
+    ('api.expense', 'group_id'),
+    ('api.expense_split_between', 'expense__group_id'),
+    ('api.expensesplitbetween', 'expense__group_id'),
+    ('api.settlement', 'group_id'),
+    ('api.request', 'group_id'),
+    ('api.spendrollup', 'group_id'),
+    ('api.balancecheckpoint', 'group_id'),
+    ('api.balancecheckpointentry', 'checkpoint__group_id'),
+    ('api.archivedexpense', 'group_id'),
+    ('api.archivedexpense_split_between', 'archivedexpense__group_id'),
+    ('api.archivedexpensesplit', 'expense__group_id'),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Prepare the GROUP_SHARDS databases: give each shard its own id range for '
+        'group-scoped tables, copy users and groups from the home database, and move '
+        'rows that belong to a group (members, expenses, splits, settlements, ...) from '
+        'the home database to their shard. Safe to re-run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('GROUP_SHARDS is empty; nothing to initialise.')
+
+        for index, alias in enumerate(sharding.SHARDS):
+            start = (index + 1) * sharding.SHARD_ID_SPAN
+            with transaction.atomic(using=alias):
+                for label in sorted(sharding.ID_RANGE_TABLES):
+                    self._start_ids_at(alias, apps.get_model(label)._meta.db_table, start)
+            self.stdout.write(f'{alias}: ids start at {start}')
+
+        batch_size = options['batch_size']
+        users = groups = 0
+        for user in User.objects.using(sharding.HOME).iterator(chunk_size=batch_size):
+            sharding.copy_to_shards(user, sharding.SHARDS)
+            users += 1
+        for group in Group.objects.using(sharding.HOME).iterator(chunk_size=batch_size):
+            sharding.copy_to_shards(group, [sharding.shard_for_group(group.id)])
+            groups += 1
+        self.stdout.write(self.style.SUCCESS(f'Copied {users} users and {groups} groups to {len(sharding.SHARDS)} shards'))
+
+        # Group rows written before the shards were configured are still on
+        # home, where nothing reads them once GROUP_SHARDS is set.
+        if {label for label, _ in MOVED} != sharding.ID_RANGE_TABLES:
+            raise CommandError('MOVED does not list every group-scoped model')
+        pairs = set()
+        group_ids = self._home_group_ids()
+        for group_id in group_ids:
+            pairs |= self._move_group(group_id, batch_size)
+        # Pair checkpoints count group splits and settlements by id, so those
+        # of users whose rows moved no longer add up on either side.
+        retaken = 0
+        for alias in sharding.aliases():
+            with sharding.using(alias):
+                for checkpoint in BalanceCheckpoint.objects.filter(group__isnull=True):
+                    if (checkpoint.user1_id, checkpoint.user2_id) in pairs:
+                        checkpoints.retake(checkpoint)
+                        retaken += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved the rows of {len(group_ids)} groups to their shards; retook {retaken} pair checkpoints'
+        ))
+
+    def _home_group_ids(self):
+        group_ids = set()
+        for label, lookup in MOVED:
+            rows = apps.get_model(label).objects.using(sharding.HOME).filter(**{f'{lookup}__isnull': False})
+            group_ids |= set(rows.values_list(lookup, flat=True).distinct())
+        return sorted(group_ids)
+
+    def _move_group(self, group_id, batch_size):
+        """Copy one group's rows to its shard and delete them from home; returns the user pairs touched."""
+        alias = sharding.shard_for_group(group_id)
+        with sharding.using(alias), ledger_lock(group_scope(group_id)):
+            with transaction.atomic(using=alias), transaction.atomic(using=sharding.HOME):
+                home = {label: apps.get_model(label).objects.using(sharding.HOME).filter(**{lookup: group_id})
+                        for label, lookup in MOVED}
+                rows = list(home['api.expensesplitbetween'].values_list('owe_id', 'expense__paid_by'))
+                rows += home['api.settlement'].values_list('from_user', 'to_user')
+                pairs = {(min(a, b), max(a, b)) for a, b in rows if a != b}
+                for label, _ in MOVED:
+                    model = apps.get_model(label)
+                    # Ids are kept: home ids lie below every shard's range.
+                    model.objects.using(alias).bulk_create(
+                        home[label].order_by('pk').iterator(chunk_size=batch_size),
+                        batch_size=batch_size, ignore_conflicts=True,
+                    )
+                for label, _ in reversed(MOVED):
+                    home[label].delete()
+        return pairs
+
+    def _start_ids_at(self, alias, table, start):
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Never move a sequence backwards on a re-run.
+                cursor.execute(
+                    f'SELECT setval(pg_get_serial_sequence(%s, \'id\'), '
+                    f'GREATEST(%s, (SELECT COALESCE(MAX(id), 0) + 1 FROM {connection.ops.quote_name(table)})), false)',
+                    [table, start],
+                )
+            elif connection.vendor == 'sqlite':
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start - 1])
+                elif row[0] < start - 1:
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start - 1, table])
+            else:
+                raise CommandError(f'Cannot set id ranges on {connection.vendor}')
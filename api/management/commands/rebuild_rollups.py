@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api import rollups, sharding
+
+
+class Command(BaseCommand):
+    help = 'Recompute the monthly spend rollups from expenses, splits and settlements.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='Only rebuild rollups for this group id.')
+
+    def handle(self, *args, **options):
+        if options['group']:
+            with sharding.for_group(options['group']):
+                count = rollups.rebuild(group_id=options['group'])
+        else:
+            count = sum(sharding.fan_out(rollups.rebuild))
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} rollup rows'))
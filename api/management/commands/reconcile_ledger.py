@@ -0,0 +1,111 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import processes, reconcile
+
+
+def _check(alias, kind, lo, hi):
+    started = time.process_time()
+    return reconcile.check_slice(alias, kind, lo, hi), time.process_time() - started
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute balance checkpoints and spend rollups from expenses, splits and settlements, '
+        'slice by slice in a pool of processes, and report (or --repair) whatever disagrees.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes.')
+        parser.add_argument(
+            '--partitions', type=int, help='Slices per kind and database (default: four per worker).'
+        )
+        parser.add_argument('--repair', action='store_true', help='Retake checkpoints and rewrite rollup rows that differ.')
+        parser.add_argument(
+            '--state', help=(
+                'Progress file. A run that stops early resumes from it when started again with the same file; '
+                'it is removed once every slice is done.'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        partitions = options['partitions'] or workers * 4
+        path = options['state']
+        state = self._load(path)
+        if state is None:
+            state = {'repair': options['repair'], 'slices': reconcile.slices(partitions), 'done': [], 'mismatches': []}
+        elif state['repair'] != options['repair']:
+            raise CommandError(f'{path} was started {"with" if state["repair"] else "without"} --repair')
+        else:
+            self.stdout.write(f'Resuming: {len(state["done"])} of {len(state["slices"])} slices already done')
+
+        started = time.perf_counter()
+        done = set(state['done'])
+        pending = [index for index in range(len(state['slices'])) if index not in done]
+        busy = 0.0
+        for index, found, seconds in self._run(pending, state['slices'], workers):
+            busy += seconds
+            found = reconcile.confirm_all(state['slices'][index][0], found, options['repair'])
+            state['done'].append(index)
+            state['mismatches'] += [reconcile.describe(mismatch) for mismatch in found]
+            self._save(path, state)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{len(state["done"])}/{len(state["slices"])} slices, {len(found)} mismatches')
+        if path and os.path.exists(path):
+            os.remove(path)
+
+        mismatches = state['mismatches']
+        for line in mismatches[:50]:
+            self.stderr.write(line)
+        if len(mismatches) > 50:
+            self.stderr.write(f'... and {len(mismatches) - 50} more')
+        elapsed = time.perf_counter() - started
+        # Worker CPU time over wall time: the cores kept busy on average,
+        # near --workers when the run scales. Time the database spends
+        # serving a server-side engine is not counted.
+        summary = (
+            f'Checked {len(pending)} slices with {workers} workers in {elapsed:.2f}s '
+            f'({busy:.2f}s of worker CPU, {busy / elapsed if elapsed else 0:.1f} cores busy)'
+        )
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS(f'{summary}; everything matches'))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f'{summary}; repaired {len(mismatches)} mismatches'))
+        else:
+            raise CommandError(f'{summary}; {len(mismatches)} mismatches')
+
+    def _run(self, pending, slices, workers):
+        """Yield (slice index, unconfirmed mismatches, seconds) as slices finish."""
+        if workers == 1 or len(pending) <= 1:
+            for index in pending:
+                yield index, *_check(*slices[index])
+            return
+        # Fresh interpreters rather than forks, so no database connection
+        # or lock is shared with this process.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=processes.init_worker, initargs=(processes.database_names(),),
+        ) as pool:
+            futures = {pool.submit(_check, *slices[index]): index for index in pending}
+            for future in as_completed(futures):
+                yield futures[future], *future.result()
+
+    def _load(self, path):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _save(self, path, state):
+        if not path:
+            return
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(f'{path}.tmp', path)
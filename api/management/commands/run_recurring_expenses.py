@@ -0,0 +1,27 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from api import recurring, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        'Create the expenses for every recurring expense due by today (or --until). '
+        'Safe to re-run and to run from cron as often as you like.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--until', type=datetime.date.fromisoformat, help='Materialize occurrences due by this date (YYYY-MM-DD).'
+        )
+        parser.add_argument('--batch-size', type=int, default=recurring.BATCH_SIZE, help='Templates per transaction.')
+
+    def handle(self, *args, **options):
+        results = sharding.fan_out(lambda: recurring.run(options['until'], options['batch_size']))
+        templates, created, stopped = (sum(column) for column in zip(*results))
+        self.stdout.write(self.style.SUCCESS(f'Created {created} expenses from {templates} recurring expenses'))
+        if stopped:
+            self.stdout.write(self.style.WARNING(
+                f'Stopped {stopped} recurring expenses whose split names members who left their group'
+            ))
@@ -0,0 +1,83 @@
+"""Who belongs to which group, cached per user.
+
+Group-scoped views check membership on every request, so each user's set
+of group ids is cached (MEMBERSHIP_CACHE_SECONDS) and dropped whenever one
+of their Member rows is saved or deleted. A warm check costs one cache
+get and no queries.
+
+Only a cache every worker shares is used: a per-process one (LocMem, the
+default without REDIS_URL) would never see another worker's invalidation
+and keep answering from the old set, so there each check reads the database.
+"""
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from rest_framework.permissions import BasePermission
+
+from . import metrics, sharding
+from .models import Member
+
+
+CACHE_KEY = 'group-ids:{}'
+CACHE_SECONDS = getattr(settings, 'MEMBERSHIP_CACHE_SECONDS', 300)
+
+
+def cache_is_shared():
+    """Whether invalidations made by one worker reach the others' reads."""
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+def group_ids(user_id):
+    """The ids of every group ``user_id`` is a member of."""
+    def load():
+        return frozenset(sharding.gather(
+            lambda: list(Member.objects.filter(user_id=user_id).values_list('group_id', flat=True))
+        ))
+
+    if not cache_is_shared():
+        return load()
+    key = CACHE_KEY.format(user_id)
+    ids = cache.get(key)
+    metrics.cache_lookup('membership', ids is not None)
+    if ids is None:
+        ids = load()
+        cache.set(key, ids, timeout=CACHE_SECONDS)
+    return ids
+
+
+def is_member(user_id, group_id):
+    return int(group_id) in group_ids(user_id)
+
+
+def invalidate(user_id, using=None):
+    """Drop the cached value; ``using`` is the database of the write that changed it."""
+    key = CACHE_KEY.format(user_id)
+    cache.delete(key)
+    # Again after commit, in case a concurrent read cached the old set
+    # while the write was still uncommitted.
+    transaction.on_commit(lambda: cache.delete(key), using=using)
+
+
+def _member_changed(sender, instance, using, **kwargs):
+    if instance.user_id is not None:
+        invalidate(instance.user_id, using)
+
+
+def connect_signals():
+    post_save.connect(_member_changed, sender=Member, dispatch_uid='membership-save')
+    post_delete.connect(_member_changed, sender=Member, dispatch_uid='membership-delete')
+
+
+class IsGroupMember(BasePermission):
+    """Allow requests whose ``group_id`` URL kwarg names one of the caller's groups."""
+
+    message = 'You are not a member of this group.'
+
+    def has_permission(self, request, view):
+        group_id = view.kwargs.get('group_id')
+        if group_id is None:
+            return True
+        user = request.user
+        return bool(user and user.is_authenticated and is_member(user.id, group_id))
@@ -0,0 +1,374 @@
+"""Process metrics in the Prometheus text exposition format.
+
+Every thread records into its own shard (plain dicts only that thread
+writes), so the hot path takes no locks; a scrape sums the shards. When a
+thread exits its shard is folded into one for retired threads, so threads
+started per request or per task do not pile up shards.
+
+With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to a directory
+shared by the workers. Each worker then writes its totals there every
+METRICS_FLUSH_SECONDS, and a scrape served by any worker adds up all of
+them. gunicorn's child_exit hook folds an exited worker's counters into
+an archive file so they survive restarts without growing the directory.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from . import db_pool
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+HISTOGRAMS = {
+    'splitzy_http_request_duration_seconds': ('Request latency by URL name.', LATENCY_BUCKETS),
+    'splitzy_db_queries_per_request': ('Database queries run while serving a request.', QUERY_COUNT_BUCKETS),
+    'splitzy_db_time_per_request_seconds': ('Time spent in database queries per request.', LATENCY_BUCKETS),
+}
+COUNTERS = {
+    'splitzy_http_requests_total': 'Requests served, by URL name, method and status.',
+    'splitzy_cache_requests_total': 'Cache lookups by cache and result.',
+    'splitzy_db_connections_opened_total': 'Database connections opened.',
+    'splitzy_db_connect_seconds_total': 'Time spent opening database connections.',
+    'splitzy_db_checkouts_total': 'Database connection checkouts: the first query of a request, or a reconnect.',
+    'splitzy_db_checkout_seconds_total': 'Time spent waiting for a usable database connection at checkout.',
+    'splitzy_db_health_check_failures_total': 'Persistent connections dropped by a failed health check.',
+    'splitzy_load_shed_total': 'Requests turned away by load shedding, by route class and reason.',
+}
+GAUGES = {
+    'splitzy_http_requests_in_flight': 'Requests currently being served.',
+    'splitzy_cache_hit_ratio': 'Cache hits over lookups since start.',
+    'splitzy_load_shedding_in_flight': 'Requests holding a concurrency slot, by route class.',
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Shard:
+    __slots__ = ('counters', 'histograms', 'gauges')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+
+class _ThreadAlive:
+    # Kept only in the thread-local, so it is freed when its thread exits.
+    __slots__ = ('__weakref__',)
+
+
+_registry_lock = threading.Lock()
+_shards = []
+_retired = _Shard()
+_local = threading.local()
+_started_pid = None
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = _Shard()
+        _local.alive = _ThreadAlive()
+        with _registry_lock:
+            _shards.append(shard)
+        weakref.finalize(_local.alive, _retire, shard)
+        return shard
+
+
+def _retire(shard):
+    """Fold an exited thread's shard into _retired."""
+    with _registry_lock:
+        if shard not in _shards:
+            return  # recorded before a fork; start_process dropped it
+        _shards.remove(shard)
+        for kind in ('counters', 'gauges'):
+            totals = getattr(_retired, kind)
+            for key, value in getattr(shard, kind).items():
+                totals[key] = totals.get(key, 0) + value
+        for key, entry in shard.histograms.items():
+            total = _retired.histograms.get(key)
+            _retired.histograms[key] = list(entry) if total is None else [a + b for a, b in zip(total, entry)]
+
+
+def inc(name, labels=(), value=1):
+    counters = _shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def gauge_add(name, labels=(), value=1):
+    gauges = _shard().gauges
+    key = (name, labels)
+    gauges[key] = gauges.get(key, 0) + value
+
+
+def observe(name, labels, value):
+    buckets = HISTOGRAMS[name][1]
+    histograms = _shard().histograms
+    key = (name, labels)
+    entry = histograms.get(key)
+    if entry is None:
+        # One slot per bucket plus +Inf, then the running sum.
+        entry = histograms[key] = [0] * (len(buckets) + 2)
+    entry[bisect_left(buckets, value)] += 1
+    entry[-1] += value
+
+
+def cache_lookup(cache_name, hit):
+    inc('splitzy_cache_requests_total', (('cache', cache_name), ('result', 'hit' if hit else 'miss')))
+
+
+def _process_counters():
+    counters = {}
+    for alias, stats in db_pool.stats().items():
+        labels = (('alias', alias),)
+        counters['splitzy_db_connections_opened_total', labels] = stats['connects']
+        counters['splitzy_db_connect_seconds_total', labels] = stats['connect_seconds']
+        counters['splitzy_db_checkouts_total', labels] = stats['checkouts']
+        counters['splitzy_db_checkout_seconds_total', labels] = stats['checkout_seconds']
+        counters['splitzy_db_health_check_failures_total', labels] = stats['health_check_failures']
+    return counters
+
+
+def snapshot():
+    """Totals for this process, summed over every thread's shard."""
+    with _registry_lock:
+        shards = [*_shards, _retired]
+    counters, histograms, gauges = _process_counters(), {}, {}
+    for shard in shards:
+        # dict() and list() copies are atomic under the GIL, so a shard can
+        # be read while its owner keeps writing.
+        for key, value in dict(shard.counters).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, value in dict(shard.gauges).items():
+            gauges[key] = gauges.get(key, 0) + value
+        for key, entry in dict(shard.histograms).items():
+            entry = list(entry)
+            total = histograms.get(key)
+            histograms[key] = entry if total is None else [a + b for a, b in zip(total, entry)]
+    return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+
+def merge(*snapshots):
+    merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+    for snap in snapshots:
+        for kind in ('counters', 'gauges'):
+            for key, value in snap[kind].items():
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for key, entry in snap['histograms'].items():
+            total = merged['histograms'].get(key)
+            merged['histograms'][key] = list(entry) if total is None else [a + b for a, b in zip(total, entry)]
+    return merged
+
+
+# Shared-directory mode
+
+def _directory():
+    return getattr(settings, 'METRICS_MULTIPROC_DIR', None)
+
+
+def _dump(snap):
+    return json.dumps({
+        kind: [[name, [list(pair) for pair in labels], value] for (name, labels), value in snap[kind].items()]
+        for kind in ('counters', 'histograms', 'gauges')
+    })
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {'counters': {}, 'histograms': {}, 'gauges': {}}
+    return {
+        kind: {(name, tuple(tuple(pair) for pair in labels)): value for name, labels, value in data.get(kind, ())}
+        for kind in ('counters', 'histograms', 'gauges')
+    }
+
+
+def _write(path, snap):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(_dump(snap))
+    os.replace(tmp, path)
+
+
+class _DirectoryLock:
+    def __init__(self, directory, exclusive):
+        self.path = os.path.join(directory, 'archive.lock')
+        self.mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, self.mode)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def flush():
+    directory = _directory()
+    if directory:
+        _write(os.path.join(directory, f'{os.getpid()}.json'), snapshot())
+
+
+def _flush_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def start_process():
+    """Start recording in this process; after a fork, drop the parent's shards."""
+    global _started_pid, _local, _shards, _retired
+    with _registry_lock:
+        if _started_pid == os.getpid():
+            return
+        if _started_pid is not None:
+            _local = threading.local()
+            _shards = []
+            _retired = _Shard()
+        _started_pid = os.getpid()
+    if _directory():
+        interval = getattr(settings, 'METRICS_FLUSH_SECONDS', 5)
+        threading.Thread(target=_flush_forever, args=(interval,), daemon=True, name='metrics-flush').start()
+
+
+def mark_process_dead(pid, directory):
+    """Fold an exited worker's counters and histograms into the archive."""
+    path = os.path.join(directory, f'{pid}.json')
+    if not os.path.exists(path):
+        return
+    archive = os.path.join(directory, 'archive.json')
+    with _DirectoryLock(directory, exclusive=True):
+        dead = _load(path)
+        dead['gauges'] = {}
+        _write(archive, merge(_load(archive), dead))
+        os.remove(path)
+
+
+def collect():
+    """Totals to expose: this process, plus every worker in shared-directory mode."""
+    own = snapshot()
+    directory = _directory()
+    if not directory:
+        return own
+    own_file = f'{os.getpid()}.json'
+    others = []
+    with _DirectoryLock(directory, exclusive=False):
+        for name in os.listdir(directory):
+            if name.endswith('.json') and name != own_file:
+                others.append(_load(os.path.join(directory, name)))
+    return merge(own, *others)
+
+
+# Exposition
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(snap):
+    lines = []
+    by_name = {}
+    for kind in ('counters', 'histograms', 'gauges'):
+        for (name, labels), value in snap[kind].items():
+            by_name.setdefault(name, []).append((labels, value))
+
+    cache_totals = {}
+    for (name, labels), value in snap['counters'].items():
+        if name == 'splitzy_cache_requests_total':
+            labels = dict(labels)
+            hits, lookups = cache_totals.get(labels['cache'], (0, 0))
+            cache_totals[labels['cache']] = (hits + (value if labels['result'] == 'hit' else 0), lookups + value)
+    by_name['splitzy_cache_hit_ratio'] = [
+        ((('cache', cache_name),), hits / lookups) for cache_name, (hits, lookups) in cache_totals.items() if lookups
+    ]
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, entry in sorted(by_name.get(name, ())):
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(float(bound))
+                lines.append(f'{name}_bucket{_labels(labels, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(entry[-1])}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    for kind, metrics in (('counter', COUNTERS), ('gauge', GAUGES)):
+        for name, help_text in metrics.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            for labels, value in sorted(by_name.get(name, ())):
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """Records latency, status, DB query count/time and in-flight requests.
+
+    Goes first in MIDDLEWARE so the latency covers the whole stack.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        start_process()
+
+    def __call__(self, request):
+        if _started_pid != os.getpid():
+            start_process()
+        queries = [0, 0.0]
+
+        def count_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries[0] += 1
+                queries[1] += time.perf_counter() - start
+
+        gauge_add('splitzy_http_requests_in_flight')
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(count_query))
+                response = self.get_response(request)
+        finally:
+            gauge_add('splitzy_http_requests_in_flight', value=-1)
+
+        elapsed = time.perf_counter() - start
+        match = request.resolver_match
+        view = match.view_name if match else '<unmatched>'
+        observe('splitzy_http_request_duration_seconds', (('view', view),), elapsed)
+        observe('splitzy_db_queries_per_request', (('view', view),), queries[0])
+        observe('splitzy_db_time_per_request_seconds', (('view', view),), queries[1])
+        inc('splitzy_http_requests_total', (('view', view), ('method', request.method), ('status', response.status_code)))
+        return response
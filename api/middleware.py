@@ -0,0 +1,51 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+_accepts_br = re.compile(r'\bbr\b')
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """GZipMiddleware that prefers brotli when the client and server support it.
+
+    Brotli output carries no random padding, so it is only used for requests
+    without cookies and responses that set none: API clients authenticate
+    with a bearer token, which a cross-site page cannot make the browser
+    send, so there is no secret for a BREACH-style attack to recover.
+    Cookie-authenticated pages (admin, browsable API) get GZipMiddleware's
+    padded gzip instead.
+    """
+
+    min_length = 200
+    brotli_quality = 4
+
+    def process_response(self, request, response):
+        if (
+            brotli is None
+            or response.streaming
+            or response.has_header('Content-Encoding')
+            or len(response.content) < self.min_length
+            or request.META.get('HTTP_COOKIE')
+            or response.cookies
+            or not _accepts_br.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        ):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        compressed = brotli.compress(response.content, quality=self.brotli_quality)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response.headers['Content-Length'] = str(len(compressed))
+        if response.has_header('ETag'):
+            response.headers['ETag'] = re.sub(r'^"', 'W/"', response.headers['ETag'])
+        response.headers['Content-Encoding'] = 'br'
+        return response
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.5 on 2026-10-18 23:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_settlement_group'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('paid', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('share', models.BigIntegerField(default=0)),
+                ('expense_count', models.PositiveIntegerField(default=0)),
+                ('settled_paid', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('settled_received', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', 'month'], name='api_spendro_group_i_2d16ab_idx'), models.Index(fields=['user', 'month'], name='api_spendro_user_id_1c3822_idx')],
+                'unique_together': {('group', 'user', 'month')},
+            },
+        ),
+    ]
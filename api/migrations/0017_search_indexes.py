@@ -0,0 +1,66 @@
+from django.db import migrations
+
+
+# (table, column, index/FTS table name). Postgres gets a GIN index on the
+# same to_tsvector() expression api.search queries with; SQLite gets an
+# external-content FTS5 table kept in sync by triggers. Both update on
+# every write. A later SQLite migration that rebuilds either table drops
+# its triggers and must create them again.
+SEARCHED = [
+    ('api_expense', 'description', 'api_expense_search'),
+    ('api_settlement', 'remark', 'api_settlement_search'),
+]
+
+
+def _vector(column):
+    return f"to_tsvector('english'::regconfig, COALESCE((\"{column}\")::text, ''))"
+
+
+def create(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for table, column, name in SEARCHED:
+        if vendor == 'postgresql':
+            schema_editor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" USING gin ({_vector(column)})')
+        elif vendor == 'sqlite':
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {name} USING fts5({column}, content='{table}', "
+                f"content_rowid='id', tokenize='porter unicode61')"
+            )
+            schema_editor.execute(
+                f'CREATE TRIGGER {name}_ai AFTER INSERT ON {table} BEGIN '
+                f'INSERT INTO {name}(rowid, {column}) VALUES (new.id, new.{column}); END'
+            )
+            schema_editor.execute(
+                f'CREATE TRIGGER {name}_ad AFTER DELETE ON {table} BEGIN '
+                f"INSERT INTO {name}({name}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END"
+            )
+            schema_editor.execute(
+                f'CREATE TRIGGER {name}_au AFTER UPDATE OF {column} ON {table} BEGIN '
+                f"INSERT INTO {name}({name}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+                f'INSERT INTO {name}(rowid, {column}) VALUES (new.id, new.{column}); END'
+            )
+            schema_editor.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+
+
+def drop(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for table, column, name in SEARCHED:
+        if vendor == 'postgresql':
+            schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+        elif vendor == 'sqlite':
+            for suffix in ('ai', 'ad', 'au'):
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {name}_{suffix}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('api', '0016_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.RunPython(create, drop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-18 23:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_search_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expensesplitbetween',
+            index=models.Index(condition=models.Q(('amount_owed__gt', 0)), fields=['owe_id', 'expense'], name='split_outstanding_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-18 23:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_split_outstanding_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['to_user', 'status', '-created_at'], name='request_inbox_idx'),
+        ),
+    ]
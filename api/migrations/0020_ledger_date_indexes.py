@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 23:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_request_inbox_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['created_at'], name='expense_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='settlement',
+            index=models.Index(fields=['settled_at'], name='settlement_settled_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_recurringexpense'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill(apps, schema_editor):
+    # The share a split was created with is not recorded anywhere else, so
+    # existing rows take what is still owed on them; for splits already
+    # paid down that is less than their original share.
+    for name in ('ExpenseSplitBetween', 'ArchivedExpenseSplit'):
+        model = apps.get_model('api', name)
+        model.objects.using(schema_editor.connection.alias).update(original_amount=F('amount_owed'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_expense_deleted_at'),
+    ]
+
+    # Nullable without a default, so SQLite adds the columns in place and
+    # the search triggers from 0017 survive.
+    operations = [
+        migrations.AddField(
+            model_name='expensesplitbetween',
+            name='original_amount',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedexpensesplit',
+            name='original_amount',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
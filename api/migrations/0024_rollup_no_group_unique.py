@@ -0,0 +1,41 @@
+# Generated by Django 5.1.5 on 2026-10-19 00:36
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+FIELDS = ['paid', 'share', 'expense_count', 'settled_paid', 'settled_received']
+
+
+def merge_duplicates(apps, schema_editor):
+    # Group-less rows written concurrently may have been inserted twice;
+    # fold each set into its oldest row before the index can be built.
+    SpendRollup = apps.get_model('api', 'SpendRollup')
+    rollups = SpendRollup.objects.using(schema_editor.connection.alias).filter(group__isnull=True)
+    duplicated = rollups.values('user_id', 'month').annotate(n=Count('id')).filter(n__gt=1)
+    for key in duplicated:
+        rows = list(rollups.filter(user_id=key['user_id'], month=key['month']).order_by('id'))
+        kept = rows[0]
+        for row in rows[1:]:
+            for field in FIELDS:
+                setattr(kept, field, getattr(kept, field) + getattr(row, field))
+        kept.save(update_fields=FIELDS)
+        rollups.filter(id__in=[row.id for row in rows[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_split_original_amount'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    # A partial unique index: no table rebuild on SQLite.
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='spendrollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('group__isnull', True)), fields=('user', 'month'), name='rollup_no_group_unique'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.5 on 2026-10-19 01:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_rollup_no_group_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='occurrence',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='recurring',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_occurrences', to='api.recurringexpense'),
+        ),
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='split_between',
+            field=models.ManyToManyField(related_name='archived_expenses', to='api.member'),
+        ),
+    ]
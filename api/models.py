@@ -2,6 +2,7 @@
 
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 
 
 class Group(models.Model):
@@ -25,11 +26,73 @@ class Expense(models.Model):
     paid_by = models.ForeignKey(User, on_delete=models.CASCADE)
     split_between = models.ManyToManyField(Member, related_name='shared_expenses')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set on expenses materialized from a RecurringExpense template.
+    recurring = models.ForeignKey(
+        'RecurringExpense', null=True, blank=True, related_name='occurrences', on_delete=models.SET_NULL
+    )
+    occurrence = models.DateField(null=True, blank=True)
+    # Set when the expense is deleted. The row stays behind as a tombstone
+    # with its splits removed; feeds and balances skip it.
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Admin date hierarchy and newest-first group feeds.
+            models.Index(fields=['created_at'], name='expense_created_idx'),
+        ]
+        constraints = [
+            # At most one expense per template and due date, so a scheduler
+            # run that overlaps or repeats another cannot double-charge.
+            models.UniqueConstraint(
+                fields=['recurring', 'occurrence'],
+                condition=models.Q(recurring__isnull=False),
+                name='expense_occurrence_uniq',
+            ),
+        ]
+
+class RecurringExpense(models.Model):
+    # A group expense repeated on a schedule; see api.recurring.
+    INTERVALS = [('daily', 'Daily'), ('weekly', 'Weekly'), ('monthly', 'Monthly'), ('yearly', 'Yearly')]
+
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+    paid_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    description = models.CharField(max_length=255)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    split = models.JSONField()
+    interval = models.CharField(max_length=10, choices=INTERVALS, default='monthly')
+    starts_on = models.DateField()
+    ends_on = models.DateField(null=True, blank=True)
+    next_run = models.DateField()
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_run'], condition=models.Q(active=True), name='recurring_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.description} ({self.interval})"
+
 
 class ExpenseSplitBetween(models.Model):
     expense = models.ForeignKey(Expense, on_delete=models.CASCADE)
     owe_id = models.ForeignKey(User, on_delete=models.CASCADE)
+    # What is still owed; settle-ups pay it down.
     amount_owed = models.PositiveIntegerField(default=0)
+    # The share as split, which settle-ups leave alone. Edits and spend
+    # rollups work from this.
+    original_amount = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            # Most splits are settled down to zero; debt feeds only read the rest.
+            models.Index(
+                fields=['owe_id', 'expense'],
+                condition=models.Q(amount_owed__gt=0),
+                name='split_outstanding_idx',
+            ),
+        ]
 
 class Friend(models.Model):
     user1 = models.ForeignKey(User, related_name='friendships_initiated', on_delete=models.CASCADE)
@@ -57,6 +120,12 @@ class Request(models.Model):
     status = models.CharField(max_length=10, choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('rejected', 'Rejected')], default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Inbox pages and badge counts.
+            models.Index(fields=['to_user', 'status', '-created_at'], name='request_inbox_idx'),
+        ]
+
     def __str__(self):
         return f"{self.from_user.username} ➝ {self.to_user.username} [{self.status}]"
 
@@ -75,7 +144,102 @@ class Settlement(models.Model):
         on_delete=models.SET_NULL
     )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['settled_at'], name='settlement_settled_idx'),
+        ]
 
     def __str__(self):
         return f"{self.from_user} paid {self.to_user} ₹{self.amount}"
 
+
+
+class SpendRollup(models.Model):
+    group = models.ForeignKey(Group, null=True, blank=True, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    month = models.DateField()
+    paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    share = models.BigIntegerField(default=0)
+    expense_count = models.PositiveIntegerField(default=0)
+    settled_paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    settled_received = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('group', 'user', 'month')
+        constraints = [
+            # NULLs never compare equal, so unique_together alone lets
+            # group-less rows for the same user and month pile up.
+            models.UniqueConstraint(
+                fields=['user', 'month'], condition=models.Q(group__isnull=True), name='rollup_no_group_unique',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['group', 'month']),
+            models.Index(fields=['user', 'month']),
+        ]
+
+
+class BalanceCheckpoint(models.Model):
+    # Either a group checkpoint (group set) or a user-pair checkpoint
+    # (user1.id < user2.id). Entries cover every split and settlement with an
+    # id at or below the watermarks; reads add the rows after them.
+    group = models.OneToOneField(Group, null=True, blank=True, on_delete=models.CASCADE)
+    user1 = models.ForeignKey(User, null=True, blank=True, related_name='+', on_delete=models.CASCADE)
+    user2 = models.ForeignKey(User, null=True, blank=True, related_name='+', on_delete=models.CASCADE)
+    split_watermark = models.BigIntegerField(default=0)
+    settlement_watermark = models.BigIntegerField(default=0)
+    writes_since = models.PositiveIntegerField(default=0)
+    taken_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user1', 'user2')
+
+
+class BalanceCheckpointEntry(models.Model):
+    checkpoint = models.ForeignKey(BalanceCheckpoint, related_name='entries', on_delete=models.CASCADE)
+    from_user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    to_user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    amount = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('checkpoint', 'from_user', 'to_user')
+
+
+class ArchivedExpense(models.Model):
+    # Fully settled expenses moved out of the hot table; ids are preserved.
+    id = models.BigIntegerField(primary_key=True)
+    group = models.ForeignKey(Group, null=True, blank=True, on_delete=models.SET_NULL)
+    description = models.CharField(max_length=255)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    paid_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    split_between = models.ManyToManyField(Member, related_name='archived_expenses')
+    created_at = models.DateTimeField()
+    # Kept for the record only: templates never run a past occurrence again,
+    # so Expense's (recurring, occurrence) constraint need not cover these.
+    recurring = models.ForeignKey(
+        'RecurringExpense', null=True, blank=True, related_name='archived_occurrences', on_delete=models.SET_NULL
+    )
+    occurrence = models.DateField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+
+class ArchivedExpenseSplit(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    expense = models.ForeignKey(ArchivedExpense, on_delete=models.CASCADE)
+    owe_id = models.ForeignKey(User, on_delete=models.CASCADE)
+    amount_owed = models.PositiveIntegerField(default=0)
+    original_amount = models.PositiveIntegerField(null=True)
+
+
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    route = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'key', 'route')
@@ -0,0 +1,20 @@
+"""Starting Django in worker processes.
+
+Kept free of model imports: a spawned worker imports this module to find
+its initializer before the app registry is ready.
+"""
+import django
+from django.conf import settings
+from django.db import connections
+
+
+def database_names():
+    """The NAME of every database as this process uses it (test databases included)."""
+    return {alias: connections[alias].settings_dict['NAME'] for alias in connections}
+
+
+def init_worker(names):
+    """ProcessPoolExecutor initializer: set Django up on the parent's databases."""
+    for alias, name in names.items():
+        settings.DATABASES[alias]['NAME'] = name
+    django.setup()
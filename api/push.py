@@ -0,0 +1,179 @@
+"""ASGI transports for api.events: Server-Sent Events and WebSockets.
+
+    GET /api/events/stream/?token=<access>   text/event-stream
+    ws:///ws/events/?token=<access>          one JSON event per text frame
+
+The token may also come as an ``Authorization: Bearer`` header. Resume by
+sending ``Last-Event-ID`` (SSE reconnects do this automatically) or
+``?last_event_id=``. A ``resync`` event means events were missed: refetch,
+then reconnect without a resume id.
+"""
+import asyncio
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import events
+
+
+SSE_PATH = '/api/events/stream/'
+WEBSOCKET_PATH = '/ws/events/'
+KEEPALIVE_SECONDS = getattr(settings, 'PUSH_KEEPALIVE_SECONDS', 15)
+
+
+def _topics(token):
+    """Topics the owner of a valid access token may follow, else None."""
+    close_old_connections()
+    try:
+        auth = JWTAuthentication()
+        user = auth.get_user(auth.get_validated_token(token))
+        if not user.is_active:
+            return None
+        return events.topics_for(user.id)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None
+    finally:
+        close_old_connections()
+
+
+def _params(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    headers = {name.decode().lower(): value.decode() for name, value in scope.get('headers', ())}
+    token = query.get('token', [''])[0]
+    bearer = headers.get('authorization', '')
+    if not token and bearer.lower().startswith('bearer '):
+        token = bearer[7:].strip()
+    last_id = headers.get('last-event-id') or query.get('last_event_id', [''])[0]
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    return token, last_id
+
+
+async def _pump(subscription, emit, keepalive):
+    while True:
+        event = await subscription.next(KEEPALIVE_SECONDS)
+        if event is None:
+            await keepalive()
+            continue
+        await emit(event)
+        if event is events.RESYNC:
+            return
+
+
+async def _until_disconnect(receive, disconnect_type, work):
+    """Run ``work`` until it finishes or the client goes away."""
+    task = asyncio.ensure_future(work)
+    try:
+        while not task.done():
+            listener = asyncio.ensure_future(receive())
+            done, _ = await asyncio.wait({task, listener}, return_when=asyncio.FIRST_COMPLETED)
+            if listener in done:
+                if listener.result()['type'] == disconnect_type:
+                    break
+            else:
+                listener.cancel()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def _start_subscription(scope):
+    token, last_id = _params(scope)
+    topics = await sync_to_async(_topics)(token) if token else None
+    if topics is None:
+        return None
+    # Off the event loop: a shared backend talks to Redis.
+    return await sync_to_async(events.backend().subscribe, thread_sensitive=False)(
+        topics, after=last_id, loop=asyncio.get_running_loop(),
+    )
+
+
+async def sse(scope, receive, send):
+    subscription = await _start_subscription(scope)
+    cors = [(b'access-control-allow-origin', b'*')] if getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False) else []
+    if subscription is None:
+        await send({'type': 'http.response.start', 'status': 401,
+                    'headers': [(b'content-type', b'application/json')] + cors})
+        await send({'type': 'http.response.body', 'body': b'{"detail":"Authentication required."}'})
+        return
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ] + cors})
+
+    async def emit(event):
+        head = b'event: %s\n' % event.type.encode()
+        if event.id is not None:
+            head = b'id: %d\n' % event.id + head
+        await send({'type': 'http.response.body', 'body': head + b'data: ' + event.body + b'\n\n', 'more_body': True})
+
+    async def keepalive():
+        await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+
+    try:
+        await _until_disconnect(receive, 'http.disconnect', _pump(subscription, emit, keepalive))
+    finally:
+        subscription.close()
+    try:
+        await send({'type': 'http.response.body', 'body': b''})
+    except Exception:
+        pass  # already disconnected
+
+
+async def websocket(scope, receive, send):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    subscription = await _start_subscription(scope)
+    if subscription is None:
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+    await send({'type': 'websocket.accept'})
+
+    async def emit(event):
+        await send({'type': 'websocket.send', 'text': event.body.decode()})
+
+    async def keepalive():
+        await send({'type': 'websocket.send', 'text': '{"type":"keepalive"}'})
+
+    try:
+        await _until_disconnect(receive, 'websocket.disconnect', _pump(subscription, emit, keepalive))
+    finally:
+        subscription.close()
+    try:
+        await send({'type': 'websocket.close', 'code': 1000})
+    except Exception:
+        pass  # already disconnected
+
+
+async def not_found(scope, receive, send):
+    """Answer 404 to everything but the push endpoints."""
+    if scope['type'] != 'http':
+        # As Django's handler does, so servers skip the lifespan protocol.
+        raise ValueError(f"Unsupported scope type {scope['type']}")
+    await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': b'{"detail":"Not found."}'})
+
+
+def router(django_application):
+    """Wrap the Django ASGI app, serving the push endpoints in front of it."""
+    async def application(scope, receive, send):
+        if scope['type'] == 'websocket' and scope['path'] == WEBSOCKET_PATH:
+            return await websocket(scope, receive, send)
+        if scope['type'] == 'http' and scope['path'] == SSE_PATH and scope['method'] == 'GET':
+            return await sse(scope, receive, send)
+        if scope['type'] == 'websocket':
+            await receive()
+            await send({'type': 'websocket.close', 'code': 4404})
+            return
+        return await django_application(scope, receive, send)
+    return application
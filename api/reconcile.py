@@ -0,0 +1,339 @@
+"""Checking derived ledger state against the raw rows.
+
+Balance checkpoints and spend rollups are both derived from expenses,
+splits and settlements and then kept up to date incrementally. This
+module recomputes them from streamed ``values_list`` reads and lists
+whatever disagrees.
+
+Work is cut into slices that can run in separate processes:
+
+- a ``group`` slice covers the groups with ids in [lo, hi): their group
+  checkpoints and rollup rows;
+- a ``user`` slice covers the users with ids in [lo, hi): pair checkpoints
+  whose lower user is one of them, and their rollup rows without a group.
+
+A slice reads only the rows of its own scopes, so slices never overlap.
+Differences are checked again for their scope alone under the ledger lock
+before they are reported (a write may have landed between two reads), and
+only then repaired: checkpoints are retaken and rollup rows overwritten
+with the recomputed values. Rechecks and repairs are few and run in the
+calling process, so the parallel part of a run only reads.
+
+Checkpoints are compared by net amount per user pair, which is all that
+reads derive from them.
+"""
+from collections import defaultdict, namedtuple
+
+from django.contrib.auth.models import User
+from django.db.models import DateField, F, Max, Min, Q
+from django.db.models.functions import Coalesce, TruncMonth
+
+from . import checkpoints, sharding
+from .balances import MINOR_UNITS
+from .locks import group_scope, ledger_lock, pair_scope
+from .models import (
+    ArchivedExpense, ArchivedExpenseSplit, BalanceCheckpoint, BalanceCheckpointEntry, Expense,
+    ExpenseSplitBetween, Group, Settlement, SpendRollup,
+)
+
+
+CHUNK_SIZE = 20000
+ROLLUP_FIELDS = ('paid', 'share', 'expense_count', 'settled_paid', 'settled_received')
+
+# scope: ('group', group id) or ('user', user id), the unit that is locked,
+# rechecked and repaired. target: ('checkpoint', checkpoint id, low user,
+# high user), net amount in minor units with positive meaning low owes
+# high, or ('rollup', group id, user id, month) together with ``field``.
+Mismatch = namedtuple('Mismatch', ['scope', 'target', 'field', 'stored', 'actual'])
+
+
+def _between(field, lo, hi):
+    return {f'{field}__gte': lo, f'{field}__lt': hi}
+
+
+def _month(field):
+    # The same truncation rollups.rebuild uses.
+    return TruncMonth(field, output_field=DateField())
+
+
+def _share():
+    # A rollup share is the split's original amount (see api.rollups);
+    # checkpoints follow amount_owed, which settle-ups pay down.
+    return Coalesce('original_amount', 'amount_owed')
+
+
+def _stream(queryset):
+    return queryset.iterator(chunk_size=CHUNK_SIZE)
+
+
+def _add_net(nets, checkpoint_id, debtor, creditor, amount):
+    if debtor == creditor:
+        return
+    if debtor < creditor:
+        nets[(checkpoint_id, debtor, creditor)] += amount
+    else:
+        nets[(checkpoint_id, creditor, debtor)] -= amount
+
+
+def _empty_rollup():
+    return dict.fromkeys(ROLLUP_FIELDS, 0)
+
+
+def _stored_nets(checkpoint_ids):
+    nets = defaultdict(int)
+    entries = BalanceCheckpointEntry.objects.filter(
+        checkpoint_id__in=checkpoint_ids
+    ).values_list('checkpoint_id', 'from_user_id', 'to_user_id', 'amount')
+    for checkpoint_id, debtor, creditor, amount in _stream(entries):
+        _add_net(nets, checkpoint_id, debtor, creditor, amount)
+    return nets
+
+
+def _compare_nets(scope_of, stored, actual):
+    for key in stored.keys() | actual.keys():
+        if stored.get(key, 0) != actual.get(key, 0):
+            yield Mismatch(scope_of(key), ('checkpoint',) + key, 'net', stored.get(key, 0), actual.get(key, 0))
+
+
+def _compare_rollups(scope_of, stored_rows, actual):
+    stored = {}
+    for group_id, user_id, month, *values in _stream(stored_rows):
+        stored[(group_id, user_id, month)] = dict(zip(ROLLUP_FIELDS, values))
+    for key in stored.keys() | actual.keys():
+        before, after = stored.get(key) or _empty_rollup(), actual.get(key) or _empty_rollup()
+        if before == after:
+            continue
+        for field in ROLLUP_FIELDS:
+            if before[field] != after[field]:
+                yield Mismatch(scope_of(key), ('rollup',) + key, field, before[field], after[field])
+
+
+def check_groups(lo, hi):
+    """Mismatches in the group checkpoints and group rollups of groups lo <= id < hi."""
+    marks = {
+        group_id: (checkpoint_id, split_mark, settlement_mark)
+        for checkpoint_id, group_id, split_mark, settlement_mark in BalanceCheckpoint.objects.filter(
+            **_between('group_id', lo, hi)
+        ).values_list('id', 'group_id', 'split_watermark', 'settlement_watermark')
+    }
+    nets = defaultdict(int)
+    totals = defaultdict(_empty_rollup)
+
+    # Months are read per expense and looked up for its splits: truncating
+    # dates is the slow part of these reads.
+    months = {}
+    for model in (Expense, ArchivedExpense):
+        expenses = model.objects.filter(**_between('group_id', lo, hi))
+        if model is Expense:
+            expenses = expenses.filter(deleted_at__isnull=True)
+        rows = expenses.annotate(month=_month('created_at')).values_list(
+            'id', 'group_id', 'paid_by_id', 'month', 'amount',
+        )
+        for expense_id, group_id, payer_id, month, amount in _stream(rows):
+            months[(model, expense_id)] = month
+            row = totals[(group_id, payer_id, month)]
+            row['paid'] += amount
+            row['expense_count'] += 1
+
+    splits = ExpenseSplitBetween.objects.filter(**_between('expense__group_id', lo, hi)).annotate(
+        share=_share(),
+    ).values_list('id', 'expense_id', 'expense__group_id', 'owe_id', 'expense__paid_by_id', 'amount_owed', 'share')
+    for split_id, expense_id, group_id, debtor, creditor, units, share in _stream(splits):
+        if (Expense, expense_id) in months:
+            totals[(group_id, debtor, months[(Expense, expense_id)])]['share'] += share
+        mark = marks.get(group_id)
+        if mark and split_id <= mark[1]:
+            _add_net(nets, mark[0], debtor, creditor, units * MINOR_UNITS)
+
+    archived_splits = ArchivedExpenseSplit.objects.filter(**_between('expense__group_id', lo, hi)).annotate(
+        share=_share(),
+    ).values_list('expense_id', 'expense__group_id', 'owe_id', 'share')
+    for expense_id, group_id, user_id, units in _stream(archived_splits):
+        totals[(group_id, user_id, months[(ArchivedExpense, expense_id)])]['share'] += units
+
+    settlements = Settlement.objects.filter(**_between('group_id', lo, hi)).annotate(
+        month=_month('settled_at'),
+    ).values_list('id', 'group_id', 'from_user_id', 'to_user_id', 'amount', 'month')
+    for settlement_id, group_id, debtor, creditor, amount, month in _stream(settlements):
+        totals[(group_id, debtor, month)]['settled_paid'] += amount
+        totals[(group_id, creditor, month)]['settled_received'] += amount
+        mark = marks.get(group_id)
+        if mark and settlement_id <= mark[2]:
+            # A payment from x to y reduces what x owes y.
+            _add_net(nets, mark[0], debtor, creditor, -int(amount * MINOR_UNITS))
+
+    group_of = {checkpoint_id: group_id for group_id, (checkpoint_id, _, _) in marks.items()}
+    mismatches = list(_compare_nets(
+        lambda key: ('group', group_of[key[0]]), _stored_nets(list(group_of)), nets,
+    ))
+    stored_rollups = SpendRollup.objects.filter(**_between('group_id', lo, hi)).values_list(
+        'group_id', 'user_id', 'month', *ROLLUP_FIELDS,
+    )
+    mismatches += _compare_rollups(lambda key: ('group', key[0]), stored_rollups, totals)
+    return mismatches
+
+
+def _lower_user_between(debtor, creditor, lo, hi):
+    """Rows whose lower user id of (debtor, creditor) lies in [lo, hi)."""
+    return (
+        Q(**_between(debtor, lo, hi)) & Q(**{f'{debtor}__lt': F(creditor)})
+        | Q(**_between(creditor, lo, hi)) & Q(**{f'{creditor}__lt': F(debtor)})
+    )
+
+
+def check_users(lo, hi):
+    """Mismatches in the pair checkpoints and group-less rollups of users lo <= id < hi."""
+    marks = {
+        (user1, user2): (checkpoint_id, split_mark, settlement_mark)
+        for checkpoint_id, user1, user2, split_mark, settlement_mark in BalanceCheckpoint.objects.filter(
+            group__isnull=True, **_between('user1_id', lo, hi)
+        ).values_list('id', 'user1_id', 'user2_id', 'split_watermark', 'settlement_watermark')
+    }
+    nets = defaultdict(int)
+    totals = defaultdict(_empty_rollup)
+
+    if marks:
+        split_top = max(mark[1] for mark in marks.values())
+        splits = ExpenseSplitBetween.objects.filter(
+            _lower_user_between('owe_id', 'expense__paid_by', lo, hi), id__lte=split_top,
+        ).values_list('id', 'owe_id', 'expense__paid_by_id', 'amount_owed')
+        for split_id, debtor, creditor, units in _stream(splits):
+            mark = marks.get((min(debtor, creditor), max(debtor, creditor)))
+            if mark and split_id <= mark[1]:
+                _add_net(nets, mark[0], debtor, creditor, units * MINOR_UNITS)
+
+        settlement_top = max(mark[2] for mark in marks.values())
+        settlements = Settlement.objects.filter(
+            _lower_user_between('from_user', 'to_user', lo, hi), id__lte=settlement_top,
+        ).values_list('id', 'from_user_id', 'to_user_id', 'amount')
+        for settlement_id, debtor, creditor, amount in _stream(settlements):
+            mark = marks.get((min(debtor, creditor), max(debtor, creditor)))
+            if mark and settlement_id <= mark[2]:
+                _add_net(nets, mark[0], debtor, creditor, -int(amount * MINOR_UNITS))
+
+    for model in (Expense, ArchivedExpense):
+        expenses = model.objects.filter(group__isnull=True, **_between('paid_by_id', lo, hi))
+        if model is Expense:
+            expenses = expenses.filter(deleted_at__isnull=True)
+        rows = expenses.annotate(month=_month('created_at')).values_list('paid_by_id', 'month', 'amount')
+        for payer_id, month, amount in _stream(rows):
+            row = totals[(None, payer_id, month)]
+            row['paid'] += amount
+            row['expense_count'] += 1
+
+    for model in (ExpenseSplitBetween, ArchivedExpenseSplit):
+        rows = model.objects.filter(expense__group__isnull=True, **_between('owe_id', lo, hi)).annotate(
+            month=_month('expense__created_at'),
+            share=_share(),
+        ).values_list('owe_id', 'month', 'share')
+        for user_id, month, share in _stream(rows):
+            totals[(None, user_id, month)]['share'] += share
+
+    for user_field, rollup_field in (('from_user_id', 'settled_paid'), ('to_user_id', 'settled_received')):
+        rows = Settlement.objects.filter(group__isnull=True, **_between(user_field, lo, hi)).annotate(
+            month=_month('settled_at'),
+        ).values_list(user_field, 'month', 'amount')
+        for user_id, month, amount in _stream(rows):
+            totals[(None, user_id, month)][rollup_field] += amount
+
+    mismatches = list(_compare_nets(lambda key: ('user', key[1]), _stored_nets([m[0] for m in marks.values()]), nets))
+    stored_rollups = SpendRollup.objects.filter(group__isnull=True, **_between('user_id', lo, hi)).values_list(
+        'group_id', 'user_id', 'month', *ROLLUP_FIELDS,
+    )
+    mismatches += _compare_rollups(lambda key: ('user', key[1]), stored_rollups, totals)
+    return mismatches
+
+
+CHECKS = {'group': check_groups, 'user': check_users}
+
+
+def _groupless_counterparts(user_id):
+    """Users sharing a group-less expense or settlement with ``user_id``."""
+    groupless = ExpenseSplitBetween.objects.filter(expense__group__isnull=True)
+    settlements = Settlement.objects.filter(group__isnull=True)
+    return (
+        set(groupless.filter(expense__paid_by=user_id).values_list('owe_id', flat=True).distinct())
+        | set(groupless.filter(owe_id=user_id).values_list('expense__paid_by', flat=True).distinct())
+        | set(settlements.filter(from_user=user_id).values_list('to_user', flat=True).distinct())
+        | set(settlements.filter(to_user=user_id).values_list('from_user', flat=True).distinct())
+    )
+
+
+def _lock_scopes(scope, mismatches):
+    kind, key = scope
+    if kind == 'group':
+        return [group_scope(key)]
+    counterparts = {m.target[3] for m in mismatches if m.target[0] == 'checkpoint'}
+    if any(m.target[0] == 'rollup' for m in mismatches):
+        counterparts |= _groupless_counterparts(key)
+    return [pair_scope(key, other) for other in counterparts if other != key]
+
+
+def _repair(mismatches):
+    checkpoint_ids = {m.target[1] for m in mismatches if m.target[0] == 'checkpoint'}
+    for checkpoint in BalanceCheckpoint.objects.filter(id__in=checkpoint_ids):
+        checkpoints.retake(checkpoint)
+    rollups = defaultdict(dict)
+    for m in mismatches:
+        if m.target[0] == 'rollup':
+            rollups[m.target[1:]][m.field] = m.actual
+    for (group_id, user_id, month), values in rollups.items():
+        SpendRollup.objects.update_or_create(group_id=group_id, user_id=user_id, month=month, defaults=values)
+
+
+def confirm(scope, mismatches, repair=False):
+    """Recheck one scope under its ledger lock; return what still disagrees, repaired if asked."""
+    kind, key = scope
+    with ledger_lock(*_lock_scopes(scope, mismatches)):
+        found = [m for m in CHECKS[kind](key, key + 1) if m.scope == scope]
+        if repair and found:
+            _repair(found)
+    return found
+
+
+def check_slice(alias, kind, lo, hi):
+    """Unconfirmed mismatches in one slice on database ``alias``."""
+    with sharding.using(alias):
+        return CHECKS[kind](lo, hi)
+
+
+def confirm_all(alias, mismatches, repair=False):
+    """confirm() every scope in ``mismatches`` on database ``alias``."""
+    by_scope = defaultdict(list)
+    for mismatch in mismatches:
+        by_scope[mismatch.scope].append(mismatch)
+    with sharding.using(alias):
+        return [m for scope in sorted(by_scope) for m in confirm(scope, by_scope[scope], repair)]
+
+
+def _ranges(lo, hi, parts):
+    """Up to ``parts`` consecutive [lo, hi) ranges covering lo..hi inclusive."""
+    if lo is None:
+        return []
+    size = -(-(hi - lo + 1) // parts)
+    return [(start, min(start + size, hi + 1)) for start in range(lo, hi + 1, size)]
+
+
+def slices(partitions):
+    """[alias, kind, lo, hi] for every database, ``partitions`` slices of each kind."""
+    result = []
+    for alias in sharding.aliases():
+        with sharding.using(alias):
+            # With shards on, the home database holds no group rows.
+            if not (sharding.enabled() and alias == sharding.HOME):
+                bounds = Group.objects.aggregate(lo=Min('id'), hi=Max('id'))
+                result += [[alias, 'group', lo, hi] for lo, hi in _ranges(bounds['lo'], bounds['hi'], partitions)]
+            bounds = User.objects.aggregate(lo=Min('id'), hi=Max('id'))
+            result += [[alias, 'user', lo, hi] for lo, hi in _ranges(bounds['lo'], bounds['hi'], partitions)]
+    return result
+
+
+def describe(mismatch):
+    kind, key = mismatch.scope
+    if mismatch.target[0] == 'checkpoint':
+        _, checkpoint_id, low, high = mismatch.target
+        what = f'checkpoint {checkpoint_id}: user {low} owes user {high} (minor units, net)'
+    else:
+        _, group_id, user_id, month = mismatch.target
+        what = f'rollup {month:%Y-%m} user {user_id}: {mismatch.field}'
+    return f'{kind} {key}, {what}: stored {mismatch.stored}, actual {mismatch.actual}'
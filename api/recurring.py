@@ -0,0 +1,242 @@
+"""Recurring group expenses, materialized in batches by a scheduler.
+
+A RecurringExpense is a template (payer, amount, compact split spec, see
+api.splits) repeated daily, weekly, monthly or yearly from ``starts_on``.
+``run`` turns every occurrence due by a date into an ordinary expense
+with its splits, a batch of templates per transaction:
+
+- expenses and splits are written as plain rows in multi-row INSERTs,
+  without a model instance apiece;
+- spend rollups and checkpoint write counters are updated in bulk
+  (rollups.bump_many, checkpoints.note_write_counts);
+- each template's ``next_run`` is advanced in the same transaction.
+
+Re-running is safe: a due occurrence is only created together with the
+move of its template's ``next_run`` watermark. Concurrent runs skip
+templates another run has locked (SKIP LOCKED where the database supports
+it) or already advanced, and (recurring, occurrence) is unique, so a run
+that still collides fails its batch instead of charging twice.
+
+Monthly and yearly occurrences keep the day of ``starts_on``, clamped to
+the end of shorter months (the 31st falls on the 30th, or the 28th/29th).
+"""
+import calendar
+import datetime
+from collections import Counter, defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import connections, router
+from django.utils import timezone
+
+from . import checkpoints, events, rollups, splits
+from .locks import ledger_lock, ledger_scopes
+from .models import Expense, ExpenseSplitBetween, Member, RecurringExpense
+
+
+# Templates per transaction.
+BATCH_SIZE = getattr(settings, 'RECURRING_BATCH_SIZE', 500)
+# Occurrences one template may catch up on in a single run; the rest stay
+# due for the next run.
+MAX_CATCH_UP = getattr(settings, 'RECURRING_MAX_CATCH_UP', 400)
+
+MONTHS = {'monthly': 1, 'yearly': 12}
+DAYS = {'daily': 1, 'weekly': 7}
+
+
+def nth_occurrence(starts_on, interval, n):
+    if interval in DAYS:
+        return starts_on + datetime.timedelta(days=DAYS[interval] * n)
+    months = starts_on.month - 1 + MONTHS[interval] * n
+    year, month = starts_on.year + months // 12, months % 12 + 1
+    return starts_on.replace(year=year, month=month, day=min(starts_on.day, calendar.monthrange(year, month)[1]))
+
+
+def occurrence_index(starts_on, interval, day):
+    """The number of the first occurrence on or after ``day``."""
+    if interval in DAYS:
+        return max(-(-(day - starts_on).days // DAYS[interval]), 0)
+    months = (day.year - starts_on.year) * 12 + day.month - starts_on.month
+    n = max(months // MONTHS[interval], 0)
+    while nth_occurrence(starts_on, interval, n) < day:
+        n += 1
+    return n
+
+
+def due_dates(template, until, limit=MAX_CATCH_UP):
+    """(occurrences due by ``until``, the next run after them)."""
+    last = until if template.ends_on is None else min(until, template.ends_on)
+    n = occurrence_index(template.starts_on, template.interval, template.next_run)
+    dates = []
+    day = nth_occurrence(template.starts_on, template.interval, n)
+    while day <= last and len(dates) < limit:
+        dates.append(day)
+        n += 1
+        day = nth_occurrence(template.starts_on, template.interval, n)
+    return dates, day
+
+
+def _owed(template, shares, member_users):
+    """{user id: units owed} for one occurrence; raises SplitError."""
+    owed = {}
+    for member_id, units in shares:
+        user_id = member_users.get((template.group_id, member_id))
+        if user_id is None:
+            raise splits.SplitError(f'Member {member_id} has left the group or has no user account.')
+        if user_id != template.paid_by_id and units:
+            owed[user_id] = owed.get(user_id, 0) + units
+    return owed
+
+
+def _plan(templates, until):
+    """{template id: (due dates, next run, owed)} plus the ids whose split no longer applies."""
+    shares, broken = {}, []
+    for template in templates:
+        try:
+            shares[template.id] = splits.expand(template.split, template.amount)
+        except splits.SplitError:
+            broken.append(template.id)
+    member_users = {
+        (group_id, member_id): user_id
+        for member_id, group_id, user_id in Member.objects.filter(
+            id__in={member_id for parts in shares.values() for member_id, _ in parts}, user__isnull=False,
+        ).values_list('id', 'group_id', 'user_id')
+    }
+    plans = {}
+    for template in templates:
+        if template.id not in shares:
+            continue
+        try:
+            owed = _owed(template, shares[template.id], member_users)
+        except splits.SplitError:
+            broken.append(template.id)
+            continue
+        dates, next_run = due_dates(template, until)
+        plans[template.id] = dates, next_run, owed
+    return plans, broken
+
+
+# What the rollups, checkpoints and events need of a created expense.
+Occurrence = namedtuple('Occurrence', 'id group_id description amount paid_by_id recurring_id created_at')
+
+
+def _insert(model, names, rows, returning=False):
+    """Insert tuples of ``names`` values, many rows per statement; the new ids if ``returning``.
+
+    Values must already be adapted for the database. Postgres and SQLite
+    (3.35+) return the ids of a multi-row insert in row order, as
+    bulk_create relies on.
+    """
+    meta = model._meta
+    fields = [meta.get_field(name) for name in names]
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    size = max(min(connection.ops.bulk_batch_size(fields, rows), 2000), 1)
+    head = f'INSERT INTO {quote(meta.db_table)} ({", ".join(quote(field.column) for field in fields)}) VALUES '
+    placeholders = f'({", ".join(["%s"] * len(fields))})'
+    tail = f' RETURNING {quote(meta.pk.column)}' if returning else ''
+    ids = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), size):
+            chunk = rows[start:start + size]
+            sql = head + ', '.join([placeholders] * len(chunk)) + tail
+            cursor.execute(sql, [value for row in chunk for value in row])
+            if returning:
+                ids += [row[0] for row in cursor.fetchall()]
+    return ids
+
+
+def _run_batch(template_ids, until):
+    templates = list(RecurringExpense.objects.filter(id__in=template_ids, active=True, next_run__lte=until))
+    plans, broken = _plan(templates, until)
+    pairs = {(t.paid_by_id, user_id) for t in templates if t.id in plans for user_id in plans[t.id][2]}
+    scopes = [scope for t in templates for scope in ledger_scopes(t.group_id)]
+    scopes += ledger_scopes(pairs=pairs)
+
+    with ledger_lock(*scopes):
+        # Only templates nobody else has advanced (or is advancing) since
+        # they were read.
+        unchanged = {
+            (t.id, t.next_run, t.active) for t in templates
+        } & set(RecurringExpense.objects.select_for_update(skip_locked=True).filter(
+            id__in=[t.id for t in templates],
+        ).values_list('id', 'next_run', 'active'))
+        templates = [t for t in templates if (t.id, t.next_run, t.active) in unchanged]
+
+        # Plain rows rather than model instances. The batch shares one
+        # creation time, so its rollup month is worked out once.
+        created_at = timezone.now()
+        month = rollups.month_of(created_at)
+        ops = connections[router.db_for_write(Expense)].ops
+        stamp = ops.adapt_datetimefield_value(created_at)
+        rows, owners = [], []
+        for template in templates:
+            if template.id not in plans:
+                continue
+            amount = ops.adapt_decimalfield_value(template.amount, 10, 2)
+            for day in plans[template.id][0]:
+                rows.append((
+                    template.group_id, template.description, amount, template.paid_by_id, stamp, template.id,
+                    ops.adapt_datefield_value(day),
+                ))
+                owners.append(template)
+        ids = _insert(
+            Expense, ('group', 'description', 'amount', 'paid_by', 'created_at', 'recurring', 'occurrence'), rows,
+            returning=True,
+        )
+        expenses = [
+            Occurrence(expense_id, t.group_id, t.description, t.amount, t.paid_by_id, t.id, created_at)
+            for expense_id, t in zip(ids, owners)
+        ]
+
+        split_rows = []
+        rollup_deltas = defaultdict(Counter)
+        group_writes, pair_writes = Counter(), Counter()
+        for expense in expenses:
+            paid = rollup_deltas[(expense.group_id, expense.paid_by_id, month)]
+            paid['paid'] += expense.amount
+            paid['expense_count'] += 1
+            group_writes[expense.group_id] += 1
+            for user_id, units in plans[expense.recurring_id][2].items():
+                split_rows.append((expense.id, user_id, units, units))
+                rollup_deltas[(expense.group_id, user_id, month)]['share'] += units
+                pair_writes[(expense.paid_by_id, user_id)] += 1
+        _insert(ExpenseSplitBetween, ('expense', 'owe_id', 'amount_owed', 'original_amount'), split_rows)
+        rollups.bump_many(rollup_deltas)
+        checkpoints.note_write_counts(group_writes, pair_writes)
+
+        # Most templates in a batch end up with the same next run.
+        advanced = defaultdict(list)
+        for template in templates:
+            if template.id in plans:
+                next_run = plans[template.id][1]
+                advanced[(next_run, template.ends_on is None or next_run <= template.ends_on)].append(template.id)
+            elif template.id in broken:
+                advanced[(template.next_run, False)].append(template.id)
+        for (next_run, active), ids in advanced.items():
+            RecurringExpense.objects.filter(id__in=ids).update(next_run=next_run, active=active)
+
+        for expense in expenses:
+            events.expense_created(expense, list(plans[expense.recurring_id][2]))
+
+    return len(templates), len(expenses), len([t for t in templates if t.id in broken])
+
+
+def run(until=None, batch_size=BATCH_SIZE):
+    """Materialize every occurrence due by ``until`` (default today) on the current database.
+
+    Returns (templates run, expenses created, templates deactivated because
+    their split names members who have left the group).
+    """
+    until = until or timezone.localdate()
+    totals = [0, 0, 0]
+    last_id = 0
+    while True:
+        ids = list(RecurringExpense.objects.filter(
+            active=True, next_run__lte=until, id__gt=last_id,
+        ).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        for index, count in enumerate(_run_batch(ids, until)):
+            totals[index] += count
+    return tuple(totals)
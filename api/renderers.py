@@ -0,0 +1,28 @@
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """Compact JSON rendered with orjson when it is installed.
+
+    Types orjson does not handle natively, plus datetimes, go through DRF's
+    encoder so the bytes match what JSONRenderer would produce. Indented
+    output (browsable API, ``; indent=`` in Accept) uses the stock renderer.
+    """
+
+    _encoder = JSONEncoder()
+    # Non-string keys (ids keyed by int) are stringified like json.dumps does.
+    _options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=self._encoder.default, option=self._options)
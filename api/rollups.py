@@ -0,0 +1,157 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DateField, F, Q, Sum
+from django.db.models.functions import Coalesce, TruncMonth
+from django.utils import timezone
+
+from . import sharding
+from .models import SpendRollup, Expense, ExpenseSplitBetween, Settlement, ArchivedExpense, ArchivedExpenseSplit
+
+
+def month_of(moment):
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def bump(group_id, user_id, month, **deltas):
+    """Add ``deltas`` to the (group, user, month) rollup row, creating it if needed."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    key = {'group_id': group_id, 'user_id': user_id, 'month': month}
+    increments = {field: F(field) + value for field, value in deltas.items()}
+    if SpendRollup.objects.filter(**key).update(**increments):
+        return
+    try:
+        # The savepoint must be on the rollup's database for the
+        # transaction there to survive the IntegrityError.
+        with transaction.atomic(using=sharding.current_alias()):
+            SpendRollup.objects.create(**key, **deltas)
+    except IntegrityError:
+        # Another writer created the row between our update and insert.
+        SpendRollup.objects.filter(**key).update(**increments)
+
+
+def bump_many(deltas):
+    """bump() for many rows: ``{(group_id, user_id, month): {field: delta}}``.
+
+    Missing rows are inserted empty first; rows with the same deltas are
+    then incremented by one UPDATE.
+    """
+    deltas = {key: {k: v for k, v in values.items() if v} for key, values in deltas.items()}
+    deltas = {key: values for key, values in deltas.items() if values}
+    if not deltas:
+        return
+    SpendRollup.objects.bulk_create(
+        [SpendRollup(group_id=g, user_id=u, month=m) for g, u, m in deltas],
+        ignore_conflicts=True, batch_size=1000,
+    )
+    # A superset of the wanted rows, narrowed down here.
+    group_ids, user_ids, months = (set(column) for column in zip(*deltas))
+    # ``IN (NULL)`` matches nothing, so group-less rows are asked for apart.
+    in_groups = Q(group_id__in=group_ids - {None})
+    if None in group_ids:
+        in_groups |= Q(group__isnull=True)
+    candidates = SpendRollup.objects.filter(
+        in_groups, user_id__in=user_ids, month__in=months,
+    ).values_list('id', 'group_id', 'user_id', 'month')
+    ids_by_delta = defaultdict(list)
+    for rollup_id, *key in candidates:
+        values = deltas.get(tuple(key))
+        if values:
+            ids_by_delta[tuple(sorted(values.items()))].append(rollup_id)
+    for values, ids in ids_by_delta.items():
+        SpendRollup.objects.filter(id__in=ids).update(**{field: F(field) + value for field, value in values})
+
+
+# ``share`` is what a user's part of an expense came to when it was split
+# (ExpenseSplitBetween.original_amount): settle-ups change what is still
+# owed, not anybody's share of the spending. Everything that writes shares
+# -- record_*, bump_many from the recurring scheduler, rebuild and
+# api.reconcile -- counts them this way.
+
+def record_expense(expense, splits):
+    month = month_of(expense.created_at)
+    bump(expense.group_id, expense.paid_by_id, month, paid=expense.amount, expense_count=1)
+    shares = defaultdict(int)
+    for split in splits:
+        shares[split.owe_id_id] += split.original_amount
+    for user_id, share in shares.items():
+        bump(expense.group_id, user_id, month, share=share)
+
+
+def record_expense_change(group_id, month, before=None, after=None):
+    """Apply the difference between two versions of an expense.
+
+    ``before`` and ``after`` are (payer id, amount, {user id: share}), or
+    None for an expense that did not or no longer exists. Only rows whose
+    values actually change are touched.
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    for sign, version in ((-1, before), (1, after)):
+        if version is None:
+            continue
+        payer_id, amount, shares = version
+        deltas[payer_id]['paid'] += sign * amount
+        deltas[payer_id]['expense_count'] += sign
+        for user_id, share in shares.items():
+            deltas[user_id]['share'] += sign * share
+    for user_id, values in deltas.items():
+        bump(group_id, user_id, month, **values)
+
+
+def record_settlement(settlement):
+    month = month_of(settlement.settled_at)
+    bump(settlement.group_id, settlement.from_user_id, month, settled_paid=settlement.amount)
+    bump(settlement.group_id, settlement.to_user_id, month, settled_received=settlement.amount)
+
+
+def rebuild(group_id=None):
+    """Recompute rollups from the raw tables.
+
+    Shares are the splits' original amounts, as record_expense counts them.
+    Archived expenses are included; deleted ones are not.
+    """
+    settlements = Settlement.objects.all()
+    rollups = SpendRollup.objects.all()
+    if group_id is not None:
+        settlements = settlements.filter(group_id=group_id)
+        rollups = rollups.filter(group_id=group_id)
+
+    rows = defaultdict(lambda: {
+        'paid': Decimal('0'), 'share': 0, 'expense_count': 0,
+        'settled_paid': Decimal('0'), 'settled_received': Decimal('0'),
+    })
+    for expense_model, split_model in ((Expense, ExpenseSplitBetween), (ArchivedExpense, ArchivedExpenseSplit)):
+        expenses = expense_model.objects.all()
+        if expense_model is Expense:
+            expenses = expenses.filter(deleted_at__isnull=True)
+        splits = split_model.objects.all()
+        if group_id is not None:
+            expenses = expenses.filter(group_id=group_id)
+            splits = splits.filter(expense__group_id=group_id)
+        for row in expenses.annotate(month=TruncMonth('created_at', output_field=DateField())).values(
+                'group_id', 'paid_by_id', 'month').annotate(total=Sum('amount'), count=Count('id')):
+            key = (row['group_id'], row['paid_by_id'], row['month'])
+            rows[key]['paid'] += row['total']
+            rows[key]['expense_count'] += row['count']
+        for row in splits.annotate(month=TruncMonth('expense__created_at', output_field=DateField())).values(
+                'expense__group_id', 'owe_id', 'month').annotate(total=Sum(Coalesce('original_amount', 'amount_owed'))):
+            rows[(row['expense__group_id'], row['owe_id'], row['month'])]['share'] += row['total']
+    dated = settlements.annotate(month=TruncMonth('settled_at', output_field=DateField()))
+    for row in dated.values('group_id', 'from_user_id', 'month').annotate(total=Sum('amount')):
+        rows[(row['group_id'], row['from_user_id'], row['month'])]['settled_paid'] += row['total']
+    for row in dated.values('group_id', 'to_user_id', 'month').annotate(total=Sum('amount')):
+        rows[(row['group_id'], row['to_user_id'], row['month'])]['settled_received'] += row['total']
+
+    with transaction.atomic(using=sharding.current_alias()):
+        rollups.delete()
+        SpendRollup.objects.bulk_create(
+            [
+                SpendRollup(group_id=group, user_id=user, month=month, **values)
+                for (group, user, month), values in rows.items()
+            ],
+            batch_size=1000,
+        )
+    return len(rows)
@@ -0,0 +1,141 @@
+"""Ranked full-text search over expense descriptions and settlement remarks.
+
+Postgres matches ``websearch_to_tsquery`` against the GIN-indexed
+``to_tsvector`` of each column and ranks with ``ts_rank``. SQLite (local
+use) queries the FTS5 tables from migration 0017 and ranks with bm25.
+Either way the index is maintained by the database on every write.
+
+Results are limited to the caller's groups and friends: expenses and
+settlements in groups they belong to, plus those between them and a
+friend, as /expenses/with/<friend>/ and /settlements/with/<friend>/ list
+them. Outside their groups, a non-friend's expenses and settlements with the
+caller do not show up.
+"""
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.models import Exists, FloatField, OuterRef, Q, Value
+from django.db.models.expressions import RawSQL
+
+from . import membership, sharding
+from .fast_serializers import decimal_str, iso_datetime
+from .models import Expense, ExpenseSplitBetween, Friend, Settlement
+
+
+PAGE_SIZE = getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+MAX_PAGE_SIZE = 100
+CONFIG = 'english'
+
+# Postgres' english configuration drops these; FTS5 has no stop words, so
+# leave them out of the MATCH expression to get the same hits locally.
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from in into is it of on or that the their this to was with'.split()
+)
+
+
+def _fts_query(text):
+    terms = [term for term in re.findall(r'\w+', text.lower()) if term not in STOP_WORDS]
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def _matching(queryset, column, fts_table, text):
+    """``queryset`` narrowed to rows matching ``text``, annotated with ``rank``."""
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        query = SearchQuery(text, config=CONFIG, search_type='websearch')
+        vector = SearchVector(column, config=CONFIG)
+        return queryset.annotate(search=vector, rank=SearchRank(vector, query)).filter(search=query)
+
+    match = _fts_query(text)
+    if not match:
+        return queryset.annotate(rank=Value(0.0, output_field=FloatField())).none()
+    table = queryset.model._meta.db_table
+    # bm25() is lower for better matches.
+    rank = RawSQL(
+        f'SELECT -bm25({fts_table}) FROM {fts_table} WHERE {fts_table} MATCH %s AND rowid = "{table}"."id"',
+        (match,), output_field=FloatField(),
+    )
+    return queryset.filter(
+        id__in=RawSQL(f'SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH %s', (match,))
+    ).annotate(rank=rank)
+
+
+def _friend_ids(user_id):
+    pairs = Friend.objects.filter(Q(user1_id=user_id) | Q(user2_id=user_id)).values_list('user1_id', 'user2_id')
+    return [user2 if user1 == user_id else user1 for user1, user2 in pairs]
+
+
+def _expenses(user_id, group_ids, friends, text, limit):
+    splits = ExpenseSplitBetween.objects.filter(expense=OuterRef('pk'))
+    visible = Expense.objects.filter(deleted_at__isnull=True).filter(
+        Q(group_id__in=group_ids)
+        | Q(paid_by_id=user_id) & Exists(splits.filter(owe_id__in=friends))
+        | Q(paid_by_id__in=friends) & Exists(splits.filter(owe_id=user_id))
+    )
+    rows = _matching(visible, 'description', 'api_expense_search', text).order_by('-rank', '-id').values(
+        'id', 'description', 'amount', 'group_id', 'group__name', 'paid_by_id', 'paid_by__username',
+        'created_at', 'rank',
+    )[:limit]
+    return [
+        {
+            'type': 'expense',
+            'id': r['id'],
+            'description': r['description'],
+            'amount': decimal_str(r['amount']),
+            'group': r['group_id'],
+            'group_name': r['group__name'],
+            'paid_by': {'id': r['paid_by_id'], 'username': r['paid_by__username']},
+            'created_at': iso_datetime(r['created_at']),
+            'rank': r['rank'],
+        }
+        for r in rows
+    ]
+
+
+def _settlements(user_id, group_ids, friends, text, limit):
+    visible = Settlement.objects.filter(
+        Q(group_id__in=group_ids)
+        | Q(from_user_id=user_id, to_user_id__in=friends)
+        | Q(from_user_id__in=friends, to_user_id=user_id)
+    )
+    rows = _matching(visible, 'remark', 'api_settlement_search', text).order_by('-rank', '-id').values(
+        'id', 'remark', 'amount', 'group_id', 'from_user_id', 'from_user__username',
+        'to_user_id', 'to_user__username', 'settled_at', 'rank',
+    )[:limit]
+    return [
+        {
+            'type': 'settlement',
+            'id': r['id'],
+            'remark': r['remark'],
+            'amount': decimal_str(r['amount']),
+            'group': r['group_id'],
+            'from_user': {'id': r['from_user_id'], 'username': r['from_user__username']},
+            'to_user': {'id': r['to_user_id'], 'username': r['to_user__username']},
+            'settled_at': iso_datetime(r['settled_at']),
+            'rank': r['rank'],
+        }
+        for r in rows
+    ]
+
+
+def search(user_id, text, page=1, page_size=PAGE_SIZE):
+    """One page of matches, best first, and whether another page follows.
+
+    Each database returns at most its top ``page * page_size + 1`` hits of
+    each kind; merging those is enough to fill the page exactly.
+    """
+    group_ids = list(membership.group_ids(user_id))
+    friends = _friend_ids(user_id)
+    limit = page * page_size + 1
+
+    def top():
+        return (
+            _expenses(user_id, group_ids, friends, text, limit)
+            + _settlements(user_id, group_ids, friends, text, limit)
+        )
+
+    hits = sorted(sharding.gather(top), key=lambda hit: (-hit['rank'], hit['type'], -hit['id']))
+    start = (page - 1) * page_size
+    return hits[start:start + page_size], len(hits) > start + page_size
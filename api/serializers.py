@@ -1,9 +1,16 @@
 
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.http import Http404
 from rest_framework import serializers
 
-from api.models import Profile, Member, Group, Request, ExpenseSplitBetween, Expense, Settlement
+from api import checkpoints, events, expenses, membership, rollups, sharding, splits
+from api.locks import ledger_lock, ledger_scopes
+from api.sparse import SparseFieldsMixin
+from api.models import (
+    Profile, Member, Group, Request, ExpenseSplitBetween, Expense, Settlement, ArchivedExpense, ArchivedExpenseSplit,
+    RecurringExpense,
+)
 
 class RegisterSerializer(serializers.ModelSerializer):
     email = serializers.EmailField()
@@ -68,11 +75,14 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'email']
 
 
-class RequestSerializer(serializers.ModelSerializer):
+class RequestSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     from_user = UserSerializer(read_only=True)
     to_user = UserSerializer(read_only=True)
     group_name = serializers.SerializerMethodField()
 
+    sparse_relations = {'from_user': 'from_user', 'to_user': 'to_user'}
+    sparse_joins = {'group_name': ['group']}
+
     class Meta:
         model = Request
         fields = '__all__'
@@ -89,7 +99,8 @@ class GroupSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'created_at', 'members']
 
     def get_members(self, obj):
-        members = Member.objects.filter(group=obj).select_related('user')
+        with sharding.for_group(obj.id):
+            members = list(Member.objects.filter(group=obj).select_related('user'))
         return [
             {
                 'id': m.user.id,
@@ -105,7 +116,37 @@ class ExpenseSplitBetweenSerializer(serializers.ModelSerializer):
         model = ExpenseSplitBetween
         fields = ['owe']
 
-class ExpenseSerializer(serializers.ModelSerializer):
+
+def expand_split(spec, group, amount, payer):
+    """{user id: units owed} from a split spec; the payer's own share is dropped."""
+    if group is None:
+        raise serializers.ValidationError({'split': 'A split refers to group members; set group.'})
+    try:
+        shares = splits.expand(spec, amount)
+    except splits.SplitError as e:
+        raise serializers.ValidationError({'split': str(e)})
+
+    with sharding.for_group(group.id):
+        member_users = dict(Member.objects.filter(
+            group=group, id__in=[member_id for member_id, _ in shares]
+        ).values_list('id', 'user_id'))
+    missing = [member_id for member_id, _ in shares if member_id not in member_users]
+    if missing:
+        raise serializers.ValidationError({'split': f'Not members of this group: {missing[:10]}'})
+    if any(member_users[member_id] is None for member_id, _ in shares):
+        raise serializers.ValidationError({'split': 'Every member in a split needs a user account.'})
+
+    owed = {}
+    for member_id, units in shares:
+        user_id = member_users[member_id]
+        if user_id != payer.id and units:
+            owed[user_id] = owed.get(user_id, 0) + units
+    return owed
+
+
+class ExpenseSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    sparse_joins = {'group': ['group']}
+
     group = serializers.SlugRelatedField(
         slug_field='name',
         queryset=Group.objects.all(),
@@ -117,35 +158,111 @@ class ExpenseSerializer(serializers.ModelSerializer):
 
     owe_list = serializers.ListField(
         child=serializers.DictField(child=serializers.CharField()),
-        write_only=True
+        write_only=True,
+        required=False
     )
+    # Compact alternative to owe_list for group expenses; see api.splits.
+    split = serializers.JSONField(write_only=True, required=False)
 
     class Meta:
         model = Expense
-        fields = ['id', 'description', 'amount', 'group', 'paid_by', 'owe_list' ]
-
-    def create(self, validated_data):
-        owe_list = validated_data.pop('owe_list', [])
-        expense = Expense.objects.create(**validated_data)
-
+        fields = ['id', 'description', 'amount', 'group', 'paid_by', 'owe_list', 'split']
+
+    def validate_group(self, group):
+        request = self.context.get('request')
+        if group is not None and request is not None and not membership.is_member(request.user.id, group.id):
+            raise serializers.ValidationError('You are not a member of this group.')
+        return group
+
+    def validate(self, attrs):
+        if 'owe_list' in attrs and 'split' in attrs:
+            raise serializers.ValidationError('Send either owe_list or split.')
+        if self.instance is None and 'owe_list' not in attrs and 'split' not in attrs:
+            raise serializers.ValidationError('Send either owe_list or split.')
+        if self.instance is not None:
+            # Edits keep the payer and group; without owe_list or split the shares stay as they are.
+            if 'group' in attrs and attrs['group'] != self.instance.group:
+                raise serializers.ValidationError({'group': 'The group of an expense cannot be changed.'})
+            attrs['group'] = self.instance.group
+            attrs['paid_by'] = self.instance.paid_by
+        if 'split' in attrs:
+            amount = attrs.get('amount', self.instance.amount if self.instance else None)
+            attrs['owed'] = expand_split(attrs['split'], attrs.get('group'), amount, attrs['paid_by'])
+        return attrs
+
+    def _resolve_owe_list(self, owe_list):
+        usernames = [entry.get('username') for entry in owe_list]
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        owed = {}
         for entry in owe_list:
             username = entry.get('username')
-            amount_owed = entry.get('amount_owed')
-
-            try:
-                user = User.objects.get(username=username)
-                ExpenseSplitBetween.objects.create(
-                    expense=expense,
-                    owe_id=user,
-                    amount_owed=int(amount_owed)
-                )
-            except User.DoesNotExist:
+            if username not in user_ids:
                 raise serializers.ValidationError(f"User '{username}' does not exist.")
-            except Exception as e:
+            try:
+                amount_owed = int(entry.get('amount_owed'))
+                if amount_owed < 0:
+                    raise ValueError('amount_owed must not be negative')
+            except (TypeError, ValueError) as e:
                 raise serializers.ValidationError(f"Error processing '{username}': {str(e)}")
+            owed[user_ids[username]] = owed.get(user_ids[username], 0) + amount_owed
+        return owed
+
+    def create(self, validated_data):
+        owe_list = validated_data.pop('owe_list', None)
+        validated_data.pop('split', None)
+        owed = validated_data.pop('owed', None)
+        if owed is None:
+            owed = self._resolve_owe_list(owe_list)
+
+        group = validated_data.get('group')
+        payer_id = validated_data['paid_by'].id
+        scopes = ledger_scopes(group.id if group else None, [(payer_id, user_id) for user_id in owed])
+
+        with sharding.for_group(group.id if group else None), ledger_lock(*scopes):
+            expense = Expense.objects.create(**validated_data)
+            splits = ExpenseSplitBetween.objects.bulk_create([
+                ExpenseSplitBetween(
+                    expense=expense, owe_id_id=user_id, amount_owed=amount_owed, original_amount=amount_owed,
+                )
+                for user_id, amount_owed in owed.items()
+            ])
 
+            rollups.record_expense(expense, splits)
+            checkpoints.note_writes(expense.group_id, [(expense.paid_by_id, s.owe_id_id) for s in splits])
+            events.expense_created(expense, list(owed))
         return expense
 
+    def update(self, instance, validated_data):
+        owe_list = validated_data.pop('owe_list', None)
+        owed = validated_data.pop('owed', None)
+        if owed is None and owe_list is not None:
+            owed = self._resolve_owe_list(owe_list)
+        fields = {field: validated_data[field] for field in ('description', 'amount') if field in validated_data}
+        updated = expenses.update_expense(instance, fields, owed)
+        if updated is None:
+            raise Http404
+        return updated
+
+
+class RecurringExpenseSerializer(serializers.ModelSerializer):
+    """A recurring expense in the group passed as ``context['group']``, paid by the caller."""
+
+    class Meta:
+        model = RecurringExpense
+        fields = ['id', 'description', 'amount', 'split', 'interval', 'starts_on', 'ends_on', 'next_run', 'active', 'paid_by']
+        read_only_fields = ['next_run', 'active', 'paid_by']
+
+    def validate(self, attrs):
+        if attrs.get('ends_on') is not None and attrs['ends_on'] < attrs['starts_on']:
+            raise serializers.ValidationError({'ends_on': 'Must not be before starts_on.'})
+        # Checked now so the scheduler only meets splits that went stale later.
+        expand_split(attrs['split'], self.context['group'], attrs['amount'], self.context['request'].user)
+        return attrs
+
+    def create(self, validated_data):
+        validated_data['next_run'] = validated_data['starts_on']
+        return super().create(validated_data)
+
 
 class OwedExpenseSerializer(serializers.ModelSerializer):
     description = serializers.CharField(source='expense.description')
@@ -192,6 +309,20 @@ class DetailedExpenseWithSplitsSerializer(serializers.ModelSerializer):
         return FilteredSplitSerializer(splits, many=True).data
 
 
+class ArchivedExpenseWithSplitsSerializer(DetailedExpenseWithSplitsSerializer):
+    class Meta(DetailedExpenseWithSplitsSerializer.Meta):
+        model = ArchivedExpense
+
+    def get_splits(self, expense):
+        user = self.context['user']
+        friend_id = self.context['friend_id']
+        splits = ArchivedExpenseSplit.objects.filter(
+            expense=expense,
+            owe_id__in=[user.id, friend_id]
+        ).select_related('owe_id')
+        return FilteredSplitSerializer(splits, many=True).data
+
+
 class SettlementSerializer(serializers.ModelSerializer):
     from_user_username = serializers.CharField(source="from_user.username", read_only=True)
     to_user_username = serializers.CharField(source="to_user.username", read_only=True)
@@ -234,11 +365,24 @@ class IndividualSettlementSerializer(serializers.Serializer):
     amount = serializers.DecimalField(max_digits=10, decimal_places=2)
 
 class GroupSettleUpSerializer(serializers.Serializer):
-    from_user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    # Always the caller: nobody records a payment on someone else's behalf.
+    from_user = serializers.HiddenField(default=serializers.CurrentUserDefault())
     group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.all(), required=False, allow_null=True)
     settlements = IndividualSettlementSerializer(many=True)
     remark = serializers.CharField(required=False, allow_blank=True)
 
+    def validate(self, attrs):
+        group = attrs.get('group')
+        if group is not None:
+            outsiders = sorted({
+                entry['to_user'].id for entry in attrs['settlements']
+                if not membership.is_member(entry['to_user'].id, group.id)
+            })
+            if outsiders:
+                raise serializers.ValidationError(
+                    {'settlements': f'Not members of this group: {", ".join(map(str, outsiders))}.'}
+                )
+        return attrs
 
     def create(self, validated_data):
         from_user = validated_data['from_user']
@@ -246,17 +390,24 @@ class GroupSettleUpSerializer(serializers.Serializer):
         settlements_data = validated_data['settlements']
 
 
+        group_id = group.id if group else None
+        scopes = ledger_scopes(group_id, [(from_user.id, entry['to_user'].id) for entry in settlements_data])
+
         created = []
-        for entry in settlements_data:
-            to_user = entry['to_user']
-            amount = entry['amount']
-            settlement = Settlement.objects.create(
-                from_user=from_user,
-                to_user=to_user,
-                amount=amount,
-                group=group,
-                remark=entry.get('remark', '')
-            )
-            created.append(settlement)
+        with sharding.for_group(group_id), ledger_lock(*scopes):
+            for entry in settlements_data:
+                to_user = entry['to_user']
+                amount = entry['amount']
+                settlement = Settlement.objects.create(
+                    from_user=from_user,
+                    to_user=to_user,
+                    amount=amount,
+                    group=group,
+                    remark=entry.get('remark', '')
+                )
+                rollups.record_settlement(settlement)
+                events.settlement_created(settlement)
+                created.append(settlement)
 
+            checkpoints.note_writes(group_id, [(from_user.id, s.to_user_id) for s in created])
         return created
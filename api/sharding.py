@@ -0,0 +1,186 @@
+"""Group-sharded placement of ledger rows.
+
+With GROUP_SHARDS set, everything that belongs to a group (members,
+expenses and their splits, recurring templates, settlements, invites,
+rollups, checkpoints, archived rows) lives on
+``GROUP_SHARDS[group_id % len(GROUP_SHARDS)]``. The home database
+('default') keeps the user-global tables (users, friends, profiles,
+idempotency keys), the group directory that allocates group ids, and
+ledger rows without a group.
+
+Code selects a shard by entering ``for_group(group_id)`` (or
+``using(alias)``); GroupShardRouter then sends group-scoped models there.
+Views that span groups run the same function against every database with
+``fan_out`` and merge the results. Users and groups are copied to the
+shards on save so shard-local joins (usernames, group names) work, and
+``init_shards`` gives each shard its own id range so ids stay unique.
+
+Writes that touch several databases (a pair settle-up consuming splits
+on more than one shard) commit per database; there is no two-phase commit.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+from django.db.models.signals import post_save
+
+
+HOME = DEFAULT_DB_ALIAS
+SHARDS = list(getattr(settings, 'GROUP_SHARDS', []))
+
+# Models whose rows are placed by group.
+GROUP_SCOPED = {
+    'api.group', 'api.member', 'api.expense', 'api.expense_split_between', 'api.expensesplitbetween',
+    'api.settlement', 'api.request', 'api.spendrollup', 'api.balancecheckpoint', 'api.balancecheckpointentry',
+    'api.archivedexpense', 'api.archivedexpense_split_between', 'api.archivedexpensesplit', 'api.recurringexpense',
+}
+# Group-scoped tables given a per-shard id range by init_shards (groups
+# take their ids from the home directory).
+ID_RANGE_TABLES = GROUP_SCOPED - {'api.group'}
+SHARD_ID_SPAN = 10 ** 12
+
+_current = ContextVar('splitzy_current_shard', default=None)
+_executor = ThreadPoolExecutor(max_workers=max(len(SHARDS), 1) + 1, thread_name_prefix='shard')
+
+
+def enabled():
+    return bool(SHARDS)
+
+
+def shard_for_group(group_id):
+    if not SHARDS or group_id is None:
+        return HOME
+    return SHARDS[int(group_id) % len(SHARDS)]
+
+
+def aliases():
+    """Every database holding ledger rows: home first, then the shards."""
+    return [HOME] + SHARDS
+
+
+def current_alias():
+    return _current.get() or HOME
+
+
+@contextmanager
+def using(alias):
+    token = _current.set(alias)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def for_group(group_id):
+    """Route group-scoped models to ``group_id``'s shard (home for None)."""
+    return using(shard_for_group(group_id))
+
+
+def group_scoped(view):
+    """Run a view that takes a ``group_id`` URL kwarg on that group's shard."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with for_group(kwargs.get('group_id')):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def _run_on(alias, func):
+    close_old_connections()
+    try:
+        with using(alias):
+            return func()
+    finally:
+        close_old_connections()
+
+
+def fan_out(func):
+    """``func()`` evaluated against every database, in parallel, in alias order.
+
+    Without shards this is just ``[func()]`` on the calling thread.
+    """
+    if not SHARDS:
+        return [func()]
+    # Each task gets its own copy of the caller's context so the current
+    # request (replica routing) carries over to the worker threads.
+    futures = [_executor.submit(copy_context().run, _run_on, alias, func) for alias in aliases()]
+    return [future.result() for future in futures]
+
+
+def gather(func):
+    """Concatenate the lists ``func()`` returns on every database."""
+    results = fan_out(func)
+    if len(results) == 1:
+        return results[0]
+    return [item for part in results for item in part]
+
+
+def find(func):
+    """The first non-None ``func()`` across databases (for lookups by unique id)."""
+    for result in fan_out(func):
+        if result is not None:
+            return result
+    return None
+
+
+class GroupShardRouter:
+    """Send group-scoped models to the shard selected with for_group()/using().
+
+    Outside such a block it defers to the next router, so group-less rows
+    stay on the home database (and its replica).
+    """
+
+    def _route(self, model, instance=None, **hints):
+        if model._meta.label_lower not in GROUP_SCOPED:
+            return None
+        # Rows loaded from a shard (and objects related to them) stay there.
+        if instance is not None and instance._state.db in SHARDS:
+            return instance._state.db
+        return _current.get()
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Shard rows point at users and groups that are copied to every
+        # shard from the home database.
+        return True
+
+
+def copy_to_shards(instance, aliases):
+    """Upsert ``instance`` into ``aliases`` as a copy of the home row."""
+    model = type(instance)
+    concrete = model._meta.concrete_fields
+    fields = [f.attname for f in concrete if not f.primary_key]
+    for alias in aliases:
+        # A fresh copy each time: bulk_create rebinds its objects to ``alias``.
+        copy = model(**{f.attname: getattr(instance, f.attname) for f in concrete})
+        model.objects.using(alias).bulk_create(
+            [copy], update_conflicts=True, unique_fields=['id'], update_fields=fields,
+        )
+
+
+def _copy_user(sender, instance, using, **kwargs):
+    if using == HOME:
+        copy_to_shards(instance, SHARDS)
+
+
+def _copy_group(sender, instance, using, **kwargs):
+    if using == HOME:
+        copy_to_shards(instance, [shard_for_group(instance.id)])
+
+
+def connect_signals():
+    from django.contrib.auth.models import User
+
+    from .models import Group
+
+    if SHARDS:
+        post_save.connect(_copy_user, sender=User, dispatch_uid='shard-copy-user')
+        post_save.connect(_copy_group, sender=Group, dispatch_uid='shard-copy-group')
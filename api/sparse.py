@@ -0,0 +1,58 @@
+from rest_framework import serializers
+
+
+def parse_fields(request):
+    """(fields, expand) from ``?fields=`` and ``?expand=``; fields is None when absent."""
+    def names(param):
+        return {name.strip() for name in request.query_params.get(param, '').split(',') if name.strip()}
+    return names('fields') or None, names('expand')
+
+
+class SparseFieldsMixin:
+    """Trim a read serializer to ``?fields=`` and collapse unexpanded relations.
+
+    ``sparse_relations`` maps nested relation fields to the select_related
+    path they need; when a sparse fieldset is given, those fields render as
+    the related id unless named in ``?expand=``. ``sparse_joins`` lists the
+    joins that other computed fields depend on. Without ``?fields=`` the
+    serializer is unchanged.
+    """
+
+    sparse_relations = {}
+    sparse_joins = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+        fields, expand = parse_fields(request)
+        if fields is None:
+            return
+        for name in list(self.fields):
+            if name not in fields:
+                self.fields.pop(name)
+            elif name in self.sparse_relations and name not in expand:
+                self.fields[name] = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    @classmethod
+    def sparse_queryset(cls, queryset, request):
+        """Apply only()/select_related() for the fields the request will render."""
+        fields, expand = parse_fields(request)
+        if fields is None:
+            joins = set(cls.sparse_relations.values())
+            for paths in cls.sparse_joins.values():
+                joins.update(paths)
+            return queryset.select_related(*sorted(joins)) if joins else queryset
+
+        concrete = {f.name for f in cls.Meta.model._meta.concrete_fields}
+        only = {'id'} | (fields & concrete)
+        joins = set()
+        for name in fields:
+            if name in cls.sparse_relations and name in expand:
+                joins.add(cls.sparse_relations[name])
+            joins.update(cls.sparse_joins.get(name, ()))
+        only.update(path.split('__')[0] for path in joins)
+        queryset = queryset.only(*sorted(only))
+        # select_related() without arguments would follow every relation.
+        return queryset.select_related(*sorted(joins)) if joins else queryset
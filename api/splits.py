@@ -0,0 +1,137 @@
+"""Compact split specs, expanded on the server.
+
+Instead of a full ``owe_list``, a group expense may carry
+
+    {"type": "equal", "members": [<member id>, ...]}
+    {"type": "shares", "members": {"<member id>": <shares>, ...}}
+    {"type": "percentage", "members": {"<member id>": <percent>, ...}}
+    {"type": "exact", "members": {"<member id>": <units>, ...}}
+
+The expense amount, rounded to whole units (what ``amount_owed`` stores),
+is divided in proportion to the weights with largest-remainder rounding,
+so the parts always add up to the total exactly. Ties go to the member
+listed first.
+
+Weights have at most WEIGHT_PLACES decimal places and WEIGHT_DIGITS digits
+in all, which keeps the integer arithmetic small whatever exponent a
+client sends.
+"""
+from decimal import ROUND_HALF_UP, Decimal, DecimalException
+
+from django.conf import settings
+
+
+TYPES = ('equal', 'shares', 'percentage', 'exact')
+MAX_MEMBERS = getattr(settings, 'SPLIT_MAX_MEMBERS', 5000)
+WEIGHT_PLACES = 2
+WEIGHT_DIGITS = 12
+
+
+class SplitError(ValueError):
+    pass
+
+
+def total_units(amount):
+    return int(Decimal(amount).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def largest_remainder(total, weights):
+    """Non-negative integers proportional to ``weights`` that sum to ``total``.
+
+    ``weights`` are non-negative integers with a positive sum.
+    """
+    weight_sum = sum(weights)
+    parts = []
+    remainders = []
+    for index, weight in enumerate(weights):
+        part, remainder = divmod(total * weight, weight_sum)
+        parts.append(part)
+        remainders.append((-remainder, index))
+    for _, index in sorted(remainders)[:total - sum(parts)]:
+        parts[index] += 1
+    return parts
+
+
+def _member_id(value):
+    try:
+        member_id = int(value)
+    except (TypeError, ValueError):
+        raise SplitError(f'{value!r} is not a member id.')
+    if member_id <= 0:
+        raise SplitError(f'{value!r} is not a member id.')
+    return member_id
+
+
+def _number(value):
+    if isinstance(value, bool):
+        raise SplitError(f'{value!r} is not a number.')
+    try:
+        number = Decimal(str(value))
+        if not number.is_finite() or number < 0:
+            raise SplitError(f'{value!r} must be a non-negative number.')
+        # adjusted() is the exponent of the leading digit; checking it first
+        # keeps quantize() away from huge exponents.
+        if number and number.adjusted() >= WEIGHT_DIGITS - WEIGHT_PLACES:
+            raise SplitError(f'{value!r} has more than {WEIGHT_DIGITS - WEIGHT_PLACES} digits before the point.')
+        rounded = number.quantize(Decimal(1).scaleb(-WEIGHT_PLACES))
+    except DecimalException:
+        raise SplitError(f'{value!r} is not a number.')
+    if rounded != number:
+        raise SplitError(f'{value!r} has more than {WEIGHT_PLACES} decimal places.')
+    return rounded
+
+
+def _integer_weights(numbers):
+    # Every weight has WEIGHT_PLACES places at most; scale them all by that.
+    return [int(number.scaleb(WEIGHT_PLACES)) for number in numbers]
+
+
+def parse(spec):
+    """(type, [member ids], [weights as Decimal]) from a raw spec; raises SplitError."""
+    if not isinstance(spec, dict):
+        raise SplitError('Expected an object with "type" and "members".')
+    kind = spec.get('type')
+    if kind not in TYPES:
+        raise SplitError(f'"type" must be one of {", ".join(TYPES)}.')
+    members = spec.get('members')
+
+    if kind == 'equal':
+        if not isinstance(members, list):
+            raise SplitError('"members" must be a list of member ids.')
+        member_ids = [_member_id(value) for value in members]
+        weights = [Decimal(1)] * len(member_ids)
+    else:
+        if not isinstance(members, dict):
+            raise SplitError('"members" must map member ids to numbers.')
+        member_ids = [_member_id(key) for key in members]
+        weights = [_number(value) for value in members.values()]
+
+    if not member_ids:
+        raise SplitError('"members" is empty.')
+    if len(member_ids) > MAX_MEMBERS:
+        raise SplitError(f'At most {MAX_MEMBERS} members per split.')
+    if len(set(member_ids)) != len(member_ids):
+        raise SplitError('A member is listed more than once.')
+    return kind, member_ids, weights
+
+
+def expand(spec, amount):
+    """[(member id, units owed)] for ``spec`` over ``amount``; raises SplitError."""
+    kind, member_ids, weights = parse(spec)
+    total = total_units(amount)
+    if total < 0:
+        raise SplitError('The amount must not be negative.')
+
+    if kind == 'exact':
+        if any(weight != weight.to_integral_value() for weight in weights):
+            raise SplitError('Exact amounts must be whole units.')
+        parts = [int(weight) for weight in weights]
+        if sum(parts) != total:
+            raise SplitError(f'Exact amounts add up to {sum(parts)}, not {total}.')
+        return list(zip(member_ids, parts))
+
+    if kind == 'percentage' and sum(weights) != 100:
+        raise SplitError(f'Percentages add up to {sum(weights)}, not 100.')
+    if not any(weights):
+        raise SplitError('At least one weight must be positive.')
+    return list(zip(member_ids, largest_remainder(total, _integer_weights(weights))))
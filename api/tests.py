@@ -1,3 +1,981 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gc
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Sum
+from unittest import mock, skipUnless
+
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (
+    archive, balances, checkpoints, db_pool, events, load_shedding, locks, membership, metrics, middleware, push,
+    recurring, rollups, sharding, splits,
+)
+from .db_routers import PrimaryReplicaRouter
+from .idempotency import idempotent
+from .models import (
+    ArchivedExpense, ArchivedExpenseSplit, BalanceCheckpoint, Expense, ExpenseSplitBetween, Friend, Group, Member,
+    RecurringExpense, Request, Settlement, SpendRollup,
+)
+from .renderers import FastJSONRenderer
+from .serializers import GroupExpenseSerializer
+
+
+class LedgerMixin:
+    # GETs are routed to the replica, and group rows to shards when set.
+    databases = '__all__'
+
+    def setUp(self):
+        # Membership and other cached state must not leak between tests.
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def add_expense(self, payer, amount, owed, **extra):
+        response = self.client_for(payer).post('/api/expenses/add/', {
+            'description': 'dinner', 'amount': amount,
+            'owe_list': [{'username': user.username, 'amount_owed': str(units)} for user, units in owed],
+            **extra,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        group = Group.objects.filter(name=extra['group']).first() if extra.get('group') else None
+        with sharding.for_group(group and group.id):
+            return Expense.objects.latest('id')
+
+    def settle(self, payer, payee, amount):
+        response = self.client_for(payer).post('/api/settle-up/', {'to_user_id': payee.id, 'amount': amount}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def add_group(self, name, *users, alias=None):
+        group = Group.objects.create(name=name)
+        with sharding.using(alias or sharding.shard_for_group(group.id)):
+            for user in users:
+                Member.objects.create(group=group, user=user, name=user.username)
+        return group
+
+
+# With shards, reads fan out to worker threads whose connections only see
+# committed rows, so tests have to commit.
+class LedgerTestCase(LedgerMixin, TransactionTestCase if sharding.enabled() else TestCase):
+    pass
+
+
+class ExpenseEditTests(LedgerTestCase):
+    def edit(self, expense, owed):
+        response = self.client_for(self.alice).patch(f'/api/expenses/{expense.id}/', {
+            'owe_list': [{'username': user.username, 'amount_owed': str(units)} for user, units in owed],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return ExpenseSplitBetween.objects.get(expense=expense, owe_id=self.bob)
+
+    def test_edit_after_settle_up_moves_only_the_outstanding_amount(self):
+        expense = self.add_expense(self.alice, 100, [(self.bob, 100)])
+        self.settle(self.bob, self.alice, 60)
+
+        split = self.edit(expense, [(self.bob, 100)])
+        self.assertEqual((split.amount_owed, split.original_amount), (40, 100))
+
+        split = self.edit(expense, [(self.bob, 120)])
+        self.assertEqual((split.amount_owed, split.original_amount), (60, 120))
+
+        # Less than was already paid: nothing is owed, nothing goes negative.
+        split = self.edit(expense, [(self.bob, 30)])
+        self.assertEqual((split.amount_owed, split.original_amount), (0, 30))
+
+        self.assertEqual(SpendRollup.objects.get(user=self.bob, group=None).share, 30)
+
+
+class RollupTests(LedgerTestCase):
+    def test_rebuild_counts_shares_as_recorded(self):
+        self.add_expense(self.alice, 100, [(self.bob, 100)])
+        self.settle(self.bob, self.alice, 60)
+        recorded = sorted(SpendRollup.objects.values_list('user_id', 'share', 'paid', 'settled_paid'))
+
+        rollups.rebuild()
+        self.assertEqual(sorted(SpendRollup.objects.values_list('user_id', 'share', 'paid', 'settled_paid')), recorded)
+        self.assertEqual(SpendRollup.objects.get(user=self.bob).share, 100)
+
+    def test_one_group_less_row_per_user_and_month(self):
+        month = rollups.month_of(timezone.now())
+        rollups.bump_many({(None, self.bob.id, month): {'share': 5}})
+        rollups.bump_many({(None, self.bob.id, month): {'share': 7}})
+        rollups.bump(None, self.bob.id, month, share=1)
+        self.assertEqual(list(SpendRollup.objects.filter(user=self.bob).values_list('share', flat=True)), [13])
+
+
+# The balances endpoint reads through the replica, which only sees committed rows.
+class GroupBalanceTests(LedgerMixin, TransactionTestCase):
+    def per_row_balances(self, group):
+        """The pre-engine computation: walk every split and settlement row."""
+        net, pairs = {}, {}
+
+        def add(debtor, creditor, amount):
+            if debtor == creditor:
+                return
+            net[creditor] = net.get(creditor, 0) + amount
+            net[debtor] = net.get(debtor, 0) - amount
+            low, high = sorted((debtor, creditor))
+            pairs[low, high] = pairs.get((low, high), 0) + (amount if debtor == low else -amount)
+
+        with sharding.for_group(group.id):
+            for split in ExpenseSplitBetween.objects.filter(expense__group=group).select_related('expense'):
+                add(split.owe_id_id, split.expense.paid_by_id, split.amount_owed * balances.MINOR_UNITS)
+            for settlement in Settlement.objects.filter(group=group):
+                add(settlement.from_user_id, settlement.to_user_id, -int(settlement.amount * balances.MINOR_UNITS))
+        return net, pairs
+
+    def test_engine_matches_the_per_row_computation(self):
+        carol = User.objects.create_user('carol')
+        group = self.add_group('trip', self.alice, self.bob, carol)
+        self.add_expense(self.alice, 900, [(self.alice, 300), (self.bob, 300), (carol, 300)], group='trip')
+        self.add_expense(self.bob, 250, [(self.alice, 125), (carol, 125)], group='trip')
+        self.add_expense(carol, 80, [(self.bob, 80)], group='trip')
+        self.add_expense(self.alice, 40, [(self.bob, 40)])
+        self.settle(self.bob, self.alice, 100)
+        response = self.client_for(carol).post(f'/api/group/{group.id}/settleup/', {
+            'settlements': [{'to_user': self.alice.id, 'amount': '1.50'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+
+        net, pairs = self.per_row_balances(group)
+        with sharding.for_group(group.id):
+            engine = balances.compute_group_balances(group.id)
+        self.assertEqual(
+            {user: amount for user, amount in zip(engine.users.tolist(), engine.net.tolist()) if amount},
+            {user: amount for user, amount in net.items() if amount},
+        )
+        expected = {
+            (low, high) if amount > 0 else (high, low): abs(amount) for (low, high), amount in pairs.items() if amount
+        }
+        self.assertEqual(
+            dict(zip(zip(engine.pair_from.tolist(), engine.pair_to.tolist()), engine.pair_amount.tolist())), expected,
+        )
+
+        payload = self.client_for(self.bob).get(f'/api/group/{group.id}/balances/').data
+        self.assertEqual(payload['users'], sorted((self.alice.id, self.bob.id, carol.id)))
+        self.assertEqual(payload['net'], [balances.to_major(net.get(user, 0)) for user in payload['users']])
+
+
+class RecurringTests(LedgerTestCase):
+    def test_run_writes_due_occurrences_once(self):
+        group = self.add_group('flat', self.alice, self.bob)
+        today = timezone.localdate()
+        with sharding.for_group(group.id):
+            members = list(Member.objects.filter(group=group).order_by('id').values_list('id', flat=True))
+            RecurringExpense.objects.create(
+                group=group, paid_by=self.alice, description='rent', amount='10.00', interval='daily',
+                split={'type': 'equal', 'members': members}, starts_on=today - datetime.timedelta(days=2),
+                next_run=today - datetime.timedelta(days=2),
+            )
+            self.assertEqual(recurring.run(today), (1, 3, 0))
+            self.assertEqual(recurring.run(today), (0, 0, 0))
+
+            expenses = Expense.objects.filter(recurring__isnull=False)
+            self.assertEqual(sorted(expenses.values_list('occurrence', flat=True)), [
+                today - datetime.timedelta(days=days) for days in (2, 1, 0)
+            ])
+            self.assertEqual(list(ExpenseSplitBetween.objects.filter(expense__in=expenses).values_list(
+                'owe_id', 'amount_owed', 'original_amount',
+            ).distinct()), [(self.bob.id, 5, 5)])
+            self.assertEqual(SpendRollup.objects.get(group=group, user=self.bob).share, 15)
+            # Written as a raw value; it must read back as the same instant.
+            self.assertLess(abs(timezone.now() - expenses.first().created_at), datetime.timedelta(minutes=1))
+
+
+# The replica is a connection of its own, which only sees committed rows.
+class ReplicaRoutingTests(LedgerMixin, TransactionTestCase):
+    def routed_get(self, user, url):
+        """The response to a GET and the databases its reads went to."""
+        routed = []
+        db_for_read = PrimaryReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            routed.append(db_for_read(router, model, **hints))
+            return routed[-1]
+
+        with mock.patch.object(PrimaryReplicaRouter, 'db_for_read', spy):
+            response = self.client_for(user).get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, set(routed) - {None}
+
+    def test_reads_use_the_replica_until_the_reader_writes(self):
+        Friend.objects.create(user1=self.alice, user2=self.bob)
+        response, routed = self.routed_get(self.bob, '/api/friends/')
+        self.assertEqual(routed, {'replica'})
+        self.assertEqual([user['username'] for user in response.data], ['alice'])
+
+        # A writer is pinned to the primary for REPLICA_PIN_SECONDS; others are not.
+        self.add_expense(self.alice, 20, [(self.bob, 20)])
+        _, routed = self.routed_get(self.alice, '/api/friends/')
+        self.assertEqual(routed, {'default'})
+        _, routed = self.routed_get(self.bob, '/api/friends/')
+        self.assertEqual(routed, {'replica'})
+
+
+class ConnectionCheckoutTests(TransactionTestCase):
+    def test_first_query_of_a_request_is_a_timed_checkout(self):
+        connection = connections['default']
+        connection.ensure_connection()
+        before = db_pool.stats()['default']['checkouts']
+
+        with mock.patch.object(connection, 'health_check_enabled', True):
+            # What request_started does before each request.
+            close_old_connections()
+            User.objects.exists()
+            User.objects.exists()
+
+        stats = db_pool.stats()['default']
+        self.assertEqual(stats['checkouts'], before + 1)
+        self.assertGreater(stats['checkout_seconds'], 0)
+
+
+# Token authentication looks the user up on the replica, which only sees
+# committed rows.
+@mock.patch.object(load_shedding, 'ENABLED', True)
+class LoadSheddingTests(LedgerMixin, TransactionTestCase):
+    def limit(self, **limits):
+        return mock.patch.dict(load_shedding.LIMITS, {
+            route: {'rate': None, 'burst': None, 'concurrency': None, **route_limits}
+            for route, route_limits in limits.items()
+        })
+
+    def bearer_client(self, user):
+        # The middleware reads the user from the token, not from DRF.
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return client
+
+    def test_empty_bucket_answers_429_with_retry_after(self):
+        client = self.bearer_client(self.alice)
+        with self.limit(read={'rate': 0.01, 'burst': 2}):
+            statuses = [client.get('/api/friends/').status_code for _ in range(3)]
+            response = client.get('/api/friends/')
+            other = self.bearer_client(self.bob).get('/api/friends/')
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertGreaterEqual(int(response['Retry-After']), 90)
+        self.assertEqual(other.status_code, 200)
+
+    def test_full_route_answers_503_and_a_failing_view_gives_its_slot_back(self):
+        client = self.bearer_client(self.alice)
+        inflight = load_shedding.INFLIGHT_KEY.format('expensive')
+        with self.limit(expensive={'concurrency': 1}):
+            self.assertIsNone(load_shedding.admit(None, 'expensive'))
+            response = client.get('/api/balance/')
+            self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+            load_shedding.release('expensive')
+
+            with mock.patch.object(checkpoints, 'user_balance_totals', side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    client.get('/api/balance/')
+            self.assertEqual(cache.get(inflight), 0)
+            self.assertEqual(client.get('/api/balance/').status_code, 200)
+
+    @mock.patch.object(load_shedding, 'INFLIGHT_TTL', 1)
+    def test_slot_count_lives_while_slots_change_and_never_goes_negative(self):
+        inflight = load_shedding.INFLIGHT_KEY.format('expensive')
+        self.assertIsNone(load_shedding.admit(None, 'expensive'))
+        time.sleep(0.6)
+        self.assertIsNone(load_shedding.admit(None, 'expensive'))
+        time.sleep(0.6)
+        # Past the TTL set by the first slot; the second one restarted it.
+        self.assertEqual(cache.get(inflight), 2)
+
+        load_shedding.release('expensive')
+        load_shedding.release('expensive')
+        load_shedding._give_slot(cache, 'expensive')
+        self.assertEqual(cache.get(inflight), 0)
+
+    def test_batch_items_meet_the_limits(self):
+        with self.limit(read={'rate': 0.01, 'burst': 2}):
+            response = self.bearer_client(self.alice).post('/api/batch/', {
+                'requests': [{'method': 'GET', 'path': '/api/friends/'}] * 3,
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        results = response.data['responses']
+        self.assertEqual(sorted(result['status'] for result in results), [200, 200, 429])
+        rejected = next(result for result in results if result['status'] == 429)
+        self.assertIn('Retry-After', rejected['headers'])
+
+    def test_racing_requests_take_each_token_once(self):
+        shared = load_shedding.caches[load_shedding.CACHE]
+        get = shared.get
+
+        def slow_get(*args, **kwargs):
+            # Widens the gap between reading a bucket and writing it back.
+            value = get(*args, **kwargs)
+            time.sleep(0.001)
+            return value
+
+        def take(_):
+            return load_shedding._take_token(shared, self.alice.id, 'read', 0.001, 50)
+
+        with mock.patch.object(shared, 'get', slow_get), ThreadPoolExecutor(max_workers=8) as pool:
+            waits = list(pool.map(take, range(200)))
+        self.assertEqual(waits.count(0), 50)
+
+
+class FailingWriteView(APIView):
+    @idempotent
+    def post(self, request):
+        Group.objects.create(name='written before failing')
+        return Response({'error': 'upstream unavailable'}, status=503)
+
+
+class MetricsAccessTests(SimpleTestCase):
+    @override_settings(METRICS_TOKEN=None)
+    def test_closed_without_a_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_needs_the_bearer_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret').status_code, 200)
+
+
+class MetricsShardTests(SimpleTestCase):
+    def test_exited_threads_fold_into_one_shard(self):
+        key = ('splitzy_test_threads_total', ())
+        before = metrics.snapshot()['counters'].get(key, 0)
+        shards = len(metrics._shards)
+
+        for _ in range(20):
+            thread = threading.Thread(target=metrics.inc, args=('splitzy_test_threads_total',))
+            thread.start()
+            thread.join()
+        gc.collect()
+
+        self.assertLessEqual(len(metrics._shards), shards + 1)
+        self.assertEqual(metrics.snapshot()['counters'][key], before + 20)
+
+
+class IdempotencyTests(LedgerMixin, TestCase):
+    def test_a_returned_5xx_is_replayed_not_rerun(self):
+        responses = []
+        for _ in range(2):
+            request = APIRequestFactory().post('/api/failing/', {}, format='json', HTTP_IDEMPOTENCY_KEY='retry-1')
+            force_authenticate(request, self.alice)
+            responses.append(FailingWriteView.as_view()(request))
+
+        self.assertEqual([response.status_code for response in responses], [503, 503])
+        self.assertEqual(responses[1]['Idempotent-Replayed'], 'true')
+        self.assertEqual(Group.objects.filter(name='written before failing').count(), 1)
+
+
+# Searches read through the replica, which only sees committed rows.
+class SearchTests(LedgerMixin, TransactionTestCase):
+    def search(self, user, text):
+        response = self.client_for(user).get('/api/search/', {'q': text})
+        self.assertEqual(response.status_code, 200)
+        return sorted(hit.get('description') or hit.get('remark') for hit in response.data['results'])
+
+    def test_scoped_to_groups_and_friends(self):
+        carol = User.objects.create_user('carol', password='pw')
+        Friend.objects.create(user1=self.alice, user2=self.bob)
+        group = self.add_group('trip', self.bob, carol)
+        self.add_expense(self.alice, 30, [(self.bob, 30)], description='hotel goa')
+        self.add_expense(carol, 30, [(self.bob, 30)], description='hotel paris', group=group.name)
+        # Carol is not Bob's friend; outside the group their expense stays hidden.
+        self.add_expense(carol, 30, [(self.bob, 30)], description='hotel rome')
+
+        self.assertEqual(self.search(self.bob, 'hotel'), ['hotel goa', 'hotel paris'])
+        self.assertEqual(self.search(self.alice, 'hotel'), ['hotel goa'])
+
+
+# List endpoints read through the replica, which only sees committed rows.
+class SparseFieldsTests(LedgerMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = self.add_group('flat', self.alice, self.bob)
+        self.expense = self.add_expense(self.alice, 100, [(self.bob, 100)], group='flat', description='rent')
+
+    def get(self, user, url, **params):
+        response = self.client_for(user).get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_group_expenses(self):
+        url = f'/api/group/{self.group.id}/expenses/'
+        full = self.get(self.bob, url)
+        with sharding.for_group(self.group.id):
+            serialized = GroupExpenseSerializer(Expense.objects.filter(group=self.group), many=True).data
+        self.assertEqual(full, serialized)
+
+        self.assertEqual(
+            self.get(self.bob, url, fields='id,paid_by'), [{'id': self.expense.id, 'paid_by': self.alice.id}],
+        )
+        self.assertEqual(
+            self.get(self.bob, url, fields='paid_by', expand='paid_by'),
+            [{'paid_by': {'id': self.alice.id, 'username': 'alice'}}],
+        )
+        self.assertEqual(
+            self.get(self.bob, url, fields='description,splits'),
+            [{'description': 'rent', 'splits': [{'owe_id': self.bob.id, 'amount_owed': 100}]}],
+        )
+        self.assertEqual(
+            self.get(self.bob, url, fields='splits', expand='splits'),
+            [{'splits': [{'owe_id': {'id': self.bob.id, 'username': 'bob'}, 'amount_owed': 100}]}],
+        )
+
+    def test_settlements_and_expense_feed(self):
+        self.settle(self.bob, self.alice, 40)
+        self.assertEqual(
+            self.get(self.alice, '/api/settlements/', fields='amount,from_user_username'),
+            [{'amount': '40.00', 'from_user_username': 'bob'}],
+        )
+        feed = self.get(self.alice, '/api/expenses/all/', fields='id,description')
+        self.assertEqual(feed['paid'], [{'id': self.expense.id, 'description': 'rent'}])
+        feed = self.get(self.bob, '/api/expenses/all/', fields='description,paid_by')
+        self.assertEqual(feed['owed'], [{'description': 'rent', 'paid_by': 'alice'}])
+
+    def test_requests_collapse_users_unless_expanded(self):
+        response = self.client_for(self.alice).post('/api/friend-requests/', {'to_user_id': self.bob.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/friend-requests/'
+
+        results = self.get(self.bob, url, fields='from_user,status')['results']
+        self.assertEqual(results, [{'from_user': self.alice.id, 'status': 'pending'}])
+        results = self.get(self.bob, url, fields='from_user', expand='from_user')['results']
+        self.assertEqual(results, [{'from_user': {'id': self.alice.id, 'username': 'alice', 'email': ''}}])
+
+
+# Both endpoints read through the replica, which only sees committed rows.
+class OutstandingDebtTests(LedgerMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create_user('carol')
+        self.add_group('trip', self.bob, self.carol)
+        self.add_expense(self.alice, 100, [(self.bob, 100)], description='rent')
+        self.add_expense(self.alice, 50, [(self.bob, 50)], description='power')
+        self.add_expense(self.carol, 60, [(self.bob, 60)], description='tickets', group='trip')
+        self.add_expense(self.bob, 20, [(self.alice, 20)], description='coffee')
+        self.settle(self.bob, self.alice, 120)
+
+    def test_owed_groups_outstanding_splits_by_creditor(self):
+        response = self.client_for(self.bob).get('/api/owed/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total'], 90)
+        creditors = response.data['creditors']
+        self.assertEqual(
+            [(entry['user'], entry['total'], entry['count']) for entry in creditors],
+            [({'id': self.carol.id, 'username': 'carol'}, 60, 1), ({'id': self.alice.id, 'username': 'alice'}, 30, 1)],
+        )
+        self.assertEqual(
+            [(row['description'], row['amount_owe'], row['group']) for entry in creditors for row in entry['expenses']],
+            [('tickets', 60, 'trip'), ('power', 30, None)],
+        )
+
+    def test_owed_expenses_hide_settled_splits_unless_asked(self):
+        client = self.client_for(self.bob)
+        url = f'/api/owed-expenses/{self.bob.id}/'
+        self.assertEqual(sorted(row['description'] for row in client.get(url).data), ['power', 'tickets'])
+        self.assertEqual(
+            sorted(row['description'] for row in client.get(url, {'include_settled': 'true'}).data),
+            ['power', 'rent', 'tickets'],
+        )
+        self.assertEqual(client.get(f'/api/owed-expenses/{self.alice.id}/').status_code, 403)
+
+
+# The inbox reads through the replica, which only sees committed rows.
+class InboxTests(LedgerMixin, TransactionTestCase):
+    def send_requests(self, count, prefix='sender'):
+        for i in range(count):
+            sender = User.objects.create_user(f'{prefix}{i}')
+            response = self.client_for(sender).post('/api/friend-requests/', {'to_user_id': self.bob.id}, format='json')
+            self.assertEqual(response.status_code, 201)
+
+    def badge(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.bob)}')
+        return client.get('/api/friend-requests/count/').data['pending']
+
+    def test_pages_newest_first(self):
+        self.send_requests(5)
+        client = self.client_for(self.bob)
+        pages = [client.get('/api/friend-requests/', {'page': page, 'page_size': 2}).data for page in (1, 2, 3)]
+
+        self.assertEqual([page['has_more'] for page in pages], [True, True, False])
+        senders = [row['from_user']['username'] for page in pages for row in page['results']]
+        self.assertEqual(senders, [f'sender{i}' for i in reversed(range(5))])
+        self.assertEqual(client.get('/api/friend-requests/', {'page': 'x'}).status_code, 400)
+        self.assertEqual(client.get('/api/friend-requests/', {'status': 'lost'}).status_code, 400)
+
+    @mock.patch.object(membership, 'cache_is_shared', return_value=True)
+    def test_badge_count_is_cached_and_dropped_on_change(self, _):
+        self.send_requests(2)
+        self.assertEqual(self.badge(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.badge(), 2)
+
+        self.send_requests(1, prefix='late')
+        self.assertEqual(self.badge(), 3)
+        request = sharding.gather(lambda: list(Request.objects.filter(to_user=self.bob)))[0]
+        request.status = 'accepted'
+        request.save()
+        self.assertEqual(self.badge(), 2)
+
+
+class GroupMembershipTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create_user('carol', password='pw')
+        self.group = self.add_group('flat', self.alice, self.bob)
+
+    def test_non_member_is_refused_on_every_group_view(self):
+        client = self.client_for(self.carol)
+        group_id = self.group.id
+        for method, url in [
+            ('get', f'/api/group/{group_id}/members/'),
+            ('get', f'/api/group/{group_id}/expenses/'),
+            ('get', f'/api/group/{group_id}/settlements/'),
+            ('get', f'/api/group/{group_id}/balances/'),
+            ('get', f'/api/group/{group_id}/analytics/'),
+            ('get', f'/api/group/{group_id}/recurring/'),
+            ('post', f'/api/group/{group_id}/recurring/'),
+            ('delete', f'/api/group/{group_id}/recurring/1/'),
+            ('post', f'/api/group/{group_id}/settleup/'),
+        ]:
+            with self.subTest(method=method, url=url):
+                self.assertEqual(getattr(client, method)(url, {}, format='json').status_code, 403)
+
+        response = client.post('/api/expenses/add/', {
+            'description': 'gatecrash', 'amount': 10, 'group': self.group.name,
+            'owe_list': [{'username': 'alice', 'amount_owed': '10'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch.object(membership, 'cache_is_shared', return_value=True)
+    def test_warm_membership_check_runs_no_queries(self, _):
+        membership.is_member(self.alice.id, self.group.id)
+        membership.is_member(self.carol.id, self.group.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(self.alice.id, self.group.id))
+            self.assertFalse(membership.is_member(self.carol.id, self.group.id))
+
+    def test_per_process_cache_is_not_trusted_for_membership(self):
+        self.assertFalse(membership.is_member(self.carol.id, self.group.id))
+        # A write made in another worker: its invalidation never reaches this
+        # process's LocMem cache.
+        with sharding.for_group(self.group.id):
+            Member.objects.bulk_create([Member(group=self.group, user=self.carol, name='carol')])
+        self.assertTrue(membership.is_member(self.carol.id, self.group.id))
+
+    def test_group_settle_up_is_from_the_caller_to_members(self):
+        client = self.client_for(self.alice)
+        url = f'/api/group/{self.group.id}/settleup/'
+        response = client.post(url, {
+            'from_user': self.bob.id, 'settlements': [{'to_user': self.bob.id, 'amount': '5.00'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        with sharding.for_group(self.group.id):
+            settlement = Settlement.objects.get()
+        self.assertEqual((settlement.from_user_id, settlement.to_user_id), (self.alice.id, self.bob.id))
+
+        response = client.post(url, {'settlements': [{'to_user': self.carol.id, 'amount': '5.00'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        with sharding.for_group(self.group.id):
+            self.assertEqual(Settlement.objects.count(), 1)
+
+
+# Feeds and balances read through the replica, which only sees committed rows.
+class ArchiveTests(LedgerMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = self.add_group('flat', self.alice, self.bob)
+        self.settled = self.add_expense(self.alice, 100, [(self.bob, 100)], group='flat', description='old rent')
+        self.settle(self.bob, self.alice, 100)
+        self.open = self.add_expense(self.alice, 30, [(self.bob, 30)], group='flat', description='groceries')
+        with sharding.for_group(self.group.id):
+            Expense.objects.filter(id=self.settled.id).update(
+                created_at=timezone.now() - datetime.timedelta(days=200), occurrence=datetime.date(2026, 3, 1),
+            )
+            self.settled.split_between.add(*Member.objects.filter(group=self.group))
+
+    def feed(self, user, **params):
+        response = self.client_for(user).get('/api/expenses/all/', params)
+        self.assertEqual(response.status_code, 200)
+        return {half: sorted(row['description'] for row in rows) for half, rows in response.data.items()}
+
+    def test_archive_round_trip(self):
+        with sharding.for_group(self.group.id):
+            self.assertEqual(ExpenseSplitBetween.objects.get(expense=self.settled).amount_owed, 0)
+        balances = [self.client_for(user).get('/api/balance/').data for user in (self.alice, self.bob)]
+        with sharding.for_group(self.group.id):
+            rollups.rebuild()
+            recorded = sorted(SpendRollup.objects.values_list('user_id', 'month', 'share', 'paid', 'settled_paid'))
+
+        with sharding.for_group(self.group.id):
+            self.assertEqual(archive.archive_settled(), 1)
+
+        with sharding.for_group(self.group.id):
+            self.assertFalse(Expense.objects.filter(id=self.settled.id).exists())
+            archived = ArchivedExpense.objects.get(id=self.settled.id)
+            self.assertEqual(archived.occurrence, datetime.date(2026, 3, 1))
+            self.assertEqual(sorted(archived.split_between.values_list('user_id', flat=True)), [self.alice.id, self.bob.id])
+            self.assertEqual(list(ArchivedExpenseSplit.objects.values_list('owe_id', 'original_amount')), [(self.bob.id, 100)])
+            rollups.rebuild()
+            self.assertEqual(sorted(SpendRollup.objects.values_list('user_id', 'month', 'share', 'paid', 'settled_paid')), recorded)
+        self.assertEqual([self.client_for(user).get('/api/balance/').data for user in (self.alice, self.bob)], balances)
+
+        self.assertEqual(self.feed(self.alice), {'paid': ['groceries'], 'owed': []})
+        self.assertEqual(self.feed(self.alice, include_archived=1), {'paid': ['groceries', 'old rent'], 'owed': []})
+        self.assertEqual(self.feed(self.bob, include_archived=1), {'paid': [], 'owed': ['groceries']})
+        self.assertEqual(
+            self.feed(self.bob, include_archived=1, include_settled=1), {'paid': [], 'owed': ['groceries', 'old rent']},
+        )
+        group_feed = self.client_for(self.bob).get(f'/api/group/{self.group.id}/expenses/', {'include_archived': 1})
+        self.assertEqual([row['description'] for row in group_feed.data], ['groceries', 'old rent'])
+
+
+# TestCase even with shards: nothing here fans out, and the commit hooks are captured.
+class CheckpointTests(LedgerMixin, TestCase):
+    def split(self, split_id, expense, units):
+        return ExpenseSplitBetween.objects.create(
+            id=split_id, expense=expense, owe_id=self.bob, amount_owed=units, original_amount=units,
+        )
+
+    def test_rows_committing_below_the_top_id_are_not_lost(self):
+        group = self.add_group('flat', self.alice, self.bob)
+        with sharding.for_group(group.id):
+            expense = Expense.objects.create(group=group, description='rent', amount=50, paid_by=self.alice)
+            self.split(10, expense, 20)
+            checkpoint = checkpoints.take_group_checkpoint(group.id)
+            # Id 5 was handed out before the checkpoint but committed after it.
+            self.split(5, expense, 30)
+            self.assertTrue(checkpoints.verify(checkpoint))
+            self.assertEqual(checkpoints.group_balances(group.id).pair_amount.tolist(), [50 * 100])
+
+    def test_due_checkpoints_are_retaken_after_commit_not_in_the_request(self):
+        with mock.patch.object(checkpoints, 'CHECKPOINT_EVERY', 2):
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.add_expense(self.alice, 10, [(self.bob, 10)])
+                self.add_expense(self.alice, 10, [(self.bob, 10)])
+            checkpoint = BalanceCheckpoint.objects.get(user1=self.alice, user2=self.bob)
+            self.assertEqual((checkpoint.writes_since, checkpoint.entries.count()), (2, 0))
+            self.assertIn('_retake_later', {callback.__qualname__.split('.')[0] for callback in callbacks})
+
+            # What the callback hands to the background thread.
+            self.assertEqual(checkpoints.retake_due(sharding.HOME), 1)
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.writes_since, 0)
+        self.assertTrue(checkpoints.verify(checkpoint))
+
+
+class ConcurrentSettleUpTests(LedgerMixin, TransactionTestCase):
+    """Settle-ups racing each other from a thread pool lose no update."""
+
+    def owed(self, user):
+        return ExpenseSplitBetween.objects.filter(owe_id=user).aggregate(total=Sum('amount_owed'))['total'] or 0
+
+    def settle_in_thread(self, pair):
+        debtor, creditor = pair
+        try:
+            response = self.client_for(debtor).post(
+                '/api/settle-up/', {'to_user_id': creditor.id, 'amount': '7'}, format='json',
+            )
+            return response.status_code
+        finally:
+            connections.close_all()
+
+    def test_concurrent_settle_ups_keep_balances_consistent(self):
+        pairs = [(self.bob, self.alice)]
+        for i in range(2):
+            pairs.append((User.objects.create_user(f'debtor{i}'), User.objects.create_user(f'creditor{i}')))
+        for debtor, creditor in pairs:
+            for _ in range(10):
+                self.add_expense(creditor, 100, [(debtor, 100)])
+        owed_before = {debtor.id: self.owed(debtor) for debtor, _ in pairs}
+
+        jobs = [pairs[i % len(pairs)] for i in range(60)]
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            statuses = list(pool.map(self.settle_in_thread, jobs))
+
+        self.assertEqual(statuses, [200] * len(jobs))
+        for debtor, creditor in pairs:
+            with self.subTest(debtor=debtor.username):
+                settled = Settlement.objects.filter(from_user=debtor, to_user=creditor).aggregate(
+                    total=Sum('amount'),
+                )['total']
+                self.assertEqual(settled, 7 * jobs.count((debtor, creditor)))
+                self.assertEqual(owed_before[debtor.id] - self.owed(debtor), settled)
+                user1, user2 = sorted((debtor.id, creditor.id))
+                checkpoint = BalanceCheckpoint.objects.get(user1_id=user1, user2_id=user2)
+                self.assertTrue(checkpoints.verify(checkpoint))
+
+    @mock.patch.object(locks, 'LOCAL_LOCK_TIMEOUT', 0.5)
+    def test_lock_inside_a_transaction_times_out_instead_of_deadlocking(self):
+        scope = locks.pair_scope(self.alice.id, self.bob.id)
+        stripe = locks._stripes[locks.scope_key(scope) % locks.LOCAL_STRIPES]
+        holding, writing = threading.Event(), threading.Event()
+
+        def hold_stripe_then_write():
+            # ledger_lock between taking its stripe and beginning its transaction.
+            try:
+                with stripe:
+                    holding.set()
+                    writing.wait()
+                    # Blocks on the write lock the main thread's transaction holds.
+                    Group.objects.create(name='written by the lock holder')
+            finally:
+                connections.close_all()
+
+        holder = threading.Thread(target=hold_stripe_then_write)
+        holder.start()
+        holding.wait()
+        # The shape of a view under @idempotent: a transaction, then the lock.
+        try:
+            with self.assertRaises(locks.LedgerLockTimeout):
+                with transaction.atomic():
+                    Group.objects.create(name='written by the idempotent request')
+                    writing.set()
+                    with locks.ledger_lock(scope):
+                        pass
+        finally:
+            writing.set()
+            holder.join()
+
+        self.assertEqual(list(Group.objects.values_list('name', flat=True)), ['written by the lock holder'])
+
+        self.assertEqual(list(Group.objects.values_list('name', flat=True)), ['written by the lock holder'])
+
+
+class SplitSpecTests(SimpleTestCase):
+    def shares(self, weight):
+        return splits.expand({'type': 'shares', 'members': {'1': weight, '2': 1}}, 100)
+
+    def test_weights_are_bounded(self):
+        for weight in ('1e-999999', '1e999999', 1e308, '1.005', '10000000000', 'NaN', '-1', 'x'):
+            with self.subTest(weight=weight), self.assertRaises(splits.SplitError):
+                self.shares(weight)
+
+    def test_weights_within_bounds(self):
+        self.assertEqual(self.shares('1.500'), [(1, 60), (2, 40)])
+        self.assertEqual(self.shares('9999999999.99'), [(1, 100), (2, 0)])
+        self.assertEqual(
+            splits.expand({'type': 'percentage', 'members': {'1': '33.33', '2': '33.33', '3': '33.34'}}, 100),
+            [(1, 33), (2, 33), (3, 34)],
+        )
+
+
+class ReconcileTests(LedgerMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = self.add_group('trip', self.alice, self.bob)
+        self.add_expense(self.alice, 100, [(self.bob, 100)], group=self.group.name)
+        self.add_expense(self.alice, 50, [(self.bob, 50)])
+        # Pays down both splits: all of the group one, part of the other.
+        self.settle(self.bob, self.alice, 120)
+        with sharding.for_group(self.group.id):
+            checkpoints.take_group_checkpoint(self.group.id)
+        checkpoints.take_pair_checkpoint(self.alice.id, self.bob.id)
+
+    def reconcile(self, **options):
+        err = StringIO()
+        try:
+            call_command('reconcile_ledger', stdout=StringIO(), stderr=err, **options)
+        except CommandError:
+            pass
+        return sorted(err.getvalue().splitlines())
+
+    def test_clean_ledger_with_settlements_matches(self):
+        self.assertEqual(self.reconcile(workers=1), [])
+        self.assertEqual(self.reconcile(workers=2, partitions=3), [])
+
+    def test_workers_find_and_repair_the_same_mismatches(self):
+        with sharding.for_group(self.group.id):
+            SpendRollup.objects.filter(group=self.group, user=self.bob).update(share=7)
+        SpendRollup.objects.filter(group=None, user=self.alice).update(paid=1)
+
+        serial = self.reconcile(workers=1)
+        self.assertEqual(len(serial), 2)
+        self.assertEqual(self.reconcile(workers=2, partitions=3), serial)
+
+        self.reconcile(workers=2, repair=True)
+        self.assertEqual(self.reconcile(workers=1), [])
+        with sharding.for_group(self.group.id):
+            self.assertEqual(SpendRollup.objects.get(group=self.group, user=self.bob).share, 100)
+
+
+@skipUnless(sharding.enabled(), 'needs GROUP_SHARDS, e.g. LOCAL_SQLITE=True LOCAL_SQLITE_SHARDS=2')
+class ShardTests(LedgerTestCase):
+    def test_events_wait_for_the_shard_transaction(self):
+        group = self.add_group('trip', self.alice, self.bob)
+        topic = events.group_topic(group.id)
+        with mock.patch.object(events.backend(), 'publish') as publish:
+            with transaction.atomic(using=sharding.shard_for_group(group.id)), sharding.for_group(group.id):
+                events.publish([topic], 'test', {})
+                publish.assert_not_called()
+            publish.assert_called_once_with(topic, 'test', {})
+
+    def test_init_shards_moves_group_rows_off_home(self):
+        # As written before GROUP_SHARDS was set.
+        group = self.add_group('legacy', self.alice, self.bob, alias=sharding.HOME)
+        with sharding.using(sharding.HOME):
+            expense = Expense.objects.create(group=group, description='rent', amount=30, paid_by=self.alice)
+            ExpenseSplitBetween.objects.create(expense=expense, owe_id=self.bob, amount_owed=30, original_amount=30)
+
+        call_command('init_shards', stdout=StringIO())
+
+        with sharding.using(sharding.HOME):
+            self.assertFalse(Member.objects.filter(group=group).exists())
+            self.assertFalse(Expense.objects.filter(group=group).exists())
+        with sharding.for_group(group.id):
+            self.assertEqual(ExpenseSplitBetween.objects.get(expense__group=group).amount_owed, 30)
+        response = self.client_for(self.bob).get(f'/api/group/{group.id}/expenses/')
+        self.assertEqual([e['id'] for e in response.data], [expense.id])
+
+    def test_ledger_writes_run_in_a_transaction_on_the_shard(self):
+        group = self.add_group('trip', self.alice, self.bob)
+        alias = sharding.shard_for_group(group.id)
+        expense = self.add_expense(self.alice, 40, [(self.bob, 40)], group=group.name)
+        self.settle(self.bob, self.alice, 40)
+        writes = []
+
+        def spy(execute, sql, params, many, context):
+            if sql.split()[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                connection = connections[alias]
+                writes.append((sql.split('"')[1], connection.in_atomic_block, len(connection.savepoint_ids)))
+            return execute(sql, params, many, context)
+
+        with sharding.for_group(group.id), connections[alias].execute_wrapper(spy):
+            checkpoints.take_group_checkpoint(group.id)
+            checkpoints.take_pair_checkpoint(self.alice.id, self.bob.id)
+            rollups.rebuild(group.id)
+            self.assertEqual(archive.archive_batch([expense.id]), 1)
+            self.assertEqual([table for table, atomic, _ in writes if not atomic], [])
+
+            # A new rollup row is inserted under a savepoint on the shard,
+            # so a conflicting insert leaves the shard's transaction usable.
+            writes.clear()
+            with transaction.atomic(using=alias):
+                rollups.bump(group.id, self.bob.id, datetime.date(2000, 1, 1), paid=1)
+        self.assertIn(('api_spendrollup', True, 1), [write for write in writes if write[0] == 'api_spendrollup'])
+
+
+class ResponseEncodingTests(SimpleTestCase):
+    def compress(self, set_cookie=False, **headers):
+        def view(request):
+            response = HttpResponse(b'{"description": "dinner"}' * 40, content_type='application/json')
+            if set_cookie:
+                response.set_cookie('sessionid', 'secret')
+            return response
+
+        request = RequestFactory().get('/api/expenses/all/', HTTP_ACCEPT_ENCODING='gzip, br', **headers)
+        return middleware.CompressionMiddleware(view)(request)['Content-Encoding']
+
+    @skipUnless(middleware.brotli, 'brotli is not installed')
+    def test_brotli_only_without_cookies(self):
+        self.assertEqual(self.compress(HTTP_AUTHORIZATION='Bearer token'), 'br')
+        self.assertEqual(self.compress(HTTP_COOKIE='sessionid=secret'), 'gzip')
+        self.assertEqual(self.compress(set_cookie=True), 'gzip')
+
+    def test_renders_non_string_keys_like_json_renderer(self):
+        data = {1: 'alice', 2: ['bob']}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+class PushProcessTests(SimpleTestCase):
+    def test_push_only_app_leaves_the_api_to_the_wsgi_workers(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            return {'type': 'http.disconnect'}
+
+        application = push.router(push.not_found)
+        asyncio.run(application({'type': 'http', 'path': '/api/balance/', 'method': 'GET'}, receive, send))
+        self.assertEqual(sent[0]['status'], 404)
+        with self.assertRaises(ValueError):
+            asyncio.run(application({'type': 'lifespan'}, receive, send))
+
+    def test_subscribing_runs_off_the_event_loop(self):
+        backend = events.InProcessBackend()
+        subscribe, threads = backend.subscribe, []
+
+        def spy(*args, **kwargs):
+            threads.append(threading.get_ident())
+            return subscribe(*args, **kwargs)
+
+        async def scenario():
+            subscription = await push._start_subscription({'query_string': b'token=t', 'headers': []})
+            backend.publish('user:1', 'test', {})
+            event = await subscription.next(1)
+            subscription.close()
+            return threading.get_ident(), event
+
+        with mock.patch.object(events, 'backend', return_value=backend), \
+                mock.patch.object(backend, 'subscribe', spy), \
+                mock.patch.object(push, '_topics', return_value=['user:1']):
+            loop_thread, event = asyncio.run(scenario())
+        self.assertNotIn(loop_thread, threads)
+        self.assertEqual(event.type, 'test')
+
+    def test_live_copies_of_replayed_events_are_skipped(self):
+        replayed, live = events.Event(5, 'user:1', 'a', b'{}'), events.Event(6, 'user:1', 'b', b'{}')
+
+        async def scenario():
+            subscription = events.Subscription(events.InProcessBackend(), ['user:1'], [replayed])
+            subscription.deliver(replayed)
+            subscription.deliver(live)
+            return [await subscription.next(0.1) for _ in range(3)]
+
+        self.assertEqual(asyncio.run(scenario()), [replayed, live, None])
+
+
+@skipUnless(getattr(settings, 'PUSH_REDIS_URL', None), 'needs REDIS_URL')
+class RedisPushTests(SimpleTestCase):
+    def test_events_reach_subscribers_of_another_worker(self):
+        # Two backends stand for two workers sharing the Redis.
+        publisher = events.RedisBackend(buffer_size=3)
+        listener = events.RedisBackend(buffer_size=3)
+        topic = events.group_topic(f'test-{uuid.uuid4().hex}')
+
+        async def scenario():
+            first = publisher.publish(topic, 'test', {'n': 0})
+            live = listener.subscribe([topic])
+            publisher.publish(topic, 'test', {'n': 1})
+            received = await live.next(5)
+            live.close()
+
+            resumed = listener.subscribe([topic], after=first.id)
+            replayed = await resumed.next(1), await resumed.next(0.1)
+            resumed.close()
+
+            for n in range(2, 6):
+                publisher.publish(topic, 'test', {'n': n})
+            evicted = listener.subscribe([topic], after=first.id)
+            gap = await evicted.next(1)
+            evicted.close()
+            return received, replayed, gap
+
+        received, replayed, gap = asyncio.run(scenario())
+        self.assertEqual(received.body, replayed[0].body)
+        self.assertIn(b'"n":1', received.body)
+        self.assertIsNone(replayed[1])
+        self.assertIs(gap, events.RESYNC)
 
-# Create your tests here.
@@ -6,7 +6,8 @@ from .views import (
     register, login_view, UserSearchView,
     FriendRequestViewSet, FriendListView, AddExpenseView, SettleUpView, get_owed_expenses, AllRelatedExpensesView,
     ExpensesBetweenUsersView, SettlementsBetweenUsersView, GroupCreateWithInvitesView, GroupListView,
-    get_group_expenses, get_group_settlements, GroupSettleUpView, group_members,
+    get_group_expenses, get_group_settlements, GroupSettleUpView, group_members, get_group_balances,
+    get_group_analytics, get_user_analytics,
 )
 
 from rest_framework_simplejwt.views import (
@@ -26,8 +27,10 @@ urlpatterns = [
     path('search-users/', UserSearchView.as_view(), name='search-users'),
     path('friends/', FriendListView.as_view(), name='friend-list'),
     path('expenses/add/', AddExpenseView.as_view(), name='add-expense'),
+    path('expenses/<int:pk>/', views.ExpenseDetailView.as_view(), name='expense-detail'),
     path('settle-up/', SettleUpView.as_view(), name='settle-up'),
     path('owed-expenses/<int:user_id>/', get_owed_expenses),
+    path('owed/', views.get_outstanding_debts, name='outstanding-debts'),
     path('expenses/all/', AllRelatedExpensesView.as_view(), name='all_related_expenses'),
     path('expenses/with/<int:friend_id>/', ExpensesBetweenUsersView.as_view(), name='expenses-with-friend'),
     path('settlements/', views.get_settlements),
@@ -39,5 +42,13 @@ urlpatterns = [
     path('group/<int:group_id>/settlements/', get_group_settlements, name='group-settlements'),
     path('group/<int:group_id>/settleup/', GroupSettleUpView.as_view()),
     path('group/<int:group_id>/members/', group_members, name='group-members'),
+    path('group/<int:group_id>/recurring/', views.group_recurring_expenses, name='group-recurring'),
+    path('group/<int:group_id>/recurring/<int:pk>/', views.stop_recurring_expense, name='group-recurring-stop'),
+    path('group/<int:group_id>/balances/', get_group_balances, name='group-balances'),
+    path('group/<int:group_id>/analytics/', get_group_analytics, name='group-analytics'),
+    path('analytics/', get_user_analytics, name='user-analytics'),
     path('balance/', views.get_overall_balance, name='get_overall_balance'),
+    path('balance/with/<int:friend_id>/', views.get_balance_with_friend, name='balance-with-friend'),
+    path('batch/', views.BatchView.as_view(), name='batch'),
+    path('search/', views.search_ledger, name='search'),
 ]
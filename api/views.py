@@ -1,21 +1,36 @@
+import hmac
 from decimal import Decimal
 
-from django.db import transaction
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, permissions, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.decorators import api_view, action, permission_classes
 from rest_framework.response import Response
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import Count, Q, Sum
 
-from .models import Member, Request, Friend, Settlement, ExpenseSplitBetween, Expense, Group
+from . import (
+    archive, batch, checkpoints, events, expenses, fast_serializers, inbox, membership, metrics, rollups, search,
+    sharding,
+)
+from .balances import MINOR_UNITS, balances_payload, to_major
+from .idempotency import idempotent
+from .locks import ledger_lock, pair_scope
+from .membership import IsGroupMember
+from .sparse import parse_fields
+from .models import (
+    Member, Request, Friend, Settlement, ExpenseSplitBetween, Expense, Group, SpendRollup,
+    ArchivedExpense, ArchivedExpenseSplit, RecurringExpense,
+)
 from .serializers import (
     RegisterSerializer, LoginSerializer, MemberSerializer,
-    RequestSerializer, UserSerializer, ExpenseSerializer, OwedExpenseSerializer, DetailedExpenseWithSplitsSerializer,
-    SettlementSerializer, GroupSerializer, GroupSettleUpSerializer, GroupExpenseSerializer
+    RequestSerializer, UserSerializer, ExpenseSerializer, DetailedExpenseWithSplitsSerializer,
+    GroupSerializer, GroupSettleUpSerializer, ArchivedExpenseWithSplitsSerializer, RecurringExpenseSerializer,
 )
 
 @api_view(['POST'])
@@ -60,11 +75,27 @@ class UserSearchView(APIView):
         return Response(UserSerializer(users, many=True).data)
 
 
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 100
+REQUEST_STATUSES = ('pending', 'accepted', 'rejected')
+
+
+def page_params(request, default_size, max_size):
+    """(page, page_size) from the query string; ValueError if not integers."""
+    page = max(int(request.query_params.get('page', 1)), 1)
+    page_size = min(max(int(request.query_params.get('page_size', default_size)), 1), max_size)
+    return page, page_size
+
+
 class FriendRequestViewSet(viewsets.ModelViewSet):
-    queryset = Request.objects.all()
     serializer_class = RequestSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        # Only requests the caller sent or received.
+        user = self.request.user
+        return Request.objects.filter(Q(to_user=user) | Q(from_user=user))
+
     def create(self, request):
         to_user_id = request.data.get('to_user_id')
         group_id = request.data.get('group_id')  # optional
@@ -82,20 +113,22 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
             if not group:
                 return Response({'error': 'Group not found'}, status=404)
 
-            existing_request = Request.objects.filter(
-                from_user=request.user,
-                to_user=to_user,
-                group=group,
-                status='pending'
-            ).first()
-            if existing_request:
-                return Response({'message': 'Group invite already sent'}, status=400)
-
-            group_request = Request.objects.create(
-                from_user=request.user,
-                to_user=to_user,
-                group=group
-            )
+            with sharding.for_group(group.id):
+                existing_request = Request.objects.filter(
+                    from_user=request.user,
+                    to_user=to_user,
+                    group=group,
+                    status='pending'
+                ).first()
+                if existing_request:
+                    return Response({'message': 'Group invite already sent'}, status=400)
+
+                group_request = Request.objects.create(
+                    from_user=request.user,
+                    to_user=to_user,
+                    group=group
+                )
+                events.request_created(group_request)
             return Response(RequestSerializer(group_request).data, status=201)
 
 
@@ -117,19 +150,58 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
             from_user=request.user,
             to_user=to_user
         )
+        events.request_created(friend_request)
         return Response(RequestSerializer(friend_request).data, status=201)
 
+    def get_object(self):
+        # Group invites live on their group's shard; ids are unique across shards.
+        pk = self.kwargs['pk']
+        friend_request = sharding.find(lambda: self.get_queryset().filter(pk=pk).first())
+        if friend_request is None:
+            raise Http404
+        self.check_object_permissions(self.request, friend_request)
+        return friend_request
+
     def list(self, request, *args, **kwargs):
+        status_filter = request.query_params.get('status')
+        if status_filter and status_filter not in REQUEST_STATUSES:
+            return Response({'error': f"status must be one of {', '.join(REQUEST_STATUSES)}"}, status=400)
+        try:
+            page, page_size = page_params(request, INBOX_PAGE_SIZE, INBOX_MAX_PAGE_SIZE)
+        except ValueError:
+            return Response({'error': 'page and page_size must be integers'}, status=400)
+
         queryset = Request.objects.filter(to_user=request.user)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        if status_filter:
+            queryset = queryset.filter(status=status_filter)
+        queryset = RequestSerializer.sparse_queryset(queryset.order_by('-created_at', '-id'), request)
+        # Each database's newest page_size * page + 1 are enough to fill
+        # the page after merging.
+        limit = page * page_size + 1
+        rows = sharding.gather(lambda: list(queryset[:limit]))
+        if sharding.enabled():
+            rows.sort(key=lambda r: (r.created_at, r.id), reverse=True)
+        start = (page - 1) * page_size
+        return Response({
+            'results': self.get_serializer(rows[start:start + page_size], many=True).data,
+            'page': page,
+            'page_size': page_size,
+            'has_more': len(rows) > start + page_size,
+        })
+
+    @action(detail=False, methods=['get'], url_path='count',
+            authentication_classes=[JWTStatelessUserAuthentication])
+    def count(self, request):
+        # Badge polling: the token alone identifies the user and the count
+        # comes from the cache, so a warm call runs no queries.
+        return Response({'pending': inbox.pending_count(request.user.id)})
 
     @action(detail=False, methods=['get'], url_path='friends')
     def my_friends(self, request):
-        accepted = Request.objects.filter(
+        accepted = sharding.gather(lambda: list(Request.objects.filter(
             (Q(from_user=request.user) | Q(to_user=request.user)),
             status='accepted'
-        )
+        ).select_related('from_user', 'to_user')))
         friends = []
         for fr in accepted:
             friend = fr.to_user if fr.from_user == request.user else fr.from_user
@@ -146,11 +218,12 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
 
 
             if friend_request.group:
-                Member.objects.create(
-                    group=friend_request.group,
-                    name=request.user.username ,
-                    user=request.user
-                )
+                with sharding.using(friend_request._state.db):
+                    Member.objects.create(
+                        group=friend_request.group,
+                        name=request.user.username ,
+                        user=request.user
+                    )
                 message = 'Group invite accepted and added to group.'
             else:
 
@@ -206,7 +279,7 @@ class GroupListView(APIView):
         user = request.user
 
 
-        member_entries = Member.objects.filter(user=user).select_related('group')
+        member_entries = sharding.gather(lambda: list(Member.objects.filter(user=user).select_related('group')))
 
 
         groups = [member.group for member in member_entries]
@@ -216,7 +289,8 @@ class GroupListView(APIView):
         return Response(serializer.data, status=200)
 
 @api_view(['GET'])
-@permission_classes([IsAuthenticated])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
 def group_members(request, group_id):
     try:
         group = Group.objects.get(pk=group_id)
@@ -234,6 +308,7 @@ def group_members(request, group_id):
 class AddExpenseView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def post(self, request):
         serializer = ExpenseSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
@@ -241,9 +316,65 @@ class AddExpenseView(APIView):
             return Response({"message": "Expense added successfully"}, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class ExpenseDetailView(APIView):
+    """One expense: read it, edit it (PATCH) or delete it.
+
+    The payer and members of the expense's group may edit; users in the
+    split may also read. A deleted expense answers 410 with its tombstone.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def _expense(self, request, pk, edit=False):
+        expense = expenses.find(pk)
+        if expense is None:
+            raise Http404
+        user_id = request.user.id
+        allowed = expense.paid_by_id == user_id or (
+            expense.group_id is not None and membership.is_member(user_id, expense.group_id)
+        )
+        if not allowed and not edit:
+            with sharding.using(expense._state.db):
+                allowed = ExpenseSplitBetween.objects.filter(expense=expense, owe_id=user_id).exists()
+        if not allowed:
+            raise Http404
+        return expense
+
+    def _tombstone(self, expense):
+        return Response({
+            "id": expense.id,
+            "deleted": True,
+            "deleted_at": fast_serializers.iso_datetime(expense.deleted_at),
+        }, status=status.HTTP_410_GONE)
+
+    def get(self, request, pk):
+        expense = self._expense(request, pk)
+        if expense.deleted_at is not None:
+            return self._tombstone(expense)
+        with sharding.using(expense._state.db):
+            data = fast_serializers.group_expenses(Expense.objects.filter(pk=expense.pk), *parse_fields(request))
+        return Response(data[0])
+
+    def patch(self, request, pk):
+        expense = self._expense(request, pk, edit=True)
+        if expense.deleted_at is not None:
+            return self._tombstone(expense)
+        serializer = ExpenseSerializer(expense, data=request.data, partial=True, context={'request': request})
+        if serializer.is_valid():
+            serializer.save()
+            return Response({"message": "Expense updated successfully"})
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def delete(self, request, pk):
+        expense = self._expense(request, pk, edit=True)
+        deleted = expenses.delete_expense(expense) if expense.deleted_at is None else None
+        if deleted is None:
+            return self._tombstone(expenses.find(pk))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 class SettleUpView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def post(self, request):
         from_user = request.user
         to_user_id = request.data.get("to_user_id")
@@ -255,7 +386,8 @@ class SettleUpView(APIView):
 
         to_user = User.objects.get(id=to_user_id)
 
-        with transaction.atomic():
+        # Serialises settle-ups (and expense writes) for this pair only.
+        with ledger_lock(pair_scope(from_user.id, to_user.id)):
 
             settlement = Settlement.objects.create(
                 from_user=from_user,
@@ -264,34 +396,90 @@ class SettleUpView(APIView):
                 remark=remark,
 
             )
+            rollups.record_settlement(settlement)
+            checkpoints.note_writes(None, [(from_user.id, to_user.id)])
+            events.settlement_created(settlement)
 
-            remaining_amount = amount
+            remaining_amount = _consume_splits(from_user, to_user, amount)
 
-            splits = ExpenseSplitBetween.objects.filter(
-                owe_id=from_user,
-                expense__paid_by=to_user
-            ).order_by('id')
+        # Group splits on the shards are paid down afterwards, one shard
+        # (and one transaction) at a time.
+        for alias in sharding.SHARDS:
+            if remaining_amount <= 0:
+                break
+            with sharding.using(alias), ledger_lock(pair_scope(from_user.id, to_user.id)):
+                remaining_amount = _consume_splits(from_user, to_user, remaining_amount)
 
-            for split in splits:
-                if remaining_amount <= 0:
-                    break
+        return Response({"message": "Settlement successful"}, status=200)
 
-                if split.amount_owed <= remaining_amount:
-                    remaining_amount -= float(split.amount_owed)
-                    split.amount_owed = 0
-                else:
-                    split.amount_owed -= remaining_amount
-                    remaining_amount = 0
 
-                split.save()
+def _consume_splits(from_user, to_user, remaining_amount):
+    """Pay down from_user's oldest debts to to_user; returns what is left."""
+    splits = ExpenseSplitBetween.objects.filter(
+        owe_id=from_user,
+        expense__paid_by=to_user
+    ).select_related('expense').select_for_update(of=('self',)).order_by('id')
+
+    for split in splits:
+        if remaining_amount <= 0:
+            break
+
+        previous = split.amount_owed
+        if split.amount_owed <= remaining_amount:
+            remaining_amount -= float(split.amount_owed)
+            split.amount_owed = 0
+        else:
+            split.amount_owed -= remaining_amount
+            remaining_amount = 0
+
+        split.save()
+        checkpoints.adjust_split(
+            split.id, split.expense.group_id, from_user.id, to_user.id,
+            (int(split.amount_owed) - previous) * MINOR_UNITS
+        )
+    return remaining_amount
+
+def wants_settled(request):
+    return request.query_params.get('include_settled', '').lower() in ('1', 'true', 'yes')
+
+
+def owed_splits(request, user_id):
+    """``user_id``'s splits: outstanding only unless ?include_settled=true."""
+    splits = ExpenseSplitBetween.objects.filter(owe_id=user_id)
+    if wants_settled(request):
+        return splits
+    # Served by split_outstanding_idx.
+    return splits.filter(amount_owed__gt=0)
 
-        return Response({"message": "Settlement successful"}, status=200)
 
 @api_view(['GET'])
+@permission_classes([IsAuthenticated])
 def get_owed_expenses(request, user_id):
-    expenses = ExpenseSplitBetween.objects.filter(owe_id=user_id).select_related('expense', 'expense__paid_by', 'expense__group')
-    serializer = OwedExpenseSerializer(expenses, many=True)
-    return Response(serializer.data)
+    if user_id != request.user.id:
+        return Response({"error": "You can only list your own debts"}, status=403)
+    fields, expand = parse_fields(request)
+    return Response(sharding.gather(lambda: fast_serializers.owed_expenses(
+        owed_splits(request, user_id), fields, expand
+    )))
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_outstanding_debts(request):
+    outstanding = ExpenseSplitBetween.objects.filter(owe_id=request.user.id, amount_owed__gt=0)
+    totals = sharding.gather(lambda: list(
+        outstanding.values_list('expense__paid_by_id', 'expense__paid_by__username')
+        .annotate(total=Sum('amount_owed'), count=Count('id')).order_by()
+    ))
+    rows = sharding.gather(lambda: list(outstanding.order_by('-id').values_list(
+        'id', 'expense_id', 'expense__description', 'amount_owed', 'expense__amount',
+        'expense__group__name', 'expense__created_at', 'expense__paid_by_id',
+    )))
+    creditors = fast_serializers.owed_by_creditor(totals, rows)
+    return Response({
+        "total": sum(entry['total'] for entry in creditors),
+        "creditors": creditors,
+    })
 
 
 class AllRelatedExpensesView(APIView):
@@ -299,21 +487,37 @@ class AllRelatedExpensesView(APIView):
 
     def get(self, request):
         user = request.user
+        fields, expand = parse_fields(request)
+        context = {'request': request}
+        include_archived = archive.wants_archive(request)
 
+        def related():
+            paid_expenses = ExpenseSerializer.sparse_queryset(
+                Expense.objects.filter(paid_by=user, deleted_at__isnull=True), request
+            )
 
-        paid_expenses = Expense.objects.filter(paid_by=user).select_related('group')
 
+            owed_expenses = owed_splits(request, user.id)
 
-        owed_expenses = ExpenseSplitBetween.objects.filter(
-            owe_id=user
-        ).select_related('expense', 'expense__paid_by', 'expense__group')
+            paid_serializer = ExpenseSerializer(paid_expenses, many=True, context=context)
+            paid, owed = paid_serializer.data, fast_serializers.owed_expenses(owed_expenses, fields, expand)
 
-        paid_serializer = ExpenseSerializer(paid_expenses, many=True)
-        owed_serializer = OwedExpenseSerializer(owed_expenses, many=True)
+            if include_archived:
+                paid += ExpenseSerializer(
+                    ExpenseSerializer.sparse_queryset(ArchivedExpense.objects.filter(paid_by=user), request),
+                    many=True, context=context
+                ).data
+                # Archived splits are all settled, so they join the owed half
+                # only when the hot half lists settled splits too.
+                if wants_settled(request):
+                    owed += fast_serializers.owed_expenses(ArchivedExpenseSplit.objects.filter(owe_id=user), fields, expand)
+            return paid, owed
 
+        # One query pair per database, run in parallel when sharded.
+        parts = sharding.fan_out(related)
         return Response({
-            "paid": paid_serializer.data,
-            "owed": owed_serializer.data
+            "paid": [row for paid, _ in parts for row in paid],
+            "owed": [row for _, owed in parts for row in owed]
         })
 
 class ExpensesBetweenUsersView(APIView):
@@ -322,21 +526,45 @@ class ExpensesBetweenUsersView(APIView):
     def get(self, request, friend_id):
         user = request.user
 
-        expenses = Expense.objects.filter(
-            Q(paid_by=user, expensesplitbetween__owe_id=friend_id) |
-            Q(paid_by_id=friend_id, expensesplitbetween__owe_id=user.id)
-        ).select_related('paid_by', 'group').prefetch_related('expensesplitbetween_set').distinct()
+        context = {'user': user, 'friend_id': friend_id}
+        include_archived = archive.wants_archive(request)
 
-        serializer = DetailedExpenseWithSplitsSerializer(expenses, many=True, context={'user': user, 'friend_id': friend_id})
-        return Response(serializer.data)
+        def between():
+            expenses = Expense.objects.filter(
+                Q(paid_by=user, expensesplitbetween__owe_id=friend_id) |
+                Q(paid_by_id=friend_id, expensesplitbetween__owe_id=user.id)
+            ).select_related('paid_by', 'group').prefetch_related('expensesplitbetween_set').distinct()
+
+            serializer = DetailedExpenseWithSplitsSerializer(expenses, many=True, context=context)
+            data = serializer.data
+
+            if include_archived:
+                archived = ArchivedExpense.objects.filter(
+                    Q(paid_by=user, archivedexpensesplit__owe_id=friend_id) |
+                    Q(paid_by_id=friend_id, archivedexpensesplit__owe_id=user.id)
+                ).select_related('paid_by', 'group').distinct()
+                data += ArchivedExpenseWithSplitsSerializer(archived, many=True, context=context).data
+            return data
+
+        return Response(sharding.gather(between))
+
+
+def _newest_first(settlements):
+    # Each database's slice is already ordered; only a merged list needs sorting.
+    if sharding.enabled():
+        settlements.sort(key=lambda s: s.get('settled_at') or '', reverse=True)
+    return settlements
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_settlements(request):
-    settlements = Settlement.objects.filter(from_user=request.user) | Settlement.objects.filter(to_user=request.user)
-    serializer = SettlementSerializer(settlements.order_by('-settled_at'), many=True)
-    return Response(serializer.data)
+    fields, expand = parse_fields(request)
+
+    def mine():
+        settlements = Settlement.objects.filter(from_user=request.user) | Settlement.objects.filter(to_user=request.user)
+        return fast_serializers.settlements(settlements.order_by('-settled_at'), fields, expand)
+    return Response(_newest_first(sharding.gather(mine)))
 
 class SettlementsBetweenUsersView(APIView):
     permission_classes = [IsAuthenticated]
@@ -344,13 +572,16 @@ class SettlementsBetweenUsersView(APIView):
     def get(self, request, friend_id):
         user = request.user
 
-        settlements = Settlement.objects.filter(
-            Q(from_user=user, to_user_id=friend_id) |
-            Q(from_user_id=friend_id, to_user=user)
-        ).order_by('-settled_at')
+        fields, expand = parse_fields(request)
+
+        def between():
+            settlements = Settlement.objects.filter(
+                Q(from_user=user, to_user_id=friend_id) |
+                Q(from_user_id=friend_id, to_user=user)
+            ).order_by('-settled_at')
+            return fast_serializers.settlements(settlements, fields, expand)
 
-        serializer = SettlementSerializer(settlements, many=True)
-        return Response(serializer.data)
+        return Response(_newest_first(sharding.gather(between)))
 
 
 class GroupCreateWithInvitesView(APIView):
@@ -365,45 +596,145 @@ class GroupCreateWithInvitesView(APIView):
 
         group = Group.objects.create(name=group_name)
 
-        for uid in member_ids:
-            user = User.objects.filter(id=uid).first()
-            if user and user != request.user:
-                Request.objects.create(
-                    from_user=request.user,
-                    to_user=user,
-                    group=group,
-                    status='pending'
-                )
+        with sharding.for_group(group.id):
+            for uid in member_ids:
+                user = User.objects.filter(id=uid).first()
+                if user and user != request.user:
+                    invite = Request.objects.create(
+                        from_user=request.user,
+                        to_user=user,
+                        group=group,
+                        status='pending'
+                    )
+                    events.request_created(invite)
 
 
-        Member.objects.create(group=group, user=request.user, name=request.user.username)
+            Member.objects.create(group=group, user=request.user, name=request.user.username)
 
         return Response(GroupSerializer(group).data, status=201)
 
 
 @api_view(['GET'])
-@permission_classes([IsAuthenticated])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
 def get_group_expenses(request, group_id):
     group = get_object_or_404(Group, id=group_id)
-    expenses = Expense.objects.filter(group=group).order_by('-created_at')
-    serializer = GroupExpenseSerializer(expenses, many=True)
-    return Response(serializer.data)
+    fields, expand = parse_fields(request)
+    expenses = Expense.objects.filter(group=group, deleted_at__isnull=True).order_by('-created_at')
+    data = fast_serializers.group_expenses(expenses, fields, expand)
+
+    if archive.wants_archive(request):
+        archived = ArchivedExpense.objects.filter(group=group).order_by('-created_at')
+        data += fast_serializers.group_expenses(archived, fields, expand)
+        data.sort(key=lambda e: (e.get('created_at'), e.get('id')), reverse=True)
+    return Response(data)
 
 @api_view(['GET'])
-@permission_classes([IsAuthenticated])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
 def get_group_settlements(request, group_id):
     group = get_object_or_404(Group, id=group_id)
     settlements = Settlement.objects.filter(group=group).order_by('-settled_at')
-    serializer = SettlementSerializer(settlements, many=True)
-    return Response(serializer.data)
+    return Response(fast_serializers.settlements(settlements, *parse_fields(request)))
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
+def group_recurring_expenses(request, group_id):
+    group = get_object_or_404(Group, id=group_id)
+    if request.method == 'POST':
+        serializer = RecurringExpenseSerializer(data=request.data, context={'request': request, 'group': group})
+        if serializer.is_valid():
+            serializer.save(group=group, paid_by=request.user)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    templates = RecurringExpense.objects.filter(group=group).order_by('-id')
+    return Response(RecurringExpenseSerializer(templates, many=True).data)
+
+
+@api_view(['DELETE'])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
+def stop_recurring_expense(request, group_id, pk):
+    # Deactivated rather than deleted; expenses already created keep their link.
+    if not RecurringExpense.objects.filter(group_id=group_id, pk=pk, paid_by=request.user).update(active=False):
+        return Response({"error": "Recurring expense not found"}, status=404)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
+def get_group_balances(request, group_id):
+    group = get_object_or_404(Group, id=group_id)
+    balances = checkpoints.group_balances(group.id)
+    return Response(balances_payload(group.id, balances))
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsGroupMember])
+@sharding.group_scoped
+def get_group_analytics(request, group_id):
+    group = get_object_or_404(Group, id=group_id)
+    rows = SpendRollup.objects.filter(group=group)
+
+    monthly = rows.values('month').annotate(
+        spent=Sum('paid'), expenses=Sum('expense_count')
+    ).order_by('month')
+    top_payers = rows.values('user_id', 'user__username').annotate(
+        paid=Sum('paid')
+    ).filter(paid__gt=0).order_by('-paid')[:10]
+    shares = rows.filter(share__gt=0).values('month', 'user_id', 'share').order_by('month', 'user_id')
+
+    return Response({
+        "group": group.id,
+        "monthly": [
+            {"month": r['month'], "spent": float(r['spent']), "expenses": r['expenses']}
+            for r in monthly
+        ],
+        "top_payers": [
+            {"id": r['user_id'], "username": r['user__username'], "paid": float(r['paid'])}
+            for r in top_payers
+        ],
+        "member_share": [
+            {"month": r['month'], "user": r['user_id'], "share": r['share']}
+            for r in shares
+        ],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_user_analytics(request):
+    rows = sharding.gather(lambda: list(SpendRollup.objects.filter(user=request.user).values(
+        'month', 'group_id', 'group__name', 'paid', 'share', 'settled_paid', 'settled_received'
+    ).order_by('month', 'group_id')))
+    if sharding.enabled():
+        rows.sort(key=lambda r: (r['month'], r['group_id'] or 0))
+    return Response([
+        {
+            "month": r['month'],
+            "group": r['group_id'],
+            "group_name": r['group__name'],
+            "paid": float(r['paid']),
+            "share": r['share'],
+            "settled_paid": float(r['settled_paid']),
+            "settled_received": float(r['settled_received']),
+        }
+        for r in rows
+    ])
 
 
 class GroupSettleUpView(APIView):
+    permission_classes = [IsAuthenticated, IsGroupMember]
+
+    @idempotent
     def post(self, request, group_id):
         data = request.data.copy()
         data['group'] = group_id
 
-        serializer = GroupSettleUpSerializer(data=data)
+        serializer = GroupSettleUpSerializer(data=data, context={'request': request})
         if serializer.is_valid():
             settlements = serializer.save()
             return Response({
@@ -418,31 +749,12 @@ class GroupSettleUpView(APIView):
 def get_overall_balance(request):
     user = request.user
 
-    you_are_owed = Decimal('0.00')
-    you_owe = Decimal('0.00')
-
-
-    expenses_paid_by_user = Expense.objects.filter(paid_by=user)
-    for expense in expenses_paid_by_user:
-        splits = ExpenseSplitBetween.objects.filter(expense=expense)
-        for split in splits:
-            if split.owe_id != user:
-                you_are_owed += Decimal(split.amount_owed)
-
-
-    expenses_owed_by_user = ExpenseSplitBetween.objects.filter(owe_id=user)
-    for split in expenses_owed_by_user:
-        if split.expense.paid_by != user:
-            you_owe += Decimal(split.amount_owed)
-
-
-    settlements_paid_by_user = Settlement.objects.filter(from_user=user)
-    for s in settlements_paid_by_user:
-        you_owe -= s.amount
-
-    settlements_received_by_user = Settlement.objects.filter(to_user=user)
-    for s in settlements_received_by_user:
-        you_are_owed -= s.amount
+    # Totals are plain sums, so each database's share simply adds up.
+    per_db = sharding.fan_out(lambda: checkpoints.user_balance_totals(user.id))
+    owed_to_user = sum(owed for owed, _ in per_db)
+    owed_by_user = sum(owes for _, owes in per_db)
+    you_are_owed = Decimal(owed_to_user) / MINOR_UNITS
+    you_owe = Decimal(owed_by_user) / MINOR_UNITS
 
 
     final_you_are_owed = abs(you_are_owed)  # always positive
@@ -454,3 +766,68 @@ def get_overall_balance(request):
         "you_owe": float(round(final_you_owe, 2)),
         "total": float(round(total, 2))
     })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_balance_with_friend(request, friend_id):
+    per_db = sharding.fan_out(lambda: checkpoints.pair_totals(request.user.id, friend_id))
+    you_owe = sum(owes for owes, _ in per_db)
+    owed_to_you = sum(owed for _, owed in per_db)
+    return Response({
+        "you_are_owed": to_major(owed_to_you),
+        "you_owe": -to_major(you_owe),
+        "total": to_major(owed_to_you - you_owe)
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_ledger(request):
+    text = request.query_params.get('q', '').strip()
+    if not text:
+        return Response({"error": "q is required"}, status=400)
+    try:
+        page, page_size = page_params(request, search.PAGE_SIZE, search.MAX_PAGE_SIZE)
+    except ValueError:
+        return Response({"error": "page and page_size must be integers"}, status=400)
+
+    results, has_more = search.search(request.user.id, text, page, page_size)
+    return Response({
+        "results": results,
+        "page": page,
+        "page_size": page_size,
+        "has_more": has_more,
+    })
+
+
+class BatchView(APIView):
+    """Serve several API calls in one round trip.
+
+    POST {"requests": [{"method": "GET", "path": "/api/balance/"}, ...]}
+    returns {"responses": [{"status": 200, "body": ...}, ...]} in the same
+    order. Items are authenticated as the caller without re-checking the token.
+    """
+    permission_classes = [IsAuthenticated]
+    batch_endpoint = True
+
+    def post(self, request):
+        try:
+            items = batch.parse(request.data)
+        except batch.BatchError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        results, wrote = batch.run(request, items)
+        # A batch of reads should not pin the caller to the primary.
+        request._request.db_wrote = wrote
+        return Response({"responses": results})
+
+
+def metrics_view(request):
+    # Closed unless METRICS_TOKEN is set; the scraper sends it as a bearer token.
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        return HttpResponse(status=403)
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(metrics.collect()), content_type=metrics.CONTENT_TYPE)
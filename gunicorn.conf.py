@@ -0,0 +1,41 @@
+import os
+
+# Loaded automatically by gunicorn from the working directory. Bind address
+# and worker count keep gunicorn's defaults ($PORT, $WEB_CONCURRENCY).
+#
+# gunicorn serves the API over WSGI (splitzy_backend.wsgi), where each
+# worker thread keeps its database connections between requests. The push
+# streams are long-lived and served by a separate ASGI process,
+#
+#     uvicorn splitzy_backend.asgi:push_application --port $PUSH_PORT
+#
+# with /api/events/stream/ and /ws/events/ routed to it. Set REDIS_URL so
+# events written by these workers reach it.
+
+
+def post_worker_init(worker):
+    # Connect before the first request instead of during it.
+    from api.db_pool import prewarm
+
+    try:
+        prewarm()
+    except Exception as exc:
+        worker.log.warning("Database prewarm failed: %s", exc)
+
+
+def worker_exit(server, worker):
+    from django.db import connections
+
+    from api.metrics import flush
+
+    flush()
+    connections.close_all()
+
+
+def child_exit(server, worker):
+    # Keep an exited worker's metrics in the shared directory's archive.
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        from api.metrics import mark_process_dead
+
+        mark_process_dead(worker.pid, directory)
@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'splitzy_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up.
+from api import push  # noqa: E402
+
+# The push endpoints (SSE and WebSockets) in front of the whole API, for
+# running everything in one process locally.
+application = push.router(django_application)
+
+# The push endpoints only, for the process deployed next to the WSGI
+# workers (see gunicorn.conf.py). Django's ASGI handler runs each request
+# on a new thread, which would open a database connection per request.
+push_application = push.router(push.not_found)
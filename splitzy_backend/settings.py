@@ -47,8 +47,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'api.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -56,6 +58,8 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'api.db_routers.ReplicaRoutingMiddleware',
+    'api.load_shedding.LoadSheddingMiddleware',
 ]
 
 
@@ -84,22 +88,122 @@ WSGI_APPLICATION = 'splitzy_backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-tmpPostgres = urlparse(os.getenv("DATABASE_URL"))
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': tmpPostgres.path[1:],
-        'USER': tmpPostgres.username,
-        'PASSWORD': tmpPostgres.password,
-        'HOST': tmpPostgres.hostname,
-        'PORT': tmpPostgres.port or 5432,
+# Connections are kept open between requests (CONN_MAX_AGE) and checked
+# before reuse (CONN_HEALTH_CHECKS), so a request only pays the TCP+TLS+auth
+# handshake when its worker has no usable connection. The api.db_backends
+# engines record connect time and connection age for the metrics.
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", "600"))
+
+
+def postgres_database(url):
+    parsed = urlparse(url)
+    return {
+        'ENGINE': 'api.db_backends.postgresql',
+        'NAME': parsed.path[1:],
+        'USER': parsed.username,
+        'PASSWORD': parsed.password,
+        'HOST': parsed.hostname,
+        'PORT': parsed.port or 5432,
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
         'OPTIONS': {
-            'sslmode': 'require'
+            'sslmode': 'require',
+            'connect_timeout': 5,
+            'keepalives': 1,
+            'keepalives_idle': 60,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
         },
     }
+
+
+DATABASES = {
+    'default': postgres_database(os.getenv("DATABASE_URL"))
 }
 
+# Read-only requests are sent to the replica when one is configured; see
+# api.db_routers. LOCAL_SQLITE=True opens the one SQLite file twice, as the
+# primary and as a replica that is never behind, so the routing runs
+# locally without anything to replicate or migrate.
+if os.getenv("REPLICA_DATABASE_URL"):
+    DATABASES['replica'] = postgres_database(os.getenv("REPLICA_DATABASE_URL"))
+
+# Writers take SQLite's write lock when their transaction begins and wait
+# for it up to ``timeout`` seconds; upgrading a read transaction instead
+# fails at once with "database is locked" when another thread is writing.
+LOCAL_SQLITE_OPTIONS = {'transaction_mode': 'IMMEDIATE', 'timeout': 20}
+
+if os.getenv("LOCAL_SQLITE") == "True":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'api.db_backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'OPTIONS': LOCAL_SQLITE_OPTIONS,
+            # A file rather than memory, so worker processes started by
+            # tests (reconcile_ledger --workers) see the test database.
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        },
+        'replica': {
+            'ENGINE': 'api.db_backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'TEST': {'MIRROR': 'default'},
+        },
+    }
+
+# Group shards (see api.sharding): GROUP_SHARD_DATABASE_URLS is a
+# comma-separated list of Postgres URLs; LOCAL_SQLITE_SHARDS=N adds N
+# SQLite files instead. Run ``manage.py migrate --database shard_N`` for
+# each, then ``manage.py init_shards``, which also moves group rows written
+# before the shards existed off the home database. Tests run against shards
+# with LOCAL_SQLITE=True LOCAL_SQLITE_SHARDS=2.
+GROUP_SHARDS = []
+for index, url in enumerate(filter(None, os.getenv("GROUP_SHARD_DATABASE_URLS", "").split(","))):
+    DATABASES[f'shard_{index}'] = postgres_database(url.strip())
+    GROUP_SHARDS.append(f'shard_{index}')
+
+if os.getenv("LOCAL_SQLITE") == "True":
+    for index in range(int(os.getenv("LOCAL_SQLITE_SHARDS", "0"))):
+        DATABASES[f'shard_{index}'] = {
+            'ENGINE': 'api.db_backends.sqlite3',
+            'NAME': BASE_DIR / f'db_shard_{index}.sqlite3',
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'OPTIONS': LOCAL_SQLITE_OPTIONS,
+            'TEST': {'NAME': BASE_DIR / f'test_db_shard_{index}.sqlite3'},
+        }
+        GROUP_SHARDS.append(f'shard_{index}')
+
+DATABASE_ROUTERS = ['api.sharding.GroupShardRouter', 'api.db_routers.PrimaryReplicaRouter']
+
+# Seconds a user's reads stay on the primary after one of their writes.
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", "15"))
+
+# /metrics: with several workers, point this at a directory they share.
+METRICS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Bearer token the scraper must send; without one /metrics answers 403.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Cache shared by every worker (replica pins, membership and badge counts,
+# load shedding counters) and the push events fanned out to them. Without
+# REDIS_URL each process keeps its own in memory and only pushes to its own
+# clients, and the membership and badge-count caches are off: a write drops
+# them with cache.delete, which would never reach the other workers' copies,
+# so every check reads the database instead of serving a stale answer.
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+        }
+    }
+    PUSH_BACKEND = 'api.events.RedisBackend'
+    PUSH_REDIS_URL = os.getenv("REDIS_URL")
+
+# Per-user rate limits and a cap on concurrent expensive requests; see
+# api.load_shedding for the route classes and their defaults.
+LOAD_SHEDDING_ENABLED = os.getenv("LOAD_SHEDDING_ENABLED", "True") == "True"
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -150,6 +254,10 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
 